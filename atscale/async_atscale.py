@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import json
+import logging
+
+
+class AsyncAtScale:
+    """Asyncio counterpart of AtScale used to run many cube queries concurrently from one event loop.
+
+    Queries are built and parsed by the wrapped AtScale object, so results match AtScale.get_data and
+    AtScale.custom_query. Any attribute not defined here, such as the list and create functions, is looked up on the
+    wrapped AtScale object.
+
+    :var AtScale `~AsyncAtScale.atscale`: The AtScale object whose project, model and token are used.
+    :var int `~AsyncAtScale.max_concurrency`: The maximum number of requests in flight at once. Defaults to 10.
+    """
+
+    def __init__(self, atscale, max_concurrency=10, pool_size=100, limit_per_host=0, timeout=None):
+        """ Creates an asyncio client for the project of the given AtScale object.
+
+        :param AtScale atscale: The AtScale object to query through.
+        :param int max_concurrency: The maximum number of requests in flight at once. Defaults to 10.
+        :param int pool_size: The maximum number of open connections. Defaults to 100.
+        :param int limit_per_host: The maximum number of open connections to a single host. Defaults to 0 for no limit.
+        :param float timeout: The total number of seconds to wait for a response. Defaults to None to wait indefinitely.
+        """
+        try:
+            import aiohttp
+        except ImportError as e:
+            from errors import AtScaleExtrasDependencyImportError
+            raise AtScaleExtrasDependencyImportError('async', str(e))
+
+        if int(max_concurrency) < 1:
+            from errors import UserError
+            raise UserError('max_concurrency must be greater than 0')
+
+        self.atscale = atscale
+        self.max_concurrency = max_concurrency
+        self._pool_size = pool_size
+        self._limit_per_host = limit_per_host
+        self._timeout = timeout
+        # created on first use so they are bound to the running event loop
+        self._session = None
+        self._semaphore = None
+        self._token_lock = None
+
+    @classmethod
+    async def create(cls, *args, max_concurrency=10, pool_size=100, limit_per_host=0, timeout=None, **kwargs):
+        """ Creates an AtScale object without blocking the event loop and wraps it in an AsyncAtScale.
+
+        Takes the same arguments as AtScale.
+
+        :param int max_concurrency: The maximum number of requests in flight at once. Defaults to 10.
+        :param int pool_size: The maximum number of open connections. Defaults to 100.
+        :param int limit_per_host: The maximum number of open connections to a single host. Defaults to 0 for no limit.
+        :param float timeout: The total number of seconds to wait for a response. Defaults to None to wait indefinitely.
+        :return: The asyncio client.
+        :rtype: AsyncAtScale
+        """
+        from atscale import AtScale
+        loop = asyncio.get_running_loop()
+        atscale = await loop.run_in_executor(None, functools.partial(AtScale, *args, **kwargs))
+        return cls(atscale, max_concurrency=max_concurrency, pool_size=pool_size, limit_per_host=limit_per_host,
+                   timeout=timeout)
+
+    def __getattr__(self, name):
+        if name == 'atscale':
+            raise AttributeError(name)
+        return getattr(self.atscale, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """ Closes all pooled connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """ Returns the aiohttp session, creating it inside the running event loop on first use.
+        """
+        if self._session is None:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self._pool_size, limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self._timeout))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._token_lock = asyncio.Lock()
+        return self._session
+
+    async def _refresh_token(self, rejected_token):
+        """ Refreshes the token of the wrapped AtScale object unless another request already has.
+
+        :param str rejected_token: The token the server rejected.
+        """
+        async with self._token_lock:
+            if self.atscale.token == rejected_token:
+                logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
+                await asyncio.get_running_loop().run_in_executor(None, self.atscale.refresh_token)
+
+    async def _request(self, method, url, data=None, headers=None):
+        """ Sends a request, refreshing the token and retrying once if it is rejected.
+
+        :param str method: The HTTP method to use.
+        :param str url: The url to send the request to.
+        :param str data: The body of the request. Defaults to None.
+        :param dict headers: Headers to add to or override the defaults. Defaults to None.
+        :return: The status code and body of the response.
+        :rtype: tuple of (int, bytes)
+        """
+        session = self._get_session()
+        async with self._semaphore:
+            for attempt in range(2):
+                token = self.atscale.token
+                request_headers = self.atscale.session.build_headers(headers, True)
+                async with session.request(method, url, data=data, headers=request_headers) as response:
+                    status = response.status
+                    content = await response.read()
+                if status not in (401, 403) or attempt == 1:
+                    return status, content
+                await self._refresh_token(token)
+
+    def _raise_error(self, content):
+        """ Raises the error message from the body of a failed response.
+
+        :param bytes content: The body of the response.
+        """
+        resp = json.loads(content)
+        raise Exception(resp['response']['error'])
+
+    async def refresh_project(self):
+        """ Refreshes the project to pick up any changes from the server.
+        """
+        atscale = self.atscale
+        project_url = f'{atscale.server}:{atscale.design_center_server_port}/api/1.0/org/{atscale.organization}' \
+                      f'/project/{atscale.project_id}'
+        published_url = f'{atscale.server}:{atscale.engine_port}/projects/published/orgId/{atscale.organization}'
+        (project_status, project_content), (published_status, published_content) = await asyncio.gather(
+            self._request('GET', project_url), self._request('GET', published_url))
+        if project_status != 200:
+            self._raise_error(project_content)
+        if published_status != 200:
+            self._raise_error(published_content)
+
+        published_projects = json.loads(published_content)['response']
+        atscale._set_project_json(json.loads(project_content)['response'])
+        atscale.project_name = atscale._find_project_name(published_projects)
+        atscale._published_version = atscale._published_fingerprint(published_projects)
+
+        level_rows, hierarchy_rows, measure_rows = await asyncio.gather(
+            self._submit_dmv_query(atscale._dimensions_dmv_query()),
+            self._submit_dmv_query(atscale._hierarchies_dmv_query()),
+            self._submit_dmv_query(atscale._measures_dmv_query()))
+        atscale._load_metadata(level_rows, hierarchy_rows, measure_rows)
+        atscale._save_metadata_cache(published_projects)
+
+    async def _submit_dmv_query(self, query_body):
+        """ Submit DMV Query.
+        """
+        url = f'{self.atscale.server}:{self.atscale.engine_port}/xmla/{self.atscale.organization}'
+        status, content = await self._request('POST', url, data=query_body, headers={'Content-type': 'application/xml'})
+        if status != 200:
+            # XMLA errors come back as SOAP faults rather than the JSON of the REST endpoints
+            raise Exception(f'DMV query failed with status {status}: {content.decode("utf-8", errors="replace")}')
+        return self.atscale._parse_dmv_response(content)
+
+    async def custom_query(self, query, language='SQL', useAggs=True, genAggs=False, fakeResults=False, dryRun=False,
+                           useLocalCache=True, useAggregateCache=True, timeout=2, output='pandas'):
+        """ Submits the given query and returns the results in a pandas dataframe.
+
+        See AtScale.custom_query for a description of the parameters.
+
+        :return: A DataFrame containing the query results.
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        from db.database import is_arrow_output
+        is_arrow_output(output)
+        atscale = self.atscale
+        json_data = atscale._build_query_request(query, language, useAggs, genAggs, fakeResults, dryRun,
+                                                 useLocalCache, useAggregateCache, timeout)
+        status, content = await self._request('POST', f'{atscale.server}:{atscale.engine_port}/query/orgId/'
+                                                      f'{atscale.organization}/submit', data=json_data)
+        if status != 200:
+            self._raise_error(content)
+        return atscale._parse_query_response(content, output)
+
+    async def get_data(self, features, filter_equals=None, filter_greater=None, filter_less=None,
+                       filter_greater_or_equal=None, filter_less_or_equal=None, filter_not_equal=None, filter_in=None,
+                       filter_between=None, filter_like=None, filter_rlike=None, filter_null=None,
+                       filter_not_null=None, limit=None, comment=None, useAggs=True, genAggs=False,
+                       fakeResults=False, dryRun=False, useLocalCache=True, useAggregateCache=True, timeout=2,
+                       output='pandas', filters=None):
+        """ Submits a query using the supplied information and returns the results in a pandas DataFrame.
+
+        See AtScale.get_data for a description of the parameters.
+
+        :return: A pandas DataFrame containing the query results.
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        query, categorical_features = self.atscale._build_get_data_query(
+            features, filter_equals, filter_greater, filter_less, filter_greater_or_equal, filter_less_or_equal,
+            filter_not_equal, filter_in, filter_between, filter_like, filter_rlike, filter_null, filter_not_null,
+            limit, comment, filters)
+
+        from db.database import is_arrow_output
+        if is_arrow_output(output):
+            from parsers import sort_arrow_table
+            table = await self.custom_query(query, 'SQL', useAggs, genAggs, fakeResults, dryRun, useLocalCache,
+                                            useAggregateCache, timeout, output)
+            return sort_arrow_table(table, categorical_features)
+
+        atscale = self.atscale
+        cache_key = None
+        if atscale.query_cache is not None and not fakeResults and not dryRun:
+            cache_key = atscale._query_cache_key(query, useAggs, genAggs)
+            df = atscale.query_cache.get(cache_key, atscale._query_cache_namespace())
+            if df is not None:
+                return df
+
+        df = await self.custom_query(query, 'SQL', useAggs, genAggs, fakeResults, dryRun, useLocalCache,
+                                     useAggregateCache, timeout)
+        if categorical_features:
+            df.sort_values(categorical_features, inplace=True)
+        if cache_key is not None:
+            atscale.query_cache.put(cache_key, df, atscale._query_cache_namespace())
+        return df
@@ -1,17 +1,31 @@
+import hashlib
+import itertools
 import logging
 import os
+import threading
+import time
 
 import pandas as pd
-import requests
 from requests.auth import HTTPBasicAuth
 import re
 import json
 import uuid
 import getpass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from db.database import Database
+from db.database import Database, is_arrow_output
 from utils import Aggs
 from errors import UserError
+from session import AtScaleSession
+from parsers import parse_query_response, sort_arrow_table
+from cache import QueryCache
+from catalog import MetadataCatalog
+from query import PreparedQuery, compile_where, filters_from_arguments, render_column, render_parts
+from time_series import (add_columns, compare_time_series_features, finish_pushed_features, packed_stats_move,
+                         parquet_chunks, plan_time_series_features, stream_time_series_features, time_series_features,
+                         update_time_series_features, window_state, write_parquet)
 
 agg = Aggs() #used for faster aggregation entry for create_aggregate_feature
 
@@ -27,12 +41,37 @@ class AtScale:
     :var str `~AtScale.password`: The password for the user. Defaults to 'None' to enter via prompt.
     :var str `~AtScale.design_center_server_port`: The port the design center is listening on. Defaults to '10500'.
     :var str `~AtScale.engine_port`: The port the engine is listening on. Defaults to '10502.
+    :var int `~AtScale.pool_connections`: The number of hosts to keep connection pools for. Defaults to 10.
+    :var int `~AtScale.pool_maxsize`: The maximum number of connections kept open to each host. Defaults to 10.
+    :var int `~AtScale.max_retries`: The number of times to retry failed connection attempts. Defaults to 0.
+    :var float `~AtScale.request_timeout`: Seconds to wait on the server per request. Defaults to None to wait indefinitely.
+    :var bool `~AtScale.keep_alive`: Whether connections are kept open between requests. Defaults to True.
+    :var str `~AtScale.metadata_cache_dir`: A directory to cache the dimensions, hierarchies and measures of the
+    published model in so later AtScale objects for the same model skip the DMV queries while the published project is
+    unchanged, the project JSON is always fetched. Defaults to None for no cache.
+    :var dict of str/float `~AtScale.refresh_timings`: The seconds spent on each DMV query and on parsing their results
+    during the last refresh.
+    :var QueryCache `~AtScale.query_cache`: The cache of get_data results, None unless enable_query_cache is called.
     """
 
     __version__ = '0.3.1'
 
+    _QUERY_RESPONSE_CHUNK_SIZE = 1024 * 1024  # bytes of a query response parsed at a time
+
+    _METADATA_CACHE_VERSION = 2  # bump whenever the cached metadata changes shape
+
+    _DB_QUERY_CACHE_SIZE = 256  # translated database queries kept by generate_db_query
+
+    _DB_QUERY_HISTORY_ATTEMPTS = 5  # times the query history is read while waiting for a planned query to appear
+
+    _PLANNED_LIMIT = re.compile(r'\s*\bLIMIT\s+1\s*;?\s*$', re.IGNORECASE)  # the LIMIT 1 closing a planned query
+
+    _QUERY_LIMIT = re.compile(r'\s*\bLIMIT\s+([0-9]+)\s*;?\s*$', re.IGNORECASE)  # the LIMIT closing an AtScale query
+
     def __init__(self, server, organization, project_id, model_id, token=None,
-                 username=None, password=None, design_center_server_port='10500', engine_port='10502'):
+                 username=None, password=None, design_center_server_port='10500', engine_port='10502',
+                 pool_connections=10, pool_maxsize=10, max_retries=0, request_timeout=None, keep_alive=True,
+                 metadata_cache_dir=None):
 
         self.server = server
         self.design_center_server_port = design_center_server_port
@@ -45,6 +84,17 @@ class AtScale:
         self.project_json = None
         self.token = token
         self.username = username
+        self.password = password
+        self.query_cache = None
+        self.metadata_cache_dir = metadata_cache_dir
+        self.refresh_timings = {}
+        self._batch = None
+        self._published_version = None
+        self._db_query_cache = OrderedDict()
+        self._db_query_cache_lock = threading.Lock()
+        self.session = AtScaleSession(token_provider=lambda: self.token, on_unauthorized=self.refresh_token,
+                                      pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                      max_retries=max_retries, timeout=request_timeout, keep_alive=keep_alive)
         if self.token is None: #only prompt password and use temp token if token not given
             if self.username is None:
                 raise UserError('You must pass in a token or alternatively a username to log in with')
@@ -76,6 +126,8 @@ class AtScale:
 
         self._hierarchy_dict = {}
 
+        self._catalog = MetadataCatalog({}, {}, {})
+
         self._level_type_dict = {
             '0': 'Standard',
             '20': 'TimeYears',
@@ -91,7 +143,32 @@ class AtScale:
             '4100': 'Undefined'
         }
 
-        self.refresh_project()
+        # OLE DB type codes used for DATA_TYPE in MDSCHEMA_MEASURES, mapped to how result columns are decoded
+        self._data_type_dict = {
+            '2': 'int',
+            '3': 'int',
+            '16': 'int',
+            '17': 'int',
+            '18': 'int',
+            '19': 'int',
+            '20': 'int',
+            '21': 'int',
+            '4': 'float',
+            '5': 'float',
+            '6': 'float',
+            '14': 'float',
+            '131': 'float',
+            '7': 'datetime',
+            '133': 'datetime',
+            '135': 'datetime',
+            '11': 'bool',
+            '129': 'string',
+            '130': 'string'
+        }
+
+        published_projects = self._get_published_projects()
+        if self.metadata_cache_dir is None or not self._load_metadata_cache(published_projects):
+            self._refresh_project(published_projects)
         logging.debug('AtScale project created, refreshing')
 
     # Update, Refresh, Publish, Export, and Clone
@@ -105,9 +182,8 @@ class AtScale:
         elif self.password is None:
             self.password = getpass.getpass(prompt=f'AtScale Password for username {self.username}: ')
         logging.debug('Refreshing API token')
-        header = {'Content-type': 'application/json'}
         url = f'{self.server}:{self.design_center_server_port}/{self.organization}/auth'
-        response = requests.get(url, headers=header, auth=HTTPBasicAuth(self.username, self.password))
+        response = self.session.get(url, authenticate=False, auth=HTTPBasicAuth(self.username, self.password))
         if response.ok:
             self.token = response.content.decode()
             self.headers = {'Content-type': 'application/json', 'Authorization': f'Bearer {self.token}'}
@@ -132,7 +208,7 @@ class AtScale:
             if 'tables' in dataset['physical']:
                 project_tables = [x for x in dataset['physical']['tables']]
                 url = f'{self.server}:{self.engine_port}/data-sources/orgId/{self.organization}/conn/{conn}/tables/cacheRefresh'
-                response = requests.post(url, data='', headers=self.headers)
+                response = self.session.post(url, data='')
                 if response.status_code != 200:
                     resp = json.loads(response.text)
                     raise Exception(resp['response']['error'])
@@ -147,7 +223,7 @@ class AtScale:
                             else:
                                 info = f'{info}&schema={table["schema"]}'
                         url = f'{self.server}:{self.engine_port}/data-sources/orgId/{self.organization}/conn/{conn}/table/{table["name"]}/info{info}'
-                        response = requests.get(url, headers=self.headers)
+                        response = self.session.get(url)
                         if response.status_code != 200:
                             resp = json.loads(response.text)
                             raise Exception(resp['response']['error'])
@@ -169,65 +245,195 @@ class AtScale:
 
     def refresh_project(self):
         """ Refreshes the project to pick up any changes from the server.
+
+        Inside a batch this does nothing, so the changes made so far in the batch are kept.
+        """
+        if self._batch is not None:
+            return
+        self._refresh_project(self._get_published_projects())
+        #self.update_project_tables()
+
+    def _refresh_project(self, published_projects):
+        """ Refreshes the project using an already fetched list of published projects.
+
+        :param list of dict published_projects: The published projects returned by the engine.
+        """
+        self._set_project_json(self._get_project_json())
+        self.project_name = self._find_project_name(published_projects)
+        self._published_version = self._published_fingerprint(published_projects)
+        self._parse_json()
+        self._save_metadata_cache(published_projects)
+
+    def _get_project_json(self):
+        """ Returns the current, possibly unpublished, project JSON from the design center.
+
+        :rtype: json
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 401:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.get(url, headers=self.headers)
+        response = self.session.get(url)
         if response.status_code == 200:
-            self.project_json = json.loads(response.content)['response']
-            self.model_name = [x['name'] for x in self.project_json['cubes']['cube'] if x['id'] == self.model_id][0]
-            self.project_name = self._get_project_name()
-            self._parse_json()
+            return json.loads(response.content)['response']
         else:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
-        #self.update_project_tables()
 
-    def _get_project_name(self):
-        """ Returns the name of the project.
+    def _set_project_json(self, project_json):
+        """ Stores the project JSON and the name of the model it contains.
 
-        :return: The project name.
-        :rtype: str
+        :param json project_json: The project JSON returned by the design center.
+        """
+        self.project_json = project_json
+        self.model_name = [x['name'] for x in self.project_json['cubes']['cube'] if x['id'] == self.model_id][0]
+
+    def _get_published_projects(self):
+        """ Returns the published projects of the organization.
+
+        :return: The published projects returned by the engine.
+        :rtype: list of dict
         """
         url = f'{self.server}:{self.engine_port}/projects/published/orgId/{self.organization}'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 401:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.get(url, headers=self.headers)
+        response = self.session.get(url)
         if response.status_code == 200:
-            projects = json.loads(response.content)['response']
-            for project in projects:
-                if project['publishType'] == 'normal_publish':
-                    for cube in project['cubes']:
-                        if cube['id'] == self.model_id:
-                            return project['name']
-            return None
+            return json.loads(response.content)['response']
         else:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
 
+    def _find_published_project(self, projects):
+        """ Finds the published project containing the model.
+
+        :param list of dict projects: The published projects returned by the engine.
+        :return: The published project, or None if the model is not published.
+        :rtype: dict
+        """
+        for project in projects:
+            if project['publishType'] == 'normal_publish':
+                for cube in project['cubes']:
+                    if cube['id'] == self.model_id:
+                        return project
+        return None
+
+    def _find_project_name(self, projects):
+        """ Finds the name of the published project containing the model.
+
+        :param list of dict projects: The published projects returned by the engine.
+        :return: The project name, or None if the model is not published.
+        :rtype: str
+        """
+        project = self._find_published_project(projects)
+        if project is None:
+            return None
+        return project['name']
+
+    # Metadata cache
+
+    def _metadata_cache_path(self):
+        """ Returns the file the metadata of this model is cached in.
+
+        :rtype: str
+        """
+        key = hashlib.sha256(f'{self.server}/{self.organization}/{self.project_id}/{self.model_id}'.encode())
+        return os.path.join(self.metadata_cache_dir, f'{key.hexdigest()[:32]}.json')
+
+    def _published_fingerprint(self, projects):
+        """ Fingerprints the published version of the project, this changes whenever the project is republished.
+
+        :param list of dict projects: The published projects returned by the engine.
+        :rtype: str
+        """
+        project = self._find_published_project(projects)
+        return hashlib.sha256(json.dumps(project, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _save_metadata_cache(self, published_projects):
+        """ Writes the metadata parsed from the DMV queries to the metadata cache, if one is configured.
+
+        The project JSON is not cached, it can be edited without being published so the published fingerprint does not
+        tell whether a cached copy is current. Nothing is cached while the model is unpublished as there is no
+        fingerprint to check the metadata against.
+
+        :param list of dict published_projects: The published projects the metadata was loaded for.
+        """
+        if self.metadata_cache_dir is None or self._find_published_project(published_projects) is None:
+            return
+        cache = {
+            'version': self._METADATA_CACHE_VERSION,
+            'fingerprint': self._published_fingerprint(published_projects),
+            'dimensions': self._dimension_dict,
+            'hierarchies': self._hierarchy_dict,
+            'measures': self._measure_dict
+        }
+        path = self._metadata_cache_path()
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.metadata_cache_dir, exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f'Unable to write the metadata cache {path}: {e}')
+
+    def _load_metadata_cache(self, published_projects):
+        """ Loads the parsed metadata from the metadata cache if it matches the published project, the project JSON is
+        fetched from the design center either way.
+
+        :param list of dict published_projects: The published projects returned by the engine.
+        :return: Whether the metadata was loaded from the cache.
+        :rtype: bool
+        """
+        if self._find_published_project(published_projects) is None:
+            return False
+        path = self._metadata_cache_path()
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        try:
+            if cache['version'] != self._METADATA_CACHE_VERSION:
+                return False
+            if cache['fingerprint'] != self._published_fingerprint(published_projects):
+                logging.debug('The project was republished, ignoring the metadata cache')
+                return False
+            dimensions = cache['dimensions']
+            measures = cache['measures']
+            hierarchies = cache['hierarchies']
+            for hierarchy in hierarchies.values():
+                # JSON has no tuples
+                hierarchy['levels'] = [tuple(level) for level in hierarchy['levels']]
+            catalog = MetadataCatalog(dimensions, measures, hierarchies)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logging.warning(f'Ignoring the malformed metadata cache {path}')
+            return False
+
+        self._set_project_json(self._get_project_json())
+        self.project_name = self._find_project_name(published_projects)
+        self._published_version = self._published_fingerprint(published_projects)
+        self._dimension_dict = dimensions
+        self._measure_dict = measures
+        self._hierarchy_dict = hierarchies
+        self._catalog = catalog
+        logging.debug('Loaded the project metadata from the metadata cache')
+        return True
+
     def _update_project(self, project_json, publish=True):
         """ Updates the project.
 
+        Inside a batch the update is deferred until the batch is committed.
+
         :param json project_json: The local version of the project JSON being pushed to the server.
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
+        if self._batch is not None:
+            self._batch['changed'] = True
+            return
         snap = self.create_snapshot(f'Python snapshot {datetime.now()}')
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}'
-        response = requests.put(url, data=json.dumps(project_json), headers=self.headers)
-
-        if response.status_code == 401:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.put(url, data=json.dumps(project_json), headers=self.headers)
+        response = self.session.put(url, data=json.dumps(project_json))
         try:
             if response.status_code != 200:
                 resp = json.loads(response.text)
                 raise Exception(resp['response']['error'])
+            self._invalidate_query_cache()
             if publish is True:
                 self.publish_project()
 
@@ -238,16 +444,55 @@ class AtScale:
             raise
         self.delete_snapshot(snap)
 
+    @contextmanager
+    def batch(self, publish=True):
+        """ Groups changes to the project so they are pushed to the server together.
+
+        The project is refreshed once when the batch starts. Every create and update function called inside the
+        batch then only changes the local project JSON, and when the batch ends the changes are committed with a
+        single snapshot, update and publish. If the commit fails the project is restored from the snapshot. If an
+        exception is raised inside the batch nothing is sent to the server and the local project is refreshed to
+        discard the changes. Batches started inside another batch join the outer one.
+
+        Features created inside a batch are not available to list or query until the batch is committed.
+
+        :param bool publish: Whether or not the updated project should be published. Defaults to True.
+        """
+        if self._batch is not None:
+            yield self
+            return
+
+        self.refresh_project()
+        self._batch = {'changed': False, 'publish': publish}
+        try:
+            yield self
+        except BaseException:
+            self._batch = None
+            self.refresh_project()
+            raise
+        batch = self._batch
+        self._batch = None
+        if batch['changed']:
+            self._update_project(self.project_json, publish=batch['publish'])
+        elif batch['publish'] and not publish:
+            self.publish_project()
+
     def publish_project(self):
         """ Publishes the project to make changes available to other tools.
+
+        Inside a batch the project is instead published when the batch is committed.
         """
+        if self._batch is not None:
+            self._batch['publish'] = True
+            return
         data = {}
         json_data = json.dumps(data)
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}'
-        response = requests.post(f'{url}/publish', data=json_data, headers=self.headers)
+        response = self.session.post(f'{url}/publish', data=json_data)
         if response.status_code != 200:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
+        self._invalidate_query_cache()
         self.refresh_project()
 
     def export_project(self, filename):
@@ -269,11 +514,7 @@ class AtScale:
         :param str name: The new name of the cloned project.
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}'
-        response = requests.get(f'{url}/clone', headers=self.headers)
-        if response.status_code == 401:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.get(f'{url}/clone', headers=self.headers)
+        response = self.session.get(f'{url}/clone')
         if response.status_code == 200:
             copy_json = json.loads(response.content)['response']
             copy_json['name'] = name
@@ -303,7 +544,7 @@ class AtScale:
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}/snapshots'
         tag = {'tag': name}
-        response = requests.post(url, data=json.dumps(tag), headers=self.headers)
+        response = self.session.post(url, data=json.dumps(tag))
         if response.status_code != 200:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
@@ -316,7 +557,7 @@ class AtScale:
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}' \
               f'/project/{self.project_id}/snapshots/{snapshot_id}'
-        response = requests.delete(url, headers=self.headers)
+        response = self.session.delete(url)
         if response.status_code != 200:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
@@ -327,7 +568,7 @@ class AtScale:
         :param str snapshot_id: The ID of the snapshot to be restored from.
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}/snapshots/{snapshot_id}/restore'
-        response = requests.get(url, headers=self.headers)  # in API documentation, says to use put, but doesn't work
+        response = self.session.get(url)  # in API documentation, says to use put, but doesn't work
         if response.status_code != 200:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
@@ -341,7 +582,7 @@ class AtScale:
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project/{self.project_id}/snapshots'
 
-        response = json.loads(requests.get(url, headers=self.headers).text)['response']
+        response = json.loads(self.session.get(url).text)['response']
         response.reverse()
 
         if name:
@@ -369,7 +610,7 @@ class AtScale:
         :rtype: str
         """
         url = f'{self.server}:{self.design_center_server_port}/api/1.0/org/{self.organization}/project'
-        response = requests.post(url, data=json.dumps(json_data), headers=self.headers)
+        response = self.session.post(url, data=json.dumps(json_data))
         if response.status_code != 200:
             resp = json.loads(response.text)
             raise Exception(resp['response']['error'])
@@ -384,7 +625,7 @@ class AtScale:
         :return: A list of all available categorical features and denormalized categorical features.
         :rtype: list of str
         """
-        return [name for (name, info) in self._dimension_dict.items() if info['visible'] and (folder == '' or info['folder'] == folder)]
+        return self._catalog.list('categorical', folder)
 
     def _list_aggregate_features(self, folder=''):
         """ Gets all available aggregate features.
@@ -393,7 +634,7 @@ class AtScale:
         :return: A list of all available aggregate features.
         :rtype: list of str
         """
-        return [name for (name, info) in self._measure_dict.items() if info['visible'] and info['type'] == 'Aggregate' and (folder == '' or info['folder'] == folder)]
+        return self._catalog.list('Aggregate', folder)
 
     def _list_calculated_features(self, folder=''):
         """ Gets all available calculated features.
@@ -402,7 +643,7 @@ class AtScale:
         :return: A list of all available calculated features.
         :rtype: list of str
         """
-        return [name for (name, info) in self._measure_dict.items() if info['visible'] and info['type'] == 'Calculated' and (folder == '' or info['folder'] == folder)]
+        return self._catalog.list('Calculated', folder)
 
     def list_all_numeric_features(self, folder=''):
         """ Gets all available aggregate and calculated features.
@@ -411,7 +652,7 @@ class AtScale:
         :return: A list of all available aggregate features and calculated features.
         :rtype: list of str
         """
-        return [name for (name, info) in self._measure_dict.items() if info['visible'] and (folder == '' or info['folder'] == folder)]
+        return self._catalog.list('numeric', folder)
 
     def list_all_features(self, folder=''):
         """ Gets all available features.
@@ -453,7 +694,7 @@ class AtScale:
         :return: A list of hierarchies.
         :rtype: list of str
         """
-        return [name for (name, info) in self._hierarchy_dict.items() if info['visible'] and (folder == '' or info['folder'] == folder)]
+        return self._catalog.list('hierarchy', folder)
 
     def list_hierarchy_levels(self, hierarchy_name):
         """ Lists the levels of a given hierarchy from lowest to highest
@@ -464,8 +705,7 @@ class AtScale:
         """        
 
         if hierarchy_name in self._hierarchy_dict:
-            lst = [name for (level_number, name, time_step) in sorted(self._hierarchy_dict[hierarchy_name]['levels'])]
-            return lst
+            return list(self._catalog.hierarchy_levels[hierarchy_name])
         else:
             raise UserError(f'Hierarchy: \'{hierarchy_name}\' not in model.'
                             f' Make sure the model has been published and it is correctly spelled')
@@ -530,19 +770,14 @@ class AtScale:
         :return: A list of folders
         :rtype: list of str
         """
-        hierarchy_folders  = [info['folder'] for (name, info) in self._hierarchy_dict.items()]
-        measure_folders  = [info['folder'] for (name, info) in self._measure_dict.items()]
-        dimension_folders  = [info['folder'] for (name, info) in self._dimension_dict.items()]
-        folders = list(set(hierarchy_folders + measure_folders + dimension_folders))
-        if '' in folders:
-            folders.remove('')
-        return folders
+        return list(self._catalog.folders)
 
     # Querying and Describing
 
     def get_data(self, features, filter_equals=None, filter_greater=None, filter_less=None, filter_greater_or_equal=None, filter_less_or_equal=None, 
                  filter_not_equal=None, filter_in=None, filter_between=None, filter_like=None, filter_rlike=None, filter_null=None, filter_not_null=None,
-                 limit=None, comment=None, useAggs=True, genAggs=False, fakeResults=False, dryRun=False, useLocalCache=True, useAggregateCache=True, timeout=2):
+                 limit=None, comment=None, useAggs=True, genAggs=False, fakeResults=False, dryRun=False, useLocalCache=True, useAggregateCache=True, timeout=2,
+                 output='pandas', filters=None):
         """ Submits a query using the supplied information and returns the results in a pandas DataFrame.
 
         :param list of str features: The list of features to query.
@@ -567,60 +802,154 @@ class AtScale:
         :param bool useLocalCache: Whether to allow the query to use the local cache. Defaults to True.
         :param bool useAggregateCache: Whether to allow the query to use the aggregate cache. Defaults to True.
         :param int timeout: The number of minutes to wait for a response before timing out. Defaults to 2.
+        :param str output: 'pandas' for a DataFrame or 'arrow' for a pyarrow Table, which is built from the response
+        without going through pandas and is not cached by the query cache. Defaults to 'pandas'.
+        :param Filter filters: A filter expression built from query.And, query.Or, query.Not and the comparisons in
+        query, for conditions the filter arguments cannot express. It is ANDed with the filter_* arguments. Defaults to
+        None.
         :return: A pandas DataFrame containing the query results.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        query, categorical_features = self._build_get_data_query(features, filter_equals, filter_greater, filter_less,
+                                                                 filter_greater_or_equal, filter_less_or_equal,
+                                                                 filter_not_equal, filter_in, filter_between,
+                                                                 filter_like, filter_rlike, filter_null,
+                                                                 filter_not_null, limit, comment, filters)
+        return self._run_get_data_query(query, categorical_features, useAggs, genAggs, fakeResults, dryRun,
+                                        useLocalCache, useAggregateCache, timeout, output)
+
+    def _run_get_data_query(self, query, categorical_features, useAggs=True, genAggs=False, fakeResults=False,
+                            dryRun=False, useLocalCache=True, useAggregateCache=True, timeout=2, output='pandas'):
+        """ Submits a query built for get_data, using the query cache and sorting the results.
+
+        See get_data for a description of the parameters.
+
+        :param str query: The query to submit.
+        :param list of str categorical_features: The categorical features queried, which the results are sorted by.
+        :return: A pandas DataFrame containing the query results.
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        if is_arrow_output(output):
+            table = self.custom_query(query, 'SQL', useAggs, genAggs, fakeResults, dryRun, useLocalCache,
+                                      useAggregateCache, timeout, output)
+            return sort_arrow_table(table, categorical_features)
+
+        cache_key = None
+        if self.query_cache is not None and not fakeResults and not dryRun:
+            cache_key = self._query_cache_key(query, useAggs, genAggs)
+            df = self.query_cache.get(cache_key, self._query_cache_namespace())
+            if df is not None:
+                return df
+
+        df = self.custom_query(query, 'SQL', useAggs, genAggs, fakeResults, dryRun, useLocalCache, useAggregateCache, timeout)
+        if categorical_features:
+            df.sort_values(categorical_features, inplace=True)
+        if cache_key is not None:
+            self.query_cache.put(cache_key, df, self._query_cache_namespace())
+        return df
+
+    # Result caching
+
+    def enable_query_cache(self, max_entries=128, max_bytes=None, ttl=None, cache_dir=None, max_disk_bytes=None):
+        """ Caches the results of get_data so identical queries against the published project are only run once.
+
+        Cached results are dropped whenever this object updates or publishes the project. Changes published by
+        anyone else are only picked up once results expire, so set a ttl if the project is shared.
+
+        :param int max_entries: The maximum number of results kept in memory. Defaults to 128.
+        :param int max_bytes: The maximum estimated size in bytes of the results kept in memory. Defaults to None for
+        no limit.
+        :param float ttl: The number of seconds a result stays valid. Defaults to None to keep results until they are
+        evicted or the project changes.
+        :param str cache_dir: A directory to also write results to as Parquet files. Defaults to None to only cache in
+        memory.
+        :param int max_disk_bytes: The maximum total size in bytes of the files in cache_dir. Defaults to None for no
+        limit.
+        """
+        self.query_cache = QueryCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, cache_dir=cache_dir,
+                                      max_disk_bytes=max_disk_bytes)
+
+    def disable_query_cache(self):
+        """ Stops caching the results of get_data and drops the results cached in memory.
+        """
+        self.query_cache = None
+
+    def clear_query_cache(self):
+        """ Drops every cached result of get_data, in memory and on disk.
+        """
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def _query_cache_namespace(self):
+        """ Returns the namespace cached results for this project are stored under.
+
+        :rtype: str
+        """
+        return f'{self.server}/{self.organization}/{self.project_id}'
+
+    def _query_cache_key(self, query, useAggs, genAggs):
+        """ Builds the key a query result is cached under, results of an older published version of the project
+        are never hit.
+
+        :param str query: The query submitted.
+        :param bool useAggs: Whether the query may use aggs.
+        :param bool genAggs: Whether the query may generate aggs.
+        :rtype: str
+        """
+        return QueryCache.make_key(self.server, self.organization, self.project_id, self.project_name, self.model_id,
+                                   self._published_version, query, bool(useAggs), bool(genAggs))
+
+    def _invalidate_query_cache(self):
+        """ Drops the cached results for this project after it changes.
         """
-        if filter_equals is None:
-            filter_equals = {}
-        if filter_greater is None:
-            filter_greater = {}
-        if filter_less is None:
-            filter_less = {}
-        if filter_greater_or_equal is None:
-            filter_greater_or_equal = {}
-        if filter_less_or_equal is None:
-            filter_less_or_equal = {}
-        if filter_not_equal is None:
-            filter_not_equal = {}
-        if filter_in is None:
-            filter_in = {}
-        if filter_between is None:
-            filter_between = {}
-        if filter_like is None:
-            filter_like = {}
-        if filter_rlike is None:
-            filter_rlike = {}
-        if filter_null is None:
-            filter_null = []
-        if filter_not_null is None:
-            filter_not_null = []
-        if type(filter_null) != list:
-            filter_null = [filter_null]
-        if type(filter_not_null) != list:
-            filter_not_null = [filter_not_null]
+        if self.query_cache is not None:
+            self.query_cache.invalidate(self._query_cache_namespace())
+
+    def _build_get_data_query(self, features, filter_equals=None, filter_greater=None, filter_less=None,
+                              filter_greater_or_equal=None, filter_less_or_equal=None, filter_not_equal=None,
+                              filter_in=None, filter_between=None, filter_like=None, filter_rlike=None,
+                              filter_null=None, filter_not_null=None, limit=None, comment=None, filters=None):
+        """ Validates the arguments of get_data and builds the query it submits.
+
+        See get_data for a description of the parameters.
 
+        :return: The query string and the categorical features in the query.
+        :rtype: tuple of (str, list of str)
+        """
         if type(features) != list:
             features = [features]
-
-        list_all = self.list_all_features()
+        parts, atscale_parts, categorical_features = self._compile_query(
+            features, filter_equals, filter_greater, filter_less, filter_greater_or_equal, filter_less_or_equal,
+            filter_not_equal, filter_in, filter_between, filter_like, filter_rlike, filter_null, filter_not_null,
+            limit, comment, filters)
+        return render_parts(parts), categorical_features
+
+    def _compile_query(self, features, filter_equals=None, filter_greater=None, filter_less=None,
+                       filter_greater_or_equal=None, filter_less_or_equal=None, filter_not_equal=None, filter_in=None,
+                       filter_between=None, filter_like=None, filter_rlike=None, filter_null=None,
+                       filter_not_null=None, limit=None, comment=None, filters=None):
+        """ Validates the features and filters of a query and compiles it for get_data and generate_atscale_query.
+
+        Filter values may be a Param to leave them to be bound when the query is rendered, see query.render_parts.
+        See get_data for a description of the parameters.
+
+        :return: The compiled query submitted by get_data, the compiled query of generate_atscale_query and the
+        categorical features in the query.
+        :rtype: tuple of (list, list, list of str)
+        """
+        expression = filters_from_arguments(filter_equals, filter_greater, filter_less, filter_greater_or_equal,
+                                            filter_less_or_equal, filter_not_equal, filter_in, filter_between,
+                                            filter_like, filter_rlike, filter_null, filter_not_null, filters)
+
+        list_all = self._catalog.all_features
         self._check_multiple_features(features, list_all)
-        self._check_multiple_features(filter_equals, list_all)
-        self._check_multiple_features(filter_greater, list_all)
-        self._check_multiple_features(filter_less, list_all)
-        self._check_multiple_features(filter_greater_or_equal, list_all)
-        self._check_multiple_features(filter_less_or_equal, list_all)
-        self._check_multiple_features(filter_not_equal, list_all)
-        self._check_multiple_features(filter_in, list_all)
-        self._check_multiple_features(filter_between, list_all)
-        self._check_multiple_features(filter_like, list_all)
-        self._check_multiple_features(filter_rlike, list_all)
-        self._check_multiple_features(filter_null, list_all)
-        self._check_multiple_features(filter_not_null, list_all)
-        
+        if expression is not None:
+            self._check_multiple_features(expression.features(), list_all)
+
         categorical_features = []
         numeric_features = []
 
-        all_categorical_features = self.list_all_categorical_features()
+        all_categorical_features = self._catalog.categorical_features
         for feature in features:
             if feature in all_categorical_features:
                 categorical_features.append(feature)
@@ -628,103 +957,18 @@ class AtScale:
                 numeric_features.append(feature)
 
         if categorical_features:
-            categorical_columns_string = ' ' + ', '.join(f'`{self.model_name}`.`{x}`' for x in categorical_features)
+            categorical_columns_string = ' ' + ', '.join(render_column(self.model_name, x) for x in categorical_features)
             if numeric_features:
                 categorical_columns_string += ','
         else:
             categorical_columns_string = ''
         if numeric_features:
-            numeric_columns_string = ' ' + ', '.join(f'`{self.model_name}`.`{x}`' for x in numeric_features)
+            numeric_columns_string = ' ' + ', '.join(render_column(self.model_name, x) for x in numeric_features)
         else:
             numeric_columns_string = ''
-        
-        if filter_equals or filter_greater or filter_less or filter_greater_or_equal or filter_less_or_equal or filter_not_equal \
-                or filter_in or filter_between or filter_null or filter_not_null or filter_like or filter_rlike:
-            filter_string = ' WHERE ('
-            for key, value in filter_equals.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` = \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` = {value})'
-            for key, value in filter_greater.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` > \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` > {value})'
-            for key, value in filter_less.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` < \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` < {value})'
-            for key, value in filter_greater_or_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` >= \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` >= {value})'
-            for key, value in filter_less_or_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` <= \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` <= {value})'
-            for key, value in filter_not_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` <> \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` <> {value})'
-            for key, value in filter_like.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` LIKE \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` LIKE {value})'
-            for key, value in filter_rlike.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` RLIKE \'{value}\')'
-            for key, value in filter_in.items():
-                str_values = [str(x) for x in value]
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value[0], (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` IN (\''
-                    filter_string += '\', \''.join(str_values)
-                    filter_string += '\'))'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` IN ('
-                    filter_string += ', '.join(str_values)
-                    filter_string += '))'
-            for key, value in filter_between.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value[0], (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` BETWEEN \'{value[0]}\' and \'{value[1]}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` BETWEEN {value[0]} and {value[1]})'
-            for key in filter_null:
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` IS NULL)'
-            for key in filter_not_null:
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` IS NOT NULL)'
-            filter_string += ') GROUP BY 1'
-        else:
-            filter_string = ''
-                
+
+        filter_parts = compile_where(self.model_name, expression)
+
         if limit is None:
             limit_string = ''
         else:
@@ -734,17 +978,41 @@ class AtScale:
             comment_string = ''
         else:
             comment_string = f' /* {comment} */'
-        
+
         version_comment = f' /* Python library version: {self.__version__} */'
 
-        query = f'SELECT{categorical_columns_string}{numeric_columns_string}' \
-                f' FROM `{self.project_name}`.`{self.model_name}` `{self.model_name}`' \
-                f'{filter_string}{limit_string}{comment_string}{version_comment}'
+        from_string = f' FROM `{self.project_name}`.`{self.model_name}` `{self.model_name}`'
+        parts = [f'SELECT{categorical_columns_string}{numeric_columns_string}{from_string}'] + filter_parts \
+            + [f'{limit_string}{comment_string}{version_comment}']
+        atscale_parts = [f'SELECT {categorical_columns_string}{numeric_columns_string}{from_string}'] + filter_parts \
+            + [f'{limit_string}{comment_string}']
+        return parts, atscale_parts, categorical_features
 
-        df = self.custom_query(query, 'SQL', useAggs, genAggs, fakeResults, dryRun, useLocalCache, useAggregateCache, timeout)
-        if categorical_features:
-            df.sort_values(categorical_features, inplace=True)
-        return df
+    def prepare_query(self, features, filter_equals=None, filter_greater=None, filter_less=None,
+                      filter_greater_or_equal=None, filter_less_or_equal=None, filter_not_equal=None, filter_in=None,
+                      filter_between=None, filter_like=None, filter_rlike=None, filter_null=None,
+                      filter_not_null=None, limit=None, comment=None, filters=None):
+        """ Validates and compiles a get_data query once so it can be run many times with new filter values.
+
+        Takes the same features and filters as get_data. Any filter value, such as the value of a feature in
+        filter_equals, the whole list of a feature in filter_in or the value of a comparison in filters, can be a Param
+        which is given a value by name each time the query is run:
+
+            query = atscale.prepare_query(['Sales'], filter_equals={'State': Param('state')})
+            df = query.get_data({'state': 'CA'})
+
+        The query is compiled against the model as it is now, prepare it again after the project changes.
+
+        :return: The prepared query.
+        :rtype: PreparedQuery
+        """
+        if type(features) != list:
+            features = [features]
+        parts, atscale_parts, categorical_features = self._compile_query(
+            features, filter_equals, filter_greater, filter_less, filter_greater_or_equal, filter_less_or_equal,
+            filter_not_equal, filter_in, filter_between, filter_like, filter_rlike, filter_null, filter_not_null,
+            limit, comment, filters)
+        return PreparedQuery(self, features, parts, atscale_parts, categorical_features)
 
     def describe(self, categorical_features, numeric_features):
         """ Gets a description of all measures for the cube.
@@ -754,8 +1022,8 @@ class AtScale:
         :return: A pandas DataFrame with the description of all the categorical features in the cube over the given numeric features.
         :rtype: pandas.DataFrame
         """
-        all_categorical_features = self.list_all_categorical_features()
-        all_numeric_features = self.list_all_numeric_features()
+        all_categorical_features = self._catalog.categorical_features
+        all_numeric_features = self._catalog.numeric_features
 
         self._check_multiple_features(categorical_features, all_categorical_features,
                                       errmsg='Make sure all items in categorical_features are '
@@ -769,31 +1037,37 @@ class AtScale:
         df.dropna(how='all', axis='columns', inplace=True)
         return df.describe(include='all')
 
-    def _parse_query_response(self, response):
+    def _parse_query_response(self, content, output='pandas'):
         """ Parses a query response.
 
-        :param requests.Response response: The response used to formulate the dataframe that the function returns.
+        :param bytes or iterable of bytes content: The body of the response used to formulate the dataframe that the
+        function returns, or an iterator over chunks of the body as it is streamed from the server.
+        :param str output: 'pandas' for a DataFrame or 'arrow' for a pyarrow Table. Defaults to 'pandas'.
         :return: A pandas DataFrame.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        content = str(response.content)
-
-        if re.search('<succeeded>(.*?)</succeeded>', content).group(1) == 'false':
-            raise Exception(re.search('<error-message>(.*?)</error-message>', ' '.join(content.split('\n'))).group(1))
-        column_names = re.findall('<name>(.*?)</name>', content)
-        row_text = re.findall('<row>(.*?)</row>', content)
-        rows = []
-        for row in row_text:
-            row = row.replace('<column null="true"/>', '<column></column>')
-            cells = re.findall('<column>(.*?)</column>', row)
-            rows.append(cells)
-        df = pd.DataFrame(data=rows, columns=column_names)
-        for column in df.columns:
-            df[column] = pd.to_numeric(df[column].values, errors='ignore')
-        return df
+        parser = parse_query_response(content)
+        column_types = {name: self._get_column_type(name) for name in parser.column_names}
+        if output == 'arrow':
+            return parser.to_arrow(column_types)
+        return parser.to_dataframe(column_types)
+
+    def _get_column_type(self, name):
+        """ Gets how a result column for the given feature should be decoded.
+
+        :param str name: The name of the column.
+        :return: 'category' for categorical features, which are decoded as numbers when every value is numeric, the
+        data type of numeric features, or None if not known.
+        :rtype: str
+        """
+        if name in self._dimension_dict:
+            return 'category'
+        if name in self._measure_dict:
+            return self._measure_dict[name].get('data_type')
+        return None
 
     def custom_query(self, query, language='SQL', useAggs=True, genAggs=False, fakeResults=False, dryRun=False,
-                     useLocalCache=True, useAggregateCache=True, timeout=2):
+                     useLocalCache=True, useAggregateCache=True, timeout=2, output='pandas'):
         """ Submits the given query and returns the results in a pandas dataframe.
 
         :param str query: The query to submit.
@@ -805,8 +1079,30 @@ class AtScale:
         :param bool useLocalCache: Whether to allow the query to use the local cache. Defaults to True.
         :param bool useAggregateCache: Whether to allow the query to use the aggregate cache. Defaults to True.
         :param int timeout: The number of minutes to wait for a response before timing out. Defaults to 2.
+        :param str output: 'pandas' for a DataFrame or 'arrow' for a pyarrow Table. Defaults to 'pandas'.
         :return: A DataFrame containing the query results.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        is_arrow_output(output)
+        json_data = self._build_query_request(query, language, useAggs, genAggs, fakeResults, dryRun, useLocalCache,
+                                              useAggregateCache, timeout)
+        response = self.session.post(f'{self.server}:{self.engine_port}/query/orgId/{self.organization}/submit',
+                                     data=json_data, stream=True)
+        with response:
+            if response.status_code != 200:
+                resp = json.loads(response.text)
+                raise Exception(resp['response']['error'])
+            return self._parse_query_response(response.iter_content(chunk_size=self._QUERY_RESPONSE_CHUNK_SIZE),
+                                              output)
+
+    def _build_query_request(self, query, language='SQL', useAggs=True, genAggs=False, fakeResults=False,
+                             dryRun=False, useLocalCache=True, useAggregateCache=True, timeout=2):
+        """ Builds the JSON body used to submit a query to the engine.
+
+        See custom_query for a description of the parameters.
+
+        :return: The JSON body of the request.
+        :rtype: str
         """
         language = language.upper()
         valid_languages = ['SQL', 'MDX']
@@ -836,32 +1132,60 @@ class AtScale:
             'useAggregateCache': useAggregateCache,
             f'timeout': '{timeout}.minutes'
         }
-        json_data = json.dumps(data)
-        response = requests.post(f'{self.server}:{self.engine_port}/query/orgId/{self.organization}/submit',
-                                 data=json_data, headers=self.headers)
-        if response.status_code == 401 or response.status_code == 403:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.post(
-                f'{self.server}:{self.engine_port}/query/orgId/{self.organization}/submit', data=json_data,
-                headers=self.headers)
-        if response.status_code != 200:
-            resp = json.loads(response.text)
-            raise Exception(resp['response']['error'])
-        return self._parse_query_response(response)
+        return json.dumps(data)
 
     # Parsing project JSON
 
     def _parse_json(self):
         """ Loads _measure_dict, _dimension_dict and _hierarchy_dict.
+
+        The three DMV queries are submitted concurrently and the seconds spent on each, and on parsing the results,
+        are stored in refresh_timings.
+        """
+        queries = {
+            'levels': self._dimensions_dmv_query(),
+            'hierarchies': self._hierarchies_dmv_query(),
+            'measures': self._measures_dmv_query()
+        }
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = {leg: executor.submit(self._timed_dmv_query, query) for leg, query in queries.items()}
+            results = {leg: future.result() for leg, future in futures.items()}
+
+        timings = {leg: seconds for leg, (rows, seconds) in results.items()}
+        start = time.perf_counter()
+        self._load_metadata(results['levels'][0], results['hierarchies'][0], results['measures'][0])
+        timings['parse'] = time.perf_counter() - start
+        self.refresh_timings = timings
+        logging.debug(f'Project metadata loaded in seconds: {timings}')
+
+    def _timed_dmv_query(self, query_body):
+        """ Submits a DMV query and measures how long it takes.
+
+        :param str query_body: The XMLA request to submit.
+        :return: The rows of the response and the number of seconds the request took.
+        :rtype: tuple of (list of str, float)
         """
-        self._parse_dimensions()
+        start = time.perf_counter()
+        rows = self._submit_dmv_query(query_body)
+        return rows, time.perf_counter() - start
+
+    def _load_metadata(self, level_rows, hierarchy_rows, measure_rows):
+        """ Loads _measure_dict, _dimension_dict and _hierarchy_dict from the rows of the three DMV queries.
+
+        :param list of str level_rows: The rows of the levels DMV query.
+        :param list of str hierarchy_rows: The rows of the hierarchies DMV query.
+        :param list of str measure_rows: The rows of the measures DMV query.
+        """
+        self._parse_dimensions(level_rows)
         # hierarchies need to be parsed after dimensions so they can set dimension folders
-        self._parse_hierarchies()
-        self._parse_measures()
+        self._parse_hierarchies(hierarchy_rows)
+        self._parse_measures(measure_rows)
+        self._catalog = MetadataCatalog(self._dimension_dict, self._measure_dict, self._hierarchy_dict)
         
-    def _parse_dimensions(self):
-        level_rows = self._submit_dmv_query(f"""<?xml version="1.0" encoding="UTF-8"?>
+    def _dimensions_dmv_query(self):
+        """ Returns the XMLA request for the levels of the model.
+        """
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
         <Envelope xmlns="http://schemas.xmlsoap.org/soap/envelope/">
          <Body>
           <Execute xmlns="urn:schemas-microsoft-com:xml-analysis">
@@ -889,8 +1213,13 @@ class AtScale:
            </Parameters>
           </Execute>
          </Body>
-        </Envelope>""")
+        </Envelope>"""
+
+    def _parse_dimensions(self, level_rows):
+        """ Loads the levels from the rows of a DMV query response.
 
+        :param list of str level_rows: The rows returned by _submit_dmv_query.
+        """
         for level in level_rows:
             name = re.search('<LEVEL_NAME>(.*?)</LEVEL_NAME>', level)[1]
 
@@ -924,8 +1253,10 @@ class AtScale:
 
             self._dimension_dict[name] = this_dict
 
-    def _parse_measures(self):
-        measure_rows = self._submit_dmv_query(f"""<?xml version="1.0" encoding="UTF-8"?>
+    def _measures_dmv_query(self):
+        """ Returns the XMLA request for the measures of the model.
+        """
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
                 <Envelope xmlns="http://schemas.xmlsoap.org/soap/envelope/">
                    <Body>
                       <Execute xmlns="urn:schemas-microsoft-com:xml-analysis">
@@ -953,8 +1284,13 @@ class AtScale:
                          </Parameters>
                       </Execute>
                    </Body>
-                </Envelope>""")
+                </Envelope>"""
+
+    def _parse_measures(self, measure_rows):
+        """ Loads the measures from the rows of a DMV query response.
 
+        :param list of str measure_rows: The rows returned by _submit_dmv_query.
+        """
         for measure in measure_rows:
             name = re.search('<MEASURE_NAME>(.*?)</MEASURE_NAME>', measure)[1]
 
@@ -988,10 +1324,18 @@ class AtScale:
             else:
                 this_dict['type'] = 'Aggregate'
 
+            data_type = re.search('<DATA_TYPE>(.*?)</DATA_TYPE>', measure)
+            if data_type:
+                this_dict['data_type'] = self._data_type_dict.get(data_type[1])
+            else:
+                this_dict['data_type'] = None
+
             self._measure_dict[name] = this_dict
 
-    def _parse_hierarchies(self):
-        hierarchy_rows = self._submit_dmv_query(f"""<?xml version="1.0" encoding="UTF-8"?>
+    def _hierarchies_dmv_query(self):
+        """ Returns the XMLA request for the hierarchies of the model.
+        """
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
                     <Envelope xmlns="http://schemas.xmlsoap.org/soap/envelope/">
                        <Body>
                           <Execute xmlns="urn:schemas-microsoft-com:xml-analysis">
@@ -1034,7 +1378,17 @@ class AtScale:
                              </Parameters>
                           </Execute>
                        </Body>
-                    </Envelope>""")
+                    </Envelope>"""
+
+    def _parse_hierarchies(self, hierarchy_rows):
+        """ Loads the hierarchies from the rows of a DMV query response.
+
+        :param list of str hierarchy_rows: The rows returned by _submit_dmv_query.
+        """
+        levels_by_hierarchy = {}
+        for level in self._dimension_dict:
+            if self._dimension_dict[level]['visible']:
+                levels_by_hierarchy.setdefault(self._dimension_dict[level]['hierarchy'], []).append(level)
 
         for hierarchy in hierarchy_rows:
 
@@ -1081,11 +1435,10 @@ class AtScale:
                 this_dict['type'] = None
 
             levels = []
-            for level in self.list_all_categorical_features():
-                if self._dimension_dict[level]['hierarchy'] == name:
-                    levels.append((self._dimension_dict[level]['level_number'], level, self._dimension_dict[level]['level_type']))
-                    # push the folder to each level
-                    self._dimension_dict[level]['folder'] = hierarchy_folder
+            for level in levels_by_hierarchy.get(name, []):
+                levels.append((self._dimension_dict[level]['level_number'], level, self._dimension_dict[level]['level_type']))
+                # push the folder to each level
+                self._dimension_dict[level]['folder'] = hierarchy_folder
 
             this_dict['levels'] = levels
             
@@ -1097,10 +1450,18 @@ class AtScale:
         """
 
         url = f'{self.server}:{self.engine_port}/xmla/{self.organization}'
-        headers = {'Content-type': 'application/xml', 'Authorization': f'Bearer {self.token}'}
-        response = requests.post(url, data=query_body, headers=headers)
+        response = self.session.post(url, data=query_body, headers={'Content-type': 'application/xml'})
 
-        xml_text = str(response.content)
+        return self._parse_dmv_response(response.content)
+
+    def _parse_dmv_response(self, content):
+        """ Splits the body of a DMV query response into rows.
+
+        :param bytes content: The body of the response.
+        :return: The text of each row.
+        :rtype: list of str
+        """
+        xml_text = str(content)
 
         rows = re.findall('<row>(.*?)</row>', xml_text)
 
@@ -1195,7 +1556,7 @@ class AtScale:
         """
         data = {}
         url = f'{self.server}:{self.engine_port}/connection-groups/orgId/{self.organization}'
-        response = requests.get(url, data=json.dumps(data), headers=self.headers)
+        response = self.session.get(url, data=json.dumps(data))
 
         check_list = [x['connectionId'] for x in json.loads(response.content)['response']['results']['values']]
 
@@ -1248,8 +1609,7 @@ class AtScale:
         data = {'dbschema': schema,
         'expression': expression,
         'database': database}
-        headers = {'Content-type': 'application/x-www-form-urlencoded', 'Authorization': 'Bearer ' + self.token}
-        response = requests.post(url, data=data, headers=headers)
+        response = self.session.post(url, data=data, headers={'Content-type': 'application/x-www-form-urlencoded'})
 
         if response.status_code != 200:
             resp = json.loads(response.text)
@@ -1395,7 +1755,7 @@ class AtScale:
         :param str format_string: The format string for the feature. Defaults to 'General Number'.
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
-        if name in self.list_all_features():
+        if name in self._catalog.all_features:
             raise Exception(f'Invalid name: \'{name}\'. A feature already exists with that name')
             
         self._check_single_column(dataset_name, column)
@@ -1452,7 +1812,7 @@ class AtScale:
 
         self.refresh_project()
         
-        if name not in self._list_aggregate_features():
+        if name not in self._catalog.aggregate_features:
             raise Exception(f'Feature: {name} does not exist.')
 
         project_json = self.project_json
@@ -1488,7 +1848,7 @@ class AtScale:
         """
         self.refresh_project()
         
-        if name in self.list_all_features():
+        if name in self._catalog.all_features:
             raise Exception(f'Invalid name: \'{name}\'. A feature already exists with that name')
             
         valid_formatting_strings = ['None', 'General Number', 'Standard', 'Scientific', 'Fixed', 'Percent']
@@ -1539,7 +1899,7 @@ class AtScale:
         """
         self.refresh_project()
         
-        if name not in self._list_calculated_features():
+        if name not in self._catalog.calculated_features:
             raise Exception(f'Feature: {name} does not exist.')
         
         project_json = self.project_json
@@ -1838,7 +2198,7 @@ class AtScale:
         :param str format_string: The format string for the feature. Defaults to 'General Number'.
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
-        self._check_single_element(numeric_feature, self.list_all_numeric_features(),
+        self._check_single_element(numeric_feature, self._catalog.numeric_features,
                                    f'Make sure \'{numeric_feature}\' is a numeric feature')
 
         if not (type(length) == int) or length < 0:
@@ -1960,7 +2320,7 @@ class AtScale:
         :param str format_string: The format string for the feature. Defaults to 'General Number'.
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
-        self._check_single_element(numeric_feature, self.list_all_numeric_features(),
+        self._check_single_element(numeric_feature, self._catalog.numeric_features,
                                    f'Make sure \'{numeric_feature}\' is a numeric feature')
 
         if not (type(length) == int) or length <= 0:
@@ -1997,7 +2357,7 @@ class AtScale:
         if type(numeric_features) != list:
             numeric_features = [numeric_features]
 
-        self._check_multiple_features(numeric_features, self.list_all_numeric_features(),
+        self._check_multiple_features(numeric_features, self._catalog.numeric_features,
                                       errmsg='Make sure all items in numeric_features are'
                                              'numeric features')
 
@@ -2011,30 +2371,29 @@ class AtScale:
             intervals = self._time_steps[time_numeric]
 
         name_list = []
-        for feature in numeric_features:
-            for interval in intervals:
-                interval = int(interval)
-                name = feature + f'_{interval}_{time_name}_'
-                if interval > 1:
-                    self.create_rolling_min(f'{name}min', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                    name_list.append(f'{name}min')
-
-                    self.create_rolling_max(f'{name}max', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                    name_list.append(f'{name}max')
-
-                    self.create_rolling_mean(f'{name}avg', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                    name_list.append(f'{name}avg')
-
-                    self.create_rolling_sum(f'{name}sum', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                    name_list.append(f'{name}sum')
-
-                    self.create_rolling_stdev(f'{name}stddev', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                    name_list.append(f'{name}stddev')
-
-                self.create_lag(f'{name}lag', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
-                name_list.append(f'{name}lag')
-        if publish:
-            self._update_project(self.project_json, publish=True)
+        with self.batch(publish=publish):
+            for feature in numeric_features:
+                for interval in intervals:
+                    interval = int(interval)
+                    name = feature + f'_{interval}_{time_name}_'
+                    if interval > 1:
+                        self.create_rolling_min(f'{name}min', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                        name_list.append(f'{name}min')
+
+                        self.create_rolling_max(f'{name}max', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                        name_list.append(f'{name}max')
+
+                        self.create_rolling_mean(f'{name}avg', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                        name_list.append(f'{name}avg')
+
+                        self.create_rolling_sum(f'{name}sum', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                        name_list.append(f'{name}sum')
+
+                        self.create_rolling_stdev(f'{name}stddev', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                        name_list.append(f'{name}stddev')
+
+                    self.create_lag(f'{name}lag', feature, interval, time_hierarchy, level, description, caption, folder, format_string, False)
+                    name_list.append(f'{name}lag')
         return name_list
     
     def create_diff(self, name, numeric_feature, length, time_hierarchy, level, description='', caption='', folder='',
@@ -2053,7 +2412,7 @@ class AtScale:
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
 
-        self._check_single_element(numeric_feature, self.list_all_numeric_features(),
+        self._check_single_element(numeric_feature, self._catalog.numeric_features,
                                    f'Make sure Argument: \'{numeric_feature}\' is a numeric feature')
                                    
         if not (type(length) == int) or length < 0:
@@ -2087,7 +2446,7 @@ class AtScale:
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
 
-        self._check_single_element(numeric_feature, self.list_all_numeric_features(),
+        self._check_single_element(numeric_feature, self._catalog.numeric_features,
                                    f'Make sure Argument: \'{numeric_feature}\' is a numeric feature')
                                    
         if not (type(length) == int) or length < 0:
@@ -2144,13 +2503,13 @@ class AtScale:
         self._check_time_hierarchy(time_hierarchy)
 
         base = self.list_hierarchy_levels(time_hierarchy)[-1]
-        for level in self.list_hierarchy_levels(time_hierarchy):
-            if level != base:
-                name = f'{numeric_feature}_{level.capitalize()}_To_{base.capitalize()}'
-                self.create_period_to_date(name, numeric_feature, time_hierarchy, level, description=description,
-                                           caption=caption, folder=folder, format_string=format_string, publish=False)
-        if publish:
-            self._update_project(self.project_json, publish=True)
+        with self.batch(publish=publish):
+            for level in self.list_hierarchy_levels(time_hierarchy):
+                if level != base:
+                    name = f'{numeric_feature}_{level.capitalize()}_To_{base.capitalize()}'
+                    self.create_period_to_date(name, numeric_feature, time_hierarchy, level, description=description,
+                                               caption=caption, folder=folder, format_string=format_string,
+                                               publish=False)
                                            
     def create_percentage(self, numeric_feature, hierarchy, description='', caption='',
                           folder='', format_string='General Number', publish=True):
@@ -2164,7 +2523,7 @@ class AtScale:
         :param str format_string: The format string for the feature. Defaults to 'General Number'.
         :param bool publish: Whether or not the updated project should be published. Defaults to True.
         """
-        if hierarchy not in self.list_all_hierarchies():
+        if hierarchy not in self._catalog.hierarchies:
             raise UserError(f'Hierarchy: \'{hierarchy}\' not in model.'
                             f' Make sure the model has been published and it is correctly spelled')
 
@@ -2172,25 +2531,25 @@ class AtScale:
 
         name_list = self.list_hierarchy_levels(hierarchy)
 
-        self._check_single_element(numeric_feature, self.list_all_numeric_features(),
+        self._check_single_element(numeric_feature, self._catalog.numeric_features,
                                    f'Make sure Argument: \'{numeric_feature}\' is a numeric feature')
 
-        for lower in range(len(name_list)):
-            for higher in range(len(name_list)):
-                if higher > lower:
-                    diff = higher - lower
-                    current = 'CurrentMember'
-                    for _ in range(diff):
-                        current += '.Parent'
-                    name_diff = f'{name_list[lower]}%{name_list[higher]}'
-
-                    expression = f'IIF( ([Measures].[{numeric_feature}], [{dimension_name}].[{hierarchy}].{current})' \
-                                 f' = 0, NULL, [Measures].[{numeric_feature}] / ([Measures].[{numeric_feature}]' \
-                                 f', [{dimension_name}].[{hierarchy}].{current}) )'
-                    self.create_calculated_feature(name_diff, expression, description=description, caption=caption,
-                                                   folder=folder, format_string=format_string, publish=False)
-        if publish:
-            self._update_project(self.project_json, publish=True)
+        with self.batch(publish=publish):
+            for lower in range(len(name_list)):
+                for higher in range(len(name_list)):
+                    if higher > lower:
+                        diff = higher - lower
+                        current = 'CurrentMember'
+                        for _ in range(diff):
+                            current += '.Parent'
+                        name_diff = f'{name_list[lower]}%{name_list[higher]}'
+
+                        expression = f'IIF( ([Measures].[{numeric_feature}], [{dimension_name}].[{hierarchy}].{current})' \
+                                     f' = 0, NULL, [Measures].[{numeric_feature}] / ([Measures].[{numeric_feature}]' \
+                                     f', [{dimension_name}].[{hierarchy}].{current}) )'
+                        self.create_calculated_feature(name_diff, expression, description=description,
+                                                       caption=caption, folder=folder, format_string=format_string,
+                                                       publish=False)
             
     def create_minmax_scaled_feature(self, numeric_feature, name, min, max, feature_min=0, feature_max=1, description='', caption='', folder='',
                                  format_string='General Number', publish=True):
@@ -2358,29 +2717,24 @@ class AtScale:
         
         self.create_calculated_feature(name, expression, description=description, caption=caption, folder=folder, format_string=format_string, publish=publish)
 
-    def generate_time_series_features(self, dataframe, numeric_features, time_hierarchy, level,  group_features=None, intervals=None, shift_amount=0):
-        """ Adds calculated measures to a pandas.DataFrame.
+    def _time_series_arguments(self, columns, numeric_features, time_hierarchy, level, group_features, intervals):
+        """ Checks the arguments of generate_time_series_features against the model.
 
-        :param pandas.DataFrame dataframe: The DataFrame to be changed.
-        :param str lst numeric_features: The numeric features to use for the calculation.
-        :param str time_hierarchy: The hierarchy that the level belongs to.
-        :param str level: The level within the time hierarchy.
-        :param str lst group_features: The features to be grouped by. Defaults to None.
-        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
-        :param int shift_amount: Allows the user to specify the lag used to generate the calculated measures. Defaults to 0.
-        :return: The changed pandas.DataFrame.
-        :rtype: pandas.DataFrame
+        :param list of str columns: The columns of the DataFrame.
+        :return: The numeric features, group features, levels of the hierarchy in the columns, name of the time step
+        of the level and intervals.
+        :rtype: tuple
         """
         self._check_time_hierarchy(time_hierarchy, level=level)
 
         if group_features:
             if type(group_features) != list:
                 group_features = [group_features]
-            self._check_multiple_features(group_features, self.list_all_features())
+            self._check_multiple_features(group_features, self._catalog.all_features)
 
         if type(numeric_features) != list:
             numeric_features = [numeric_features]
-        self._check_multiple_features(numeric_features, self.list_all_numeric_features(),
+        self._check_multiple_features(numeric_features, self._catalog.numeric_features,
                                       errmsg='Make sure all items in numeric_features are numeric features')
 
         time_numeric = self._get_hierarchy_level_time_step(time_hierarchy, level)
@@ -2392,56 +2746,230 @@ class AtScale:
         else:
             intervals = self._time_steps[time_numeric]
 
-        levels = [x for x in self.list_hierarchy_levels(time_hierarchy) if x in dataframe.columns]
+        levels = [x for x in self.list_hierarchy_levels(time_hierarchy) if x in columns]
+        return numeric_features, group_features, levels, time_name, [int(interval) for interval in intervals]
+
+    def generate_time_series_features(self, dataframe, numeric_features, time_hierarchy, level,  group_features=None, intervals=None, shift_amount=0,
+                                      n_jobs=None, executor=None, return_state=False, partitions=None):
+        """ Adds calculated measures to a pandas.DataFrame.
+
+        :param pandas.DataFrame dataframe: The DataFrame to be changed.
+        :param str lst numeric_features: The numeric features to use for the calculation.
+        :param str time_hierarchy: The hierarchy that the level belongs to.
+        :param str level: The level within the time hierarchy.
+        :param str lst group_features: The features to be grouped by. Defaults to None.
+        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
+        :param int shift_amount: Allows the user to specify the lag used to generate the calculated measures. Defaults to 0.
+        :param int n_jobs: The number of processes to compute the features in when there are group_features, each
+        computing whole groups. -1 uses one per CPU. Defaults to None to compute them in this process.
+        :param concurrent.futures.Executor executor: An executor to compute the groups in instead of starting n_jobs
+        processes, such as an existing ProcessPoolExecutor. Defaults to None.
+        :param bool return_state: Whether to also return the state update_time_series_features needs to add rows to
+        the changed DataFrame later. Defaults to False.
+        :param int partitions: The number of ranges of groups split between the processes. Defaults to None for four
+        per process, counting os.cpu_count() processes when an executor is given without n_jobs.
+        :return: The changed pandas.DataFrame, and its state if return_state is True.
+        :rtype: pandas.DataFrame or tuple of (pandas.DataFrame, TimeSeriesState)
+        """
+        numeric_features, group_features, levels, time_name, intervals = self._time_series_arguments(
+            dataframe.columns, numeric_features, time_hierarchy, level, group_features, intervals)
 
         if group_features:
             dataframe = dataframe.sort_values(by=group_features + levels).reset_index(drop=True)
         else:
             dataframe = dataframe.sort_values(by=levels).reset_index(drop=True)
-            
-        for feature in numeric_features:
-            for interval in intervals:
-                interval = int(interval)
-                name = feature + f'_{interval}_{time_name}_'
-                if group_features:
-                    if interval > 1:
-                        dataframe[f'{name}sum'] = dataframe.groupby(group_features)[feature].rolling(interval).sum().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}avg'] = dataframe.groupby(group_features)[feature].rolling(interval).mean().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}stddev'] = dataframe.groupby(group_features)[feature].rolling(interval).std().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}min'] = dataframe.groupby(group_features)[feature].rolling(interval).min().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}max'] = dataframe.groupby(group_features)[feature].rolling(interval).max().shift(shift_amount).reset_index(drop=True)
 
-                    dataframe[f'{name}lag'] = dataframe.groupby(group_features)[feature].shift(interval).reset_index(drop=True)
-                else:
-                    if interval > 1:
-                        dataframe[f'{name}sum'] = dataframe[feature].rolling(interval).sum().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}avg'] = dataframe[feature].rolling(interval).mean().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}stddev'] = dataframe[feature].rolling(interval).std().shift(shift_amount).reset_index(drop=True)
-
-                        dataframe[f'{name}min'] = dataframe[feature].rolling(interval).min().shift(shift_amount).reset_index(drop=True)
+        edges = {} if return_state else None
+        columns = time_series_features(dataframe, numeric_features, levels, level, time_name, intervals,
+                                       group_features, shift_amount, n_jobs=n_jobs, executor=executor, edges=edges,
+                                       partitions=partitions)
+        if not return_state:
+            return add_columns(dataframe, columns)
+        state = window_state(dataframe, numeric_features, levels, level, time_name, intervals, group_features,
+                             shift_amount, edges)
+        return add_columns(dataframe, columns), state
+
+    def update_time_series_features(self, dataframe, new_rows, state):
+        """ Adds rows to a DataFrame returned by generate_time_series_features, such as the next day of a daily panel,
+        computing the calculated measures of only the new rows. The result is identical to running
+        generate_time_series_features on every row again. Only the new rows and the groups are sorted, but every row is
+        still copied into the returned DataFrame.
+
+        :param pandas.DataFrame dataframe: The DataFrame returned along with the state.
+        :param pandas.DataFrame new_rows: The rows to add, with the columns of the DataFrame before the calculated
+        measures were added. Each row must come after every row already in the DataFrame with the same group_features.
+        :param TimeSeriesState state: The state returned by generate_time_series_features with return_state, or by
+        the last update.
+        :return: The changed pandas.DataFrame and the state to add the next rows with.
+        :rtype: tuple of (pandas.DataFrame, TimeSeriesState)
+        """
+        return update_time_series_features(dataframe, new_rows, state)
+
+    def stream_time_series_features(self, chunks, output_path, numeric_features, time_hierarchy, level,
+                                    group_features=None, intervals=None, shift_amount=0):
+        """ Adds the calculated measures of generate_time_series_features to a panel too large to hold in memory,
+        reading it in chunks and writing the chunks with their calculated measures to a Parquet file. Only the last
+        rows of the group in progress are carried from chunk to chunk, and the result is identical to running
+        generate_time_series_features on the whole panel.
+
+        :param chunks: The chunks of the panel, sorted together by the group_features and then the levels of the
+        time hierarchy, or the path of a Parquet file to read one row group at a time.
+        :type chunks: iterable of pandas.DataFrame or str
+        :param str output_path: The path of the Parquet file to write.
+        :param str lst numeric_features: The numeric features to use for the calculation.
+        :param str time_hierarchy: The hierarchy that the level belongs to.
+        :param str level: The level within the time hierarchy.
+        :param str lst group_features: The features to be grouped by. Defaults to None.
+        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
+        :param int shift_amount: Allows the user to specify the lag used to generate the calculated measures. Defaults to 0.
+        :return: The number of rows written.
+        :rtype: int
+        """
+        if isinstance(chunks, str):
+            chunks = parquet_chunks(chunks)
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
+            raise UserError('There are no chunks to add calculated measures to')
+
+        numeric_features, group_features, levels, time_name, intervals = self._time_series_arguments(
+            first.columns, numeric_features, time_hierarchy, level, group_features, intervals)
+        frames = stream_time_series_features(itertools.chain([first], chunks), numeric_features, levels, level,
+                                             time_name, intervals, group_features, shift_amount)
+        return write_parquet(frames, output_path)
+
+    def plan_time_series_features(self, numeric_features, time_hierarchy, level, group_features=None, intervals=None,
+                                  shift_amount=0, estimated_rows=None, route=None, returned_rows=None):
+        """ Decides whether get_time_series_features computes the rolling stats and lags in the cube, as the calculated
+        features of create_rolling_stats, or locally like generate_time_series_features. Both routes query every row
+        the windows need. The cube route creates and publishes the features the model is missing and queries them for
+        only the rows returned, the local route computes them for every row, which is cheaper unless few of the rows
+        are returned, see the since parameter of get_time_series_features. The route estimated to take less time is
+        chosen, and the local route whenever shift_amount is not 0, which the cube cannot reproduce.
 
-                        dataframe[f'{name}max'] = dataframe[feature].rolling(interval).max().shift(shift_amount).reset_index(drop=True)
+        :param str lst numeric_features: The numeric features to use for the calculation.
+        :param str time_hierarchy: The hierarchy that the level belongs to.
+        :param str level: The level within the time hierarchy.
+        :param str lst group_features: The features to be grouped by. Defaults to None.
+        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
+        :param int shift_amount: Allows the user to specify the lag used to generate the calculated measures. Defaults to 0.
+        :param int estimated_rows: The number of rows the query is expected to return. Defaults to None when unknown.
+        :param str route: 'cube' or 'local' to choose the route by hand. Defaults to None.
+        :param int returned_rows: The number of the estimated rows from the since member on. Defaults to None for every row.
+        :return: The route along with the reason for it, the estimated seconds of each route and the features it creates.
+        :rtype: TimeSeriesPlan
+        """
+        numeric_features, group_features, levels, time_name, intervals = self._time_series_arguments(
+            self._time_series_levels(time_hierarchy, level), numeric_features, time_hierarchy, level, group_features,
+            intervals)
+        query_columns = len((group_features or []) + levels + numeric_features)
+        return plan_time_series_features(numeric_features, intervals, time_name, self._catalog.numeric_features,
+                                         query_columns, shift_amount, estimated_rows, returned_rows, route)
+
+    def _time_series_levels(self, time_hierarchy, level):
+        """ Lists the levels of a time hierarchy from the highest down to the given level. """
+        levels = self.list_hierarchy_levels(time_hierarchy)
+        return levels[:levels.index(level) + 1] if level in levels else levels
+
+    def get_time_series_features(self, numeric_features, time_hierarchy, level, group_features=None, intervals=None,
+                                 shift_amount=0, estimated_rows=None, route=None, since=None, returned_rows=None):
+        """ Queries the numeric features at the level, by the group_features, with the calculated measures of
+        generate_time_series_features, computing the rolling stats and lags on the route plan_time_series_features
+        chooses. Either route returns the same columns in the same order with the same values, up to floating point
+        rounding, as long as every group has a row for every member of the level it spans. The cube route creates the
+        rolling stats and lags the model is missing and publishes the model once.
+
+        With since, only the rows from that member of the level on are returned, with their windows and to date totals
+        taken from the earlier rows. Both routes query the earlier rows without any calculated features, and the cube
+        route queries its calculated features for the returned rows only, relying on the engine to evaluate them over
+        the earlier members, which check_time_series_parity confirms for a model.
 
-                    dataframe[f'{name}lag'] = dataframe[feature].shift(interval).shift(shift_amount).reset_index(drop=True)
-                    
-            found = False
-            for heir_level in reversed(levels):
-                if found and heir_level in dataframe.columns:
-                    name = f'{feature}_{heir_level}_to_date'
-                    if group_features:
-                        dataframe[name] = dataframe.groupby(group_features+[heir_level])[feature].cumsum().shift(1).reset_index(drop=True)
-                    else:
-                        dataframe[name] = dataframe.groupby([heir_level])[feature].cumsum().shift(1).reset_index(drop=True)
-                if heir_level == level:
-                    found = True
+        :param str lst numeric_features: The numeric features to use for the calculation.
+        :param str time_hierarchy: The hierarchy that the level belongs to.
+        :param str level: The level within the time hierarchy.
+        :param str lst group_features: The features to be grouped by. Defaults to None.
+        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
+        :param int shift_amount: Allows the user to specify the lag used to generate the calculated measures. Defaults to 0.
+        :param int estimated_rows: The number of rows the query is expected to return. Defaults to None when unknown.
+        :param str route: 'cube' or 'local' to choose the route by hand. Defaults to None.
+        :param str since: The first member of the level to return rows for. Defaults to None to return every row.
+        :param int returned_rows: The number of the estimated rows from the since member on. Defaults to None for every row.
+        :return: The queried features with the calculated measures.
+        :rtype: pandas.DataFrame
+        """
+        plan = self.plan_time_series_features(numeric_features, time_hierarchy, level, group_features, intervals,
+                                              shift_amount, estimated_rows, route, returned_rows)
+        numeric_features, group_features, levels, time_name, intervals = self._time_series_arguments(
+            self._time_series_levels(time_hierarchy, level), numeric_features, time_hierarchy, level, group_features,
+            intervals)
+        features = (group_features or []) + levels + numeric_features
+        pushed = [name for name, _, _, _ in plan.features] if plan.route == 'cube' else []
+
+        if plan.route == 'cube' and plan.missing:
+            creators = {'sum': self.create_rolling_sum, 'avg': self.create_rolling_mean,
+                        'stddev': self.create_rolling_stdev, 'min': self.create_rolling_min,
+                        'max': self.create_rolling_max, 'lag': self.create_lag}
+            missing = set(plan.missing)
+            with self.batch():
+                for name, feature, interval, stat in plan.features:
+                    if name in missing:
+                        creators[stat](name, feature, interval, time_hierarchy, level, publish=False)
+
+        if since is None:
+            dataframe = self.get_data(features + pushed)
+            earlier = 0
+        else:
+            history = self.get_data(features, filter_less={level: since})
+            dataframe = pd.concat([history, self.get_data(features + pushed, filter_greater_or_equal={level: since})],
+                                  ignore_index=True)
+            earlier = len(history)
+        dataframe = dataframe.sort_values(by=(group_features or []) + levels)
+        returned = dataframe.index >= earlier
+        dataframe = dataframe.reset_index(drop=True)
+
+        if plan.route == 'cube' and earlier and packed_stats_move(dataframe, group_features):
+            logging.warning('Rows with a null group feature move the rolling stats of the earlier rows to the rows '
+                            'returned, computing them locally')
+            dataframe = dataframe.drop(columns=pushed)
+            plan.route = 'local'
+        if plan.route == 'cube':
+            return finish_pushed_features(dataframe, numeric_features, levels, level, time_name, intervals,
+                                          group_features, None if since is None else returned)
+        dataframe = self.generate_time_series_features(dataframe, numeric_features, time_hierarchy, level,
+                                                       group_features, intervals, shift_amount)
+        return dataframe if since is None else dataframe[returned].reset_index(drop=True)
+
+    def check_time_series_parity(self, numeric_features, time_hierarchy, level, group_features=None, intervals=None,
+                                 rtol=1e-9, since=None, create_features=False):
+        """ Runs get_time_series_features on both routes and compares the results.
+
+        The cube route needs the rolling stats and lags as calculated features of the model. Creating the ones the model
+        is missing changes and publishes the model, so it is only done with create_features.
 
-        return dataframe
+        :param str lst numeric_features: The numeric features to use for the calculation.
+        :param str time_hierarchy: The hierarchy that the level belongs to.
+        :param str level: The level within the time hierarchy.
+        :param str lst group_features: The features to be grouped by. Defaults to None.
+        :param int lst intervals: Custom list of intervals to create features over. Defaults to None to use default intervals based off of level time step
+        :param float rtol: The relative tolerance of the values. Defaults to 1e-9.
+        :param str since: The first member of the level to return rows for, see get_time_series_features. Defaults to
+        None to compare every row.
+        :param bool create_features: Whether to create and publish the calculated features the model is missing.
+        Defaults to False.
+        :return: The number of rows that differ by column, empty when the routes match.
+        :rtype: dict of str/int
+        :raises UserError if the model is missing calculated features and create_features is False
+        """
+        plan = self.plan_time_series_features(numeric_features, time_hierarchy, level, group_features, intervals,
+                                              route='cube')
+        if plan.missing and not create_features:
+            raise UserError(f'The model is missing the calculated features: {plan.missing}. Create them with '
+                            f'create_rolling_stats or pass create_features=True to create and publish them')
+        cube = self.get_time_series_features(numeric_features, time_hierarchy, level, group_features, intervals,
+                                             route='cube', since=since)
+        local = self.get_time_series_features(numeric_features, time_hierarchy, level, group_features, intervals,
+                                              route='local', since=since)
+        return compare_time_series_features(cube, local, rtol=rtol)
 
     # Connecting to Databases
 
@@ -2475,13 +3003,18 @@ class AtScale:
             raise Exception(f'join_features and join_columns lengths must match. join_features is'
                             f' length {len(join_features)} while join_columns is length {len(join_columns)}')
 
-        self._check_multiple_features(join_features, self.list_all_categorical_features(),
+        self._check_multiple_features(join_features, self._catalog.categorical_features,
                                       errmsg='Make sure all items in join_features are categorical features')
 
         self._check_multiple_features(join_columns, dataframe.columns,
                                       errmsg='Make sure all items in join_features are in the dataframe')
 
-        self.database.add_table(table_name, dataframe, chunksize, 'fail')
+        if self.database.supports_key_hints:
+            # rows are looked up by the join columns, so lay the table out by them
+            self.database.add_table(table_name, dataframe, chunksize, 'fail', sort_keys=list(join_columns),
+                                    dist_key=join_columns[0] if join_columns else None)
+        else:
+            self.database.add_table(table_name, dataframe, chunksize, 'fail')
         # TO-DO: if write_df_to_db is deprecated, check if chunksize is None and don't pass None so default
         # is used
 
@@ -2526,12 +3059,12 @@ class AtScale:
         if schema == '':
             schema = self.database.get_schema()
 
-        self._check_multiple_features(join_features, self.list_all_categorical_features(),
+        self._check_multiple_features(join_features, self._catalog.categorical_features,
                                       errmsg='Make sure all items in join_features are categorical features')
 
         url = f'{self.server}:{self.engine_port}/data-sources/orgId/{self.organization}' \
               f'/conn/{connection_id}/tables/cacheRefresh'
-        response = requests.post(url, data='', headers=self.headers)
+        response = self.session.post(url, data='')
 
         if response.status_code != 200:
             resp = json.loads(response.text)
@@ -2544,7 +3077,7 @@ class AtScale:
                 url += f'&schema={schema}'
         elif schema:
             url += f'?schema={schema}'
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url)
 
         if response.status_code != 200:
             resp = json.loads(response.text)
@@ -2683,7 +3216,7 @@ class AtScale:
     def generate_atscale_query(self, features, filter_equals=None, filter_greater=None, filter_less=None,
                                filter_greater_or_equal=None, filter_less_or_equal=None, filter_not_equal=None,
                                filter_in=None, filter_between=None, filter_like=None, filter_rlike=None,
-                               filter_null=None, filter_not_null=None, limit=None, comment=None):
+                               filter_null=None, filter_not_null=None, limit=None, comment=None, filters=None):
         """ Generates an AtScale query to get the given features.
 
         :param list of str features: The list of features to query.
@@ -2701,234 +3234,129 @@ class AtScale:
         :param list of str filter_not_null: Filters results to exclude null values of the specified features. Defaults to None
         :param int limit: Limit the number of results. Defaults to None for no limit.
         :param str comment: A comment string to build into the query. Defaults to None for no comment.
+        :param Filter filters: A filter expression built from query.And, query.Or, query.Not and the comparisons in
+        query, for conditions the filter arguments cannot express. It is ANDed with the filter_* arguments. Defaults to
+        None.
         :return: An AtScale query string.
         :rtype: str
         """
-
-        if filter_equals is None:
-            filter_equals = {}
-        if filter_greater is None:
-            filter_greater = {}
-        if filter_less is None:
-            filter_less = {}
-        if filter_greater_or_equal is None:
-            filter_greater_or_equal = {}
-        if filter_less_or_equal is None:
-            filter_less_or_equal = {}
-        if filter_not_equal is None:
-            filter_not_equal = {}
-        if filter_in is None:
-            filter_in = {}
-        if filter_between is None:
-            filter_between = {}
-        if filter_like is None:
-            filter_like = {}
-        if filter_rlike is None:
-            filter_rlike = {}
-        if filter_null is None:
-            filter_null = []
-        if filter_not_null is None:
-            filter_not_null = []
-        if type(filter_null) != list:
-            filter_null = [filter_null]
-        if type(filter_not_null) != list:
-            filter_not_null = [filter_not_null]
-
         if type(features) != list:
             raise UserError(f'Make sure that Argument: \'{features}\' is a list')
 
-        list_all = self.list_all_features()
-        self._check_multiple_features(features, list_all)
-        self._check_multiple_features(filter_equals, list_all)
-        self._check_multiple_features(filter_greater, list_all)
-        self._check_multiple_features(filter_less, list_all)
-        self._check_multiple_features(filter_greater_or_equal, list_all)
-        self._check_multiple_features(filter_less_or_equal, list_all)
-        self._check_multiple_features(filter_not_equal, list_all)
-        self._check_multiple_features(filter_in, list_all)
-        self._check_multiple_features(filter_between, list_all)
-        self._check_multiple_features(filter_like, list_all)
-        self._check_multiple_features(filter_rlike, list_all)
-        self._check_multiple_features(filter_null, list_all)
-        self._check_multiple_features(filter_not_null, list_all)
-        
-        categorical_features = []
-        numeric_features = []
-        for feature in features:
-            if feature in self.list_all_categorical_features():
-                categorical_features.append(feature)
-            else:
-                numeric_features.append(feature)
-        
-        if categorical_features:
-            categorical_columns_string = ' ' + ', '.join(f'`{self.model_name}`.`{x}`' for x in categorical_features)
-            if numeric_features:
-                categorical_columns_string += ','
-        else:
-            categorical_columns_string = ''
-        if numeric_features:
-            numeric_columns_string = ' ' + ', '.join(f'`{self.model_name}`.`{x}`' for x in numeric_features)
-        else:
-            numeric_columns_string = ''
-
-        if filter_equals or filter_greater or filter_less or filter_greater_or_equal or filter_less_or_equal \
-                or filter_not_equal or filter_in or filter_between or filter_null or filter_not_null or filter_like \
-                or filter_rlike:
-            filter_string = ' WHERE ('
-            for key, value in filter_equals.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` = \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` = {value})'
-            for key, value in filter_greater.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` > \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` > {value})'
-            for key, value in filter_less.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` < \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` < {value})'
-            for key, value in filter_greater_or_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` >= \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` >= {value})'
-            for key, value in filter_less_or_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` <= \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` <= {value})'
-            for key, value in filter_not_equal.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` <> \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` <> {value})'
-            for key, value in filter_like.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value, (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` LIKE \'{value}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` LIKE {value})'
-            for key, value in filter_rlike.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` RLIKE \'{value}\')'
-            for key, value in filter_in.items():
-                str_values = [str(x) for x in value]
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value[0], (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` IN (\''
-                    filter_string += '\', \''.join(str_values)
-                    filter_string += '\'))'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` IN ('
-                    filter_string += ', '.join(str_values)
-                    filter_string += '))'
-            for key, value in filter_between.items():
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                if not isinstance(value[0], (int, float, bool)):
-                    filter_string += f'(`{self.model_name}`.`{key}` BETWEEN \'{value[0]}\' and \'{value[1]}\')'
-                else:
-                    filter_string += f'(`{self.model_name}`.`{key}` BETWEEN {value[0]} and {value[1]})'
-            for key in filter_null:
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` IS NULL)'
-            for key in filter_not_null:
-                if filter_string != ' WHERE (':
-                    filter_string += ' and '
-                filter_string += f'(`{self.model_name}`.`{key}` IS NOT NULL)'
-            filter_string += ') GROUP BY 1'
-        else:
-            filter_string = ''
-        
-        if limit is None:
-            limit_string = ''
-        else:
-            limit_string = f' LIMIT {limit}'
-
-        if comment is None:
-            comment_string = ''
-        else:
-            comment_string = f' /* {comment} */'
-
-        query = f'SELECT {categorical_columns_string}{numeric_columns_string} FROM `{self.project_name}`' \
-                f'.`{self.model_name}` `{self.model_name}`{filter_string}{limit_string}{comment_string}'
-        return query
+        parts, atscale_parts, categorical_features = self._compile_query(
+            features, filter_equals, filter_greater, filter_less, filter_greater_or_equal, filter_less_or_equal,
+            filter_not_equal, filter_in, filter_between, filter_like, filter_rlike, filter_null, filter_not_null,
+            limit, comment, filters)
+        return render_parts(atscale_parts)
 
     def generate_db_query(self, atscale_query):
         """ Submits an AtScale query to the query planner to generate a query for Snowflake.
 
+        Translations are cached for the published version of the project, so repeating a query, even with a different
+        limit or comments, does not go back to the query planner.
+
         :param str atscale_query: The AtScale query to convert to a database query.
         :return: A database query string.
         :rtype: str
         """
-        limit_match = re.search(r"LIMIT [0-9]+", atscale_query)
-        if limit_match:
-            inbound_query = atscale_query.replace(limit_match.group(0), 'LIMIT 1')
-        else:
-            inbound_query = f'{atscale_query} LIMIT 1'
-            
         comment_match = re.findall(r"/\*.+?\*/", atscale_query)
-            
-        now = datetime.utcnow()  # current date and time
-        now = now - timedelta(minutes=5)
 
-        date_time = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-        
-        self.custom_query(inbound_query)
+        # the limit and comments are put back after translating, so they are left out of the cached query, only the
+        # closing clause is the limit, a LIMIT in a filter value or a subquery is kept
+        base_query = re.sub(r"/\*.+?\*/", '', atscale_query)
+        limit_match = self._QUERY_LIMIT.search(base_query)
+        if limit_match:
+            base_query = base_query[:limit_match.start()]
+        base_query = base_query.strip()
+        key = (self._published_version, self.project_name, base_query)
+
+        with self._db_query_cache_lock:
+            outbound_query = self._db_query_cache.get(key)
+            if outbound_query is not None:
+                self._db_query_cache.move_to_end(key)
+        if outbound_query is None:
+            outbound_query = self._plan_db_query(f'{base_query} LIMIT 1')
+            if outbound_query == '':
+                return ''
+            # only the closing clause is the limit that was planned, a LIMIT 10 or a limit in a subquery is kept
+            planned_limit = self._PLANNED_LIMIT.search(outbound_query)
+            if planned_limit:
+                outbound_query = outbound_query[:planned_limit.start()]
+            else:
+                logging.warning('The planned database query does not end with its LIMIT 1, so the limit of the query '
+                                'can not be applied to it')
+            with self._db_query_cache_lock:
+                self._db_query_cache[key] = outbound_query
+                while len(self._db_query_cache) > self._DB_QUERY_CACHE_SIZE:
+                    self._db_query_cache.popitem(last=False)
+
+        db_query = outbound_query
+        if limit_match:
+            db_query += f' LIMIT {limit_match.group(1)}'
+        for comment in comment_match:
+            db_query += ' '
+            db_query += comment
+        return db_query
 
-        url = f'{self.server}:{self.engine_port}/queries/orgId/{self.organization}'\
-              f'?limit=21&querySource=user&queryStarted=5m&queryDateTimeStart={date_time}'
+    def _plan_db_query(self, inbound_query):
+        """ Plans an AtScale query and reads the database query it was planned as from the query history.
 
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 401:
-            logging.info('Invalid authentication, if you created this instance with a token, you need a new one')
-            self.refresh_token()
-            response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            json_data = json.loads(response.content)['response']
-        else:
-            resp = json.loads(response.text)
-            raise Exception(resp['response']['error'])
-        db_query = ''
+        The query is first submitted as a dry run, which plans it without running it on the database. This relies on
+        the engine recording the SubqueriesWall event, which holds the database query, in the history of dry runs.
+        If no such event is found, the query is submitted again and run, as it was before dry runs were used, so it is
+        found on engines that only record the event for queries they run. The query is tagged with a unique comment
+        so it is found in the history even when other queries are being submitted at the same time.
+
+        The history is written asynchronously, so it is read up to _DB_QUERY_HISTORY_ATTEMPTS times per submission
+        with a growing sleep between reads, about two seconds in all when the query does not show up.
+
+        :param str inbound_query: The AtScale query to plan, it should be limited to a row as it may be run.
+        :return: The database query, or an empty string if the planned query was not found in the history.
+        :rtype: str
+        """
+        for dry_run in (True, False):
+            db_query = self._find_planned_query(inbound_query, dry_run)
+            if db_query is not None:
+                return db_query
+            if dry_run:
+                logging.debug('The dry run left no database query in the query history, running the query instead')
+        logging.warning(f'Unable to find the database query for: {inbound_query}')
+        return ''
+
+    def _find_planned_query(self, inbound_query, dry_run):
+        """ Submits an AtScale query and polls the query history for the database query it was planned as.
+
+        :param str inbound_query: The AtScale query to submit.
+        :param bool dry_run: Whether to only plan the query rather than run it.
+        :return: The database query, or None if it did not appear in the history.
+        :rtype: str
+        """
+        marker = f'/* atscale-python {uuid.uuid4()} */'
+        # start the history a minute early in case the server clock is behind
+        date_time = (datetime.utcnow() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+        self.custom_query(f'{inbound_query} {marker}', dryRun=dry_run)
+
+        url = f'{self.server}:{self.engine_port}/queries/orgId/{self.organization}'\
+              f'?limit=100&querySource=user&queryStarted=5m&queryDateTimeStart={date_time}'
+        for attempt in range(self._DB_QUERY_HISTORY_ATTEMPTS):
+            if attempt:
+                # the history is written asynchronously, so the query may not be there yet
+                time.sleep(0.2 * attempt)
+            response = self.session.get(url)
+            if response.status_code == 200:
+                json_data = json.loads(response.content)['response']
+            else:
+                resp = json.loads(response.text)
+                raise Exception(resp['response']['error'])
 
-        for query_info in json_data['data']:
-            if db_query != '':
-                break
-            if query_info['query_text'] == inbound_query:
+            for query_info in json_data['data']:
+                if marker not in query_info['query_text']:
+                    continue
                 for event in query_info['timeline_events']:
                     if event['type'] == 'SubqueriesWall':
-                        outbound_query = event['children'][0]['query_text']
-                        if limit_match:
-                            db_query = outbound_query.replace('LIMIT 1', limit_match.group(0))
-                        else:
-                            db_query = outbound_query.replace('LIMIT 1', '')
-                        if comment_match:
-                            for comment in comment_match:
-                                db_query += ' '
-                                db_query += comment
-                            
-                        break
-
-        return db_query
+                        return event['children'][0]['query_text'].replace(marker, '').strip()
+        return None
 
     #could deprecate
     def submit_db_query(self, db_query):
@@ -2945,7 +3373,7 @@ class AtScale:
 
     def get_data_direct(self, features, filter_equals=None, filter_greater=None, filter_less=None, filter_greater_or_equal=None, filter_less_or_equal=None,
                         filter_not_equal=None, filter_in=None, filter_between=None, filter_like=None, filter_rlike=None, filter_null=None,
-                        filter_not_null=None, limit=None, comment=None):
+                        filter_not_null=None, limit=None, comment=None, chunksize=None, output='pandas', filters=None):
         """ Generates an AtScale query to get the given features, translates it to a database query, and submits it directly to the database.
 
         :param list of str features: The list of features to query.
@@ -2963,16 +3391,38 @@ class AtScale:
         :param list of str filter_not_null: Filters results to exclude null values of the specified features. Defaults to None
         :param int limit: Limit the number of results. Defaults to None for no limit.
         :param str comment: A comment string to build into the query. Defaults to None for no comment.
+        :param int chunksize: The most rows in each DataFrame when streaming the results. Defaults to None to return
+        all results in one DataFrame.
+        :param str output: 'pandas' for DataFrames or 'arrow' for a pyarrow Table, or pyarrow RecordBatches when
+        streaming. Defaults to 'pandas'.
+        :param Filter filters: A filter expression built from query.And, query.Or, query.Not and the comparisons in
+        query, for conditions the filter arguments cannot express. It is ANDed with the filter_* arguments. Defaults to
+        None.
+        :return: the queried data, or an iterator over chunks of at most chunksize rows if chunksize is given
+        :rtype: pandas.DataFrame, pyarrow.Table or an iterator of either
+        """
+        is_arrow_output(output)
+
+        db_query = self.generate_db_query(self.generate_atscale_query(features, filter_equals, filter_greater,
+                                                                      filter_less, filter_greater_or_equal,
+                                                                      filter_less_or_equal, filter_not_equal, filter_in,
+                                                                      filter_between, filter_like, filter_rlike,
+                                                                      filter_null, filter_not_null, limit, comment,
+                                                                      filters))
+        return self._submit_db_query(db_query, chunksize, output)
+
+    def _submit_db_query(self, db_query, chunksize=None, output='pandas'):
+        """ Submits a translated query to the database for get_data_direct.
+
+        See get_data_direct for a description of the parameters.
+
+        :param str db_query: The query to submit to the database.
         :return: the queried data
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame, pyarrow.Table or an iterator of either
         """
-
-        return self.database.submit_query(
-            self.generate_db_query(self.generate_atscale_query(features, filter_equals, filter_greater, filter_less,
-                                                                 filter_greater_or_equal, filter_less_or_equal,
-                                                                 filter_not_equal, filter_in,
-                                                                 filter_between, filter_like, filter_rlike, filter_null,
-                                                                 filter_not_null, limit, comment)))
+        if chunksize is not None:
+            return self.database.submit_query_chunks(db_query, chunksize, output)
+        return self.database.submit_query(db_query, output)
 
     # FUNCTION TO BE DEPRECATED
 
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """A client-side cache of query results with LRU eviction, a time to live and an optional on-disk tier.
+
+    Results are kept in memory up to a number of entries and an estimated number of bytes, evicting the least
+    recently used first. When a directory is given, results are also written there as Parquet files so they survive
+    eviction from memory and can be shared between processes. Every entry belongs to a namespace, normally the
+    project it was queried from, so all results for a project can be dropped when it changes.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, ttl=None, cache_dir=None, max_disk_bytes=None):
+        """ Creates the cache.
+
+        :param int max_entries: The maximum number of results kept in memory. Defaults to 128.
+        :param int max_bytes: The maximum estimated size in bytes of the results kept in memory. Defaults to None for
+        no limit.
+        :param float ttl: The number of seconds a result stays valid. Defaults to None to keep results until they are
+        evicted or invalidated.
+        :param str cache_dir: The directory to write results to as Parquet files. Defaults to None to only cache in
+        memory.
+        :param int max_disk_bytes: The maximum total size in bytes of the files in cache_dir. Defaults to None for no
+        limit.
+        """
+        if int(max_entries) < 1:
+            from errors import UserError
+            raise UserError('max_entries must be greater than 0')
+        if cache_dir is not None:
+            try:
+                import pyarrow
+            except ImportError as e:
+                from errors import AtScaleExtrasDependencyImportError
+                raise AtScaleExtrasDependencyImportError('cache', str(e))
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """ Builds a cache key from the given values.
+
+        :param parts: Values that identify a result, they must be serializable to JSON.
+        :return: The key.
+        :rtype: str
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def _namespace_prefix(namespace):
+        return hashlib.sha256(str(namespace).encode()).hexdigest()[:16]
+
+    def _path(self, namespace, key):
+        return os.path.join(self.cache_dir, f'{self._namespace_prefix(namespace)}-{key}.parquet')
+
+    def get(self, key, namespace=None):
+        """ Looks up a result.
+
+        :param str key: The key of the result.
+        :param str namespace: The namespace the result was stored under. Defaults to None.
+        :return: A copy of the cached result, or None if it is not cached or has expired.
+        :rtype: pandas.DataFrame
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                df, size, expires, _ = entry
+                if expires is None or expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return df.copy()
+                self._remove(key)
+
+        df = self._read_file(namespace, key, now)
+        with self._lock:
+            if df is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._add(key, df, namespace, now)
+        return df.copy()
+
+    def put(self, key, df, namespace=None):
+        """ Stores a result.
+
+        :param str key: The key of the result.
+        :param pandas.DataFrame df: The result to store, a copy is kept so later changes to it are not cached.
+        :param str namespace: The namespace to store the result under. Defaults to None.
+        """
+        df = df.copy()
+        now = time.time()
+        with self._lock:
+            self._add(key, df, namespace, now)
+        self._write_file(namespace, key, df)
+
+    def invalidate(self, namespace):
+        """ Drops every result stored under the given namespace, in memory and on disk.
+
+        :param str namespace: The namespace to drop.
+        """
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[3] == namespace]:
+                self._remove(key)
+        if self.cache_dir is not None:
+            prefix = f'{self._namespace_prefix(namespace)}-'
+            for filename in os.listdir(self.cache_dir):
+                if filename.startswith(prefix) and filename.endswith('.parquet'):
+                    self._delete_file(os.path.join(self.cache_dir, filename))
+
+    def clear(self):
+        """ Drops every result, in memory and on disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.cache_dir is not None:
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith('.parquet'):
+                    self._delete_file(os.path.join(self.cache_dir, filename))
+
+    def _add(self, key, df, namespace, now):
+        if key in self._entries:
+            self._remove(key)
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        expires = None if self.ttl is None else now + self.ttl
+        self._entries[key] = (df, size, expires, namespace)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or \
+                (self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1):
+            self._remove(next(iter(self._entries)))
+        if self.max_bytes is not None and self._bytes > self.max_bytes:
+            # a single result larger than the limit is not kept in memory
+            self._remove(key)
+
+    def _remove(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _read_file(self, namespace, key, now):
+        if self.cache_dir is None:
+            return None
+        path = self._path(namespace, key)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+        if self.ttl is not None and modified + self.ttl <= now:
+            self._delete_file(path)
+            return None
+        import pandas as pd
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            logging.debug(f'Unable to read cached result {path}: {e}')
+            self._delete_file(path)
+            return None
+        # mark the file as recently used for eviction from disk
+        os.utime(path)
+        return df
+
+    def _write_file(self, namespace, key, df):
+        if self.cache_dir is None:
+            return
+        path = self._path(namespace, key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            df.to_parquet(temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.debug(f'Unable to write cached result {path}: {e}')
+            self._delete_file(temp_path)
+            return
+        if self.max_disk_bytes is not None:
+            self._evict_files()
+
+    def _evict_files(self):
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.parquet'):
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            self._delete_file(path)
+            total -= size
+
+    @staticmethod
+    def _delete_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,71 @@
+class MetadataCatalog:
+    """An index over the parsed metadata of a model, built once per refresh so lookups do not rescan the model.
+
+    Only visible features and hierarchies are indexed, matching what the list functions of AtScale return. Lists keep
+    the order features were loaded in and sets are provided for membership checks.
+
+    :var dict of str/dict `~MetadataCatalog.features`: The record of every visible feature by name.
+    :var frozenset of str `~MetadataCatalog.all_features`: The names of all visible features.
+    :var frozenset of str `~MetadataCatalog.categorical_features`: The names of visible categorical features.
+    :var frozenset of str `~MetadataCatalog.numeric_features`: The names of visible aggregate and calculated features.
+    :var frozenset of str `~MetadataCatalog.aggregate_features`: The names of visible aggregate features.
+    :var frozenset of str `~MetadataCatalog.calculated_features`: The names of visible calculated features.
+    :var frozenset of str `~MetadataCatalog.hierarchies`: The names of visible hierarchies.
+    :var dict of str/list of str `~MetadataCatalog.hierarchy_levels`: The levels of each hierarchy from lowest to
+    highest.
+    :var frozenset of str `~MetadataCatalog.folders`: The names of all non-empty folders.
+    """
+
+    def __init__(self, dimensions, measures, hierarchies):
+        """ Builds the catalog.
+
+        :param dict dimensions: The parsed levels and secondary attributes, see AtScale._parse_dimensions.
+        :param dict measures: The parsed measures, see AtScale._parse_measures.
+        :param dict hierarchies: The parsed hierarchies, see AtScale._parse_hierarchies.
+        """
+        # folder '' holds every feature, other keys hold the features in that folder
+        self._lists = {'categorical': {'': []}, 'Aggregate': {'': []}, 'Calculated': {'': []}, 'numeric': {'': []},
+                       'hierarchy': {'': []}}
+        self.features = {}
+
+        for name, info in dimensions.items():
+            if info['visible']:
+                self.features[name] = info
+                self._add('categorical', name, info)
+        for name, info in measures.items():
+            if info['visible']:
+                self.features[name] = info
+                self._add('numeric', name, info)
+                if info['type'] in ('Aggregate', 'Calculated'):
+                    self._add(info['type'], name, info)
+        for name, info in hierarchies.items():
+            if info['visible']:
+                self._add('hierarchy', name, info)
+
+        self.categorical_features = frozenset(self._lists['categorical'][''])
+        self.numeric_features = frozenset(self._lists['numeric'][''])
+        self.aggregate_features = frozenset(self._lists['Aggregate'][''])
+        self.calculated_features = frozenset(self._lists['Calculated'][''])
+        self.all_features = self.categorical_features | self.numeric_features
+        self.hierarchies = frozenset(self._lists['hierarchy'][''])
+        self.hierarchy_levels = {name: [level for (level_number, level, level_type) in sorted(info['levels'])]
+                                 for name, info in hierarchies.items()}
+        self.folders = frozenset(info.get('folder', '') for info in
+                                 list(hierarchies.values()) + list(measures.values()) + list(dimensions.values())) \
+            - {''}
+
+    def _add(self, kind, name, info):
+        self._lists[kind][''].append(name)
+        folder = info.get('folder', '')
+        if folder != '':
+            self._lists[kind].setdefault(folder, []).append(name)
+
+    def list(self, kind, folder=''):
+        """ Lists the visible members of a kind in a folder.
+
+        :param str kind: One of 'categorical', 'numeric', 'Aggregate', 'Calculated' or 'hierarchy'.
+        :param str folder: The folder to list from. Defaults to '' for every folder.
+        :return: The names in the order they were loaded.
+        :rtype: list of str
+        """
+        return list(self._lists[kind].get(folder, ()))
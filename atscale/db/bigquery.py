@@ -4,7 +4,7 @@ import os
 import pandas
 import pandas as pd
 
-from database import Database
+from database import Database, is_arrow_output
 
 
 class BigQuery(Database):
@@ -52,7 +52,6 @@ class BigQuery(Database):
                 :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'.
                 Defaults to 'fail'.
                 """
-        from sqlalchemy import create_engine
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
@@ -66,17 +65,18 @@ class BigQuery(Database):
 
         logging.info(f'Table \"{table_name}\" created in Big Query with {df.size} rows and {len(df.columns)} columns')
 
-    def submit_query(self, db_query):
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to BigQuery and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        from sqlalchemy import create_engine
-        engine = create_engine(self.connection_string)
-        connection = engine.connect()
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self.get_engine().connect() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
     def get_atscale_connection_id(self):
@@ -1,12 +1,478 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import logging
+import queue
+import threading
+import time
+
 import pandas
 
 
+def dataframe_to_rows(dataframe: pandas.DataFrame) -> list:
+    """ Converts a DataFrame to rows of Python values for parameterized inserts, converting a column at a time.
+
+    :param pandas.DataFrame dataframe: The DataFrame to convert.
+    :return: A tuple of values per row, with None in place of null values.
+    :rtype: list of tuple
+    """
+    columns = []
+    for i in range(dataframe.shape[1]):
+        series = dataframe.iloc[:, i]
+        values = series.astype(object).tolist()
+        nulls = series.isna().to_numpy()
+        if nulls.any():
+            for row in nulls.nonzero()[0]:
+                values[row] = None
+        columns.append(values)
+    return list(zip(*columns))
+
+
+def upload_chunks(dataframe: pandas.DataFrame, chunksize: int, write_chunk, workers: int=1, retries: int=0,
+                  max_in_flight: int=None, first_chunk_serial: bool=False) -> dict:
+    """ Writes a DataFrame in chunks, sending chunks concurrently from a pool of threads.
+
+    write_chunk must write its chunk atomically, for example in a single transaction, so a chunk that failed can be
+    retried without duplicating rows.
+
+    :param pandas.DataFrame dataframe: The DataFrame to write.
+    :param int chunksize: The number of rows in each chunk.
+    :param callable write_chunk: Called with each chunk and its index to write it.
+    :param int workers: The number of chunks written at once. Defaults to 1.
+    :param int retries: The number of times a failed chunk is retried. Defaults to 0.
+    :param int max_in_flight: The most chunks queued or being written at once, which bounds the memory used by
+    chunks converted for upload. Defaults to None for twice the number of workers.
+    :param bool first_chunk_serial: Whether the first chunk should be written on its own before the rest, for writers
+    that create the table with the first chunk. That chunk is not retried. Defaults to False.
+    :return: The number of rows, the total seconds, the rows per second and the metrics of each chunk.
+    :rtype: dict
+    """
+    if int(workers) < 1:
+        from atscale.errors import UserError
+        raise UserError('workers must be greater than 0')
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    # an empty frame is still written once so writers that create the table do so
+    starts = list(range(0, dataframe.shape[0], chunksize)) or [0]
+
+    def write(index, start, retries=retries):
+        chunk = dataframe.iloc[start:start + chunksize]
+        attempt = 0
+        while True:
+            began = time.perf_counter()
+            try:
+                write_chunk(chunk, index)
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logging.warning(f'Retrying chunk {index} after error: {e}')
+                continue
+            return {'chunk': index, 'rows': chunk.shape[0], 'seconds': time.perf_counter() - began,
+                    'attempts': attempt + 1}
+
+    started = time.perf_counter()
+    metrics = []
+    chunks = list(enumerate(starts))
+    if first_chunk_serial:
+        metrics.append(write(*chunks.pop(0), retries=0))
+    if chunks:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            try:
+                for index, start in chunks:
+                    while len(pending) >= max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        metrics.extend(future.result() for future in done)
+                    pending.add(executor.submit(write, index, start))
+                done, pending = wait(pending)
+                metrics.extend(future.result() for future in done)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    seconds = time.perf_counter() - started
+    rows = dataframe.shape[0]
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else float('inf'),
+            'chunks': sorted(metrics, key=lambda m: m['chunk'])}
+
+
+def executemany_chunk_writer(connections, operation: str, fast_executemany: bool=True):
+    """ Builds a write_chunk for upload_chunks that inserts each chunk with one executemany and commits it.
+
+    :param ThreadLocalConnections connections: The DB-API connections to insert with, opened without autocommit.
+    :param str operation: The parameterized INSERT statement.
+    :param bool fast_executemany: Whether pyodbc should send each chunk's parameters as arrays. Defaults to True.
+    :return: The chunk writer.
+    :rtype: callable
+    """
+    def write_chunk(chunk, index):
+        if chunk.shape[0] == 0:
+            return
+        connection = connections.get()
+        try:
+            cursor = connection.cursor()
+            cursor.fast_executemany = fast_executemany
+            cursor.executemany(operation, dataframe_to_rows(chunk))
+            connection.commit()
+        except Exception:
+            # the connection may be broken or mid transaction, closing it rolls back and a retry gets a new one
+            connections.discard()
+            raise
+        cursor.close()
+    return write_chunk
+
+
+def is_arrow_output(output: str) -> bool:
+    """ Checks the format a query result was requested in.
+
+    :param str output: Either 'pandas' or 'arrow'.
+    :return: Whether the result should be built as Arrow data.
+    :rtype: bool
+    :raises UserError if output is not a valid format
+    :raises AtScaleExtrasDependencyImportError if output is 'arrow' and pyarrow is not installed
+    """
+    valid_outputs = ['pandas', 'arrow']
+    if output not in valid_outputs:
+        from atscale.errors import UserError
+        raise UserError(f'Invalid output: {output}. Valid options are: {valid_outputs}.')
+    if output == 'arrow':
+        try:
+            import pyarrow
+        except ImportError as e:
+            from atscale.errors import AtScaleExtrasDependencyImportError
+            raise AtScaleExtrasDependencyImportError('arrow', str(e))
+        return True
+    return False
+
+
+def fetch_arrow_table(cursor, batch_size: int=100000):
+    """ Reads the whole result of an executed DB-API cursor into a pyarrow Table.
+
+    Drivers that fetch Arrow data natively, such as the Snowflake connector, are read with it. Other drivers are read
+    with fetchmany and each column is converted to an Arrow array once, without building a DataFrame.
+
+    :param cursor: The cursor the query was executed on.
+    :param int batch_size: The number of rows fetched at a time from drivers without Arrow support. Defaults to
+    100,000.
+    :return: The result.
+    :rtype: pyarrow.Table
+    """
+    import pyarrow as pa
+    names = [column[0] for column in cursor.description]
+    fetch_arrow_all = getattr(cursor, 'fetch_arrow_all', None)
+    if fetch_arrow_all is not None:
+        table = fetch_arrow_all()
+        if table is not None:
+            return table
+    columns = [[] for _ in names]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return pa.Table.from_arrays([pa.array(column) for column in columns], names=names)
+
+
+def fetch_arrow_batches(cursor, batch_size: int):
+    """ Reads the result of an executed DB-API cursor as pyarrow RecordBatches of at most batch_size rows.
+
+    The type of each column is taken from the first batch in which it has a value, later batches are converted to it.
+
+    :param cursor: The cursor the query was executed on.
+    :param int batch_size: The most rows in each batch.
+    :return: An iterator over the result.
+    :rtype: iterator of pyarrow.RecordBatch
+    """
+    import pyarrow as pa
+    names = [column[0] for column in cursor.description]
+    native_batches = getattr(cursor, 'fetch_arrow_batches', None)
+    if native_batches is not None:
+        for table in native_batches():
+            yield from table.to_batches(max_chunksize=batch_size)
+        return
+    types = [None] * len(names)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        arrays = []
+        for i, values in enumerate(zip(*rows)):
+            array = pa.array(values, type=types[i])
+            if types[i] is None and array.type != pa.null():
+                types[i] = array.type
+            arrays.append(array)
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+class ThreadLocalConnections:
+    """Opens one connection per thread on first use, for writers that share work between threads."""
+
+    def __init__(self, connect, release=None, discard=None):
+        """ Creates the holder.
+
+        :param callable connect: Called with no arguments to open a new connection.
+        :param callable release: Called with each connection when the holder is closed, for example to return it to
+        a pool. Defaults to None to close the connections.
+        :param callable discard: Called with a connection that failed, for example to close it without returning it
+        to a pool. Defaults to None to close it.
+        """
+        self._connect = connect
+        self._release = release
+        self._discard = discard
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """ Returns the connection of the current thread, opening it if needed.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def discard(self):
+        """ Drops the connection of the current thread after it failed, the next get opens a new one.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self._connections.remove(connection)
+        if self._discard is not None:
+            self._discard(connection)
+        else:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """ Closes or releases every connection that was opened.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            if self._release is not None:
+                self._release(connection)
+            else:
+                connection.close()
+
+
+class ConnectionPool:
+    """Keeps DB-API connections open for reuse, for drivers that are used without SQLAlchemy."""
+
+    def __init__(self, connect, size: int=5, recycle: float=None):
+        """ Creates an empty pool.
+
+        :param callable connect: Called with no arguments to open a new connection.
+        :param int size: The most idle connections kept open. Defaults to 5.
+        :param float recycle: The number of seconds after which a connection is closed instead of reused. Defaults to
+        None to reuse connections indefinitely.
+        """
+        self._connect = connect
+        self.size = size
+        self.recycle = recycle
+        self._idle = queue.LifoQueue()
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns an idle connection, or a new one if none are idle.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self.recycle is None or time.monotonic() - self._opened.get(id(connection), 0) < self.recycle:
+                return connection
+            self.discard(connection)
+        connection = self._connect()
+        with self._lock:
+            self._opened[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection):
+        """ Returns a connection to the pool, closing it if the pool is full.
+        """
+        if self._idle.qsize() < self.size:
+            self._idle.put(connection)
+        else:
+            self.discard(connection)
+
+    def discard(self, connection):
+        """ Closes a connection that was acquired from the pool instead of returning it.
+        """
+        with self._lock:
+            self._opened.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """ Lends a connection for the duration of a with block, connections that raised are closed not reused.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self.discard(connection)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """ Closes every idle connection.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(connection)
+
+
 class Database(ABC):
     """
     Database is an object used for all interaction between AtScale and the supported database
+
+    :var int upload_workers: The number of chunks add_table writes at once. Defaults to 4.
+    :var int upload_retries: The number of times add_table retries a chunk that failed to write. Defaults to 2.
+    :var dict upload_stats: The rows, seconds, rows per second and per chunk metrics of the last add_table call.
+    :var bool supports_key_hints: Whether add_table accepts sort_keys and dist_key to lay out new tables.
+    :var int pool_size: The number of connections kept open for reuse. Defaults to 5.
+    :var float pool_recycle: The number of seconds after which a pooled connection is replaced. Defaults to 3600.
+
+    Connections are opened on first use and reused by submit_query and add_table until close is called, or the
+    database is used as a context manager.
     """
 
+    supports_key_hints = False
+    upload_workers = 4
+    upload_retries = 2
+    upload_stats = None
+    pool_size = 5
+    pool_recycle = 3600
+    _engine = None
+    _connection_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_pool_lock(self):
+        """ Returns the lock guarding the creation of this database's engine and connection pool.
+
+        Subclasses do not call Database.__init__, so the lock is created on first use. dict.setdefault is atomic,
+        so threads racing to create it all get the same lock.
+        """
+        return self.__dict__.setdefault('_pool_lock', threading.Lock())
+
+    def get_engine(self):
+        """ Returns the SQLAlchemy engine of this database, creating its connection pool on first use.
+
+        :return: The engine.
+        :rtype: sqlalchemy.engine.Engine
+        """
+        if self._engine is None:
+            with self._get_pool_lock():
+                if self._engine is None:
+                    self._engine = self._create_engine()
+        return self._engine
+
+    def _create_engine(self):
+        """ Creates the pooled SQLAlchemy engine, databases that need extra engine arguments override this.
+        """
+        from sqlalchemy import create_engine
+        return create_engine(self.connection_string, pool_size=self.pool_size, pool_recycle=self.pool_recycle,
+                             pool_pre_ping=True)
+
+    def _get_connection_pool(self) -> ConnectionPool:
+        """ Returns the pool of DB-API connections of this database, for databases used without SQLAlchemy.
+        """
+        if self._connection_pool is None:
+            with self._get_pool_lock():
+                if self._connection_pool is None:
+                    self._connection_pool = ConnectionPool(self._connect, size=self.pool_size,
+                                                           recycle=self.pool_recycle)
+        return self._connection_pool
+
+    def _connect(self):
+        """ Opens a new DB-API connection, by default a raw connection from the SQLAlchemy engine. Databases used
+        without SQLAlchemy override this to open one with autocommit on.
+        """
+        return self.get_engine().raw_connection()
+
+    @contextmanager
+    def _dbapi_connection(self):
+        """ Lends a pooled DB-API connection for the duration of a with block, databases used without SQLAlchemy
+        override this.
+        """
+        connection = self.get_engine().raw_connection()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _stream_connection(self):
+        """ Lends a pooled connection that pandas can read results from a server-side cursor with.
+        """
+        with self.get_engine().connect() as connection:
+            yield connection.execution_options(stream_results=True)
+
+    def _writer_connections(self) -> ThreadLocalConnections:
+        """ Lends a pooled DB-API connection with autocommit off to each upload thread, for use with
+        executemany_chunk_writer.
+
+        Connections that failed are closed instead of returned to the pool. The others are rolled back, in case a
+        transaction was left open, and have autocommit turned back on before they are reused.
+        """
+        pool = self._get_connection_pool()
+
+        def connect():
+            connection = pool.acquire()
+            try:
+                connection.autocommit = False
+            except Exception:
+                pool.discard(connection)
+                raise
+            return connection
+
+        def release(connection):
+            try:
+                connection.rollback()
+                connection.autocommit = True
+            except Exception as e:
+                logging.warning(f'Closing a connection that could not be reset after an upload: {e}')
+                pool.discard(connection)
+                return
+            pool.release(connection)
+
+        return ThreadLocalConnections(connect, release, pool.discard)
+
+    def close(self):
+        """ Closes the pooled connections of this database, new ones are opened if it is used again.
+        """
+        with self._get_pool_lock():
+            engine, self._engine = self._engine, None
+            connection_pool, self._connection_pool = self._connection_pool, None
+        if engine is not None:
+            engine.dispose()
+        if connection_pool is not None:
+            connection_pool.close()
+
     @abstractmethod
     def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=None, if_exists: str='fail'):
         """ Creates a table in the database and inserts a DataFrame into the table.
@@ -20,14 +486,81 @@ class Database(ABC):
         """
         pass
 
+    def _upload(self, dataframe: pandas.DataFrame, chunksize: int, write_chunk, retries: int=None,
+                first_chunk_serial: bool=False) -> dict:
+        """ Writes a DataFrame in chunks with upload_chunks using this database's upload settings.
+
+        :param pandas.DataFrame dataframe: The DataFrame to write.
+        :param int chunksize: The number of rows in each chunk.
+        :param callable write_chunk: Called with each chunk and its index to write it.
+        :param int retries: The number of times a failed chunk is retried. Defaults to None to use upload_retries.
+        :param bool first_chunk_serial: Whether the first chunk should be written before the rest. Defaults to False.
+        :return: The upload statistics, which are also stored in upload_stats.
+        :rtype: dict
+        """
+        if retries is None:
+            retries = self.upload_retries
+        self.upload_stats = upload_chunks(dataframe, chunksize, write_chunk, workers=self.upload_workers,
+                                          retries=retries, first_chunk_serial=first_chunk_serial)
+        logging.debug(f'Uploaded {self.upload_stats["rows"]} rows in {len(self.upload_stats["chunks"])} chunks at '
+                      f'{self.upload_stats["rows_per_second"]:.0f} rows/sec')
+        return self.upload_stats
+
     @abstractmethod
-    def submit_query(self, db_query):
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to the database and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+
+    def _submit_query_arrow(self, db_query: str):
+        """ Submits a query to the database and returns the result as a pyarrow Table, see fetch_arrow_table.
+        """
+        with self._dbapi_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(db_query)
+                return fetch_arrow_table(cursor)
+            finally:
+                cursor.close()
+
+    def submit_query_chunks(self, db_query: str, chunksize: int=100000, output: str='pandas'):
+        """ Submits a query to the database and yields the result in chunks of at most chunksize rows.
+
+        Rows are streamed with a server-side cursor where the driver supports one, so only one chunk is held in memory
+        at a time. The connection stays checked out of the pool until the iterator is exhausted or closed.
+
+        :param str db_query: The query to submit to the database.
+        :param int chunksize: The most rows in each chunk. Defaults to 100,000.
+        :param str output: 'pandas' to yield DataFrames or 'arrow' to yield pyarrow RecordBatches. Defaults to 'pandas'.
+        :return: An iterator over the queried data.
+        :rtype: iterator of pandas.DataFrame or iterator of pyarrow.RecordBatch
+        :raises UserError if chunksize is less than 1 or output is not a valid format
+        """
+        # validated here rather than in the generator so bad arguments raise when this is called, not on first next()
+        if int(chunksize) < 1:
+            from atscale.errors import UserError
+            raise UserError('Chunksize must be greater than 0')
+        return self._submit_query_chunks(db_query, int(chunksize), is_arrow_output(output))
+
+    def _submit_query_chunks(self, db_query: str, chunksize: int, arrow: bool):
+        """ Yields the chunks of submit_query_chunks once its arguments were validated.
         """
+        if arrow:
+            with self._dbapi_connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(db_query)
+                    yield from fetch_arrow_batches(cursor, chunksize)
+                finally:
+                    cursor.close()
+            return
+        with self._stream_connection() as connection:
+            for chunk in pandas.read_sql_query(db_query, connection, chunksize=chunksize):
+                yield chunk
 
     @abstractmethod
     def get_atscale_connection_id(self) -> str:
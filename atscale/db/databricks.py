@@ -1,15 +1,23 @@
 import logging
+import os
+import shutil
+import time
+import uuid
 
 import pandas
 import pandas as pd
-from database import Database
+from database import Database, ThreadLocalConnections, dataframe_to_rows, is_arrow_output
 
 
 class Databricks(Database):
     """An object used for all interaction between AtScale and Databricks as well as storage of all necessary
             information for the connected Databricks database"""
 
-    def __init__(self, atscale_connection_id, token, host, schema, http_path, driver, port=443):
+    # the most parameters bound in a single INSERT statement
+    _MAX_INSERT_PARAMETERS = 2000
+
+    def __init__(self, atscale_connection_id, token, host, schema, http_path, driver, port=443, staging_path=None,
+                 staging_uri=None):
         """ Creates a database connection to allow for writeback to a Databricks warehouse.
 
         :param str atscale_connection_id: The connection name for the warehouse in AtScale.
@@ -18,6 +26,11 @@ class Databricks(Database):
         :param str http_path: The database HTTP path.
         :param str driver: The Databricks driver to use.
         :param str port: The database port (defaults to 443).
+        :param str staging_path: A directory that Databricks can read, such as a DBFS mount, to stage tables in as
+        Parquet files which are then loaded with COPY INTO. Defaults to None to insert rows with parameterized
+        statements instead.
+        :param str staging_uri: The location of staging_path as seen by Databricks, for example 'dbfs:/tmp/atscale'.
+        Defaults to None to use staging_path.
         """
         try:
             from sqlalchemy import create_engine
@@ -39,8 +52,16 @@ class Databricks(Database):
         self.connection_string = str(engine.url)
         self.http_path = http_path
         self.driver = driver
+        self.staging_path = staging_path
+        self.staging_uri = staging_uri if staging_uri is not None else staging_path
         logging.info('Databricks database created')
 
+    def _create_engine(self):
+        from sqlalchemy import create_engine
+        return create_engine(self.connection_string, pool_size=self.pool_size, pool_recycle=self.pool_recycle,
+                             pool_pre_ping=True,
+                             connect_args={'http_path': self.http_path, 'driver_path': self.driver})
+
     def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=10000, if_exists: str='fail'):
         """ Creates a table in Databricks using a pandas DataFrame.
 
@@ -48,15 +69,16 @@ class Databricks(Database):
                 :param pandas.DataFrame dataframe: The DataFrame to upload to the table.
                 :param int chunksize: the number of rows to insert at a time. Defaults to None to use default value for database.
                 :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'. Defaults to 'fail'.
+
+                If a staging_path was given the chunks are written there as Parquet files and loaded with one COPY INTO,
+                otherwise each chunk is inserted with parameterized multi-row INSERT statements. The time taken by each
+                chunk is recorded in upload_stats.
                 """
-        from sqlalchemy import create_engine
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
                             f'Valid values are \'append\', \'replace\', and \'fail\'')
 
-        df = dataframe.copy()
-
         if chunksize is None:
             chunksize=10000
         if int(chunksize) < 1:
@@ -72,8 +94,7 @@ class Databricks(Database):
             '<class \'datetime.date\'>': 'Date',
             '<class \'decimal.Decimal\'>': 'Decimal'
         }
-        engine = create_engine(self.connection_string,
-                               connect_args={'http_path': self.http_path, 'driver_path': self.driver})
+        engine = self.get_engine()
 
         exists = engine.has_table(table_name, schema=self.schema)
         if exists and if_exists == 'fail':
@@ -100,39 +121,106 @@ class Databricks(Database):
         operation += ")"
         cursor.execute(operation)
 
-        operation = f"INSERT INTO `{self.schema}`.`{table_name}` VALUES ("
-
-        list_df = [dataframe[i:i + chunksize] for i in range(0, dataframe.shape[0], chunksize)]
-        for df in list_df:
-            op_copy = operation
-            for index, row in df.iterrows():
-                for col in df.columns:
-                    if 'String' in types[col]:
-                        op_copy += "'{}', ".format(row[col])
-                    elif 'Date' in types[col] or 'Timestamp' in types[col]:
-                        op_copy += "cast('{}' as {}), ".format(row[col], types[col])
-                    else:
-                        op_copy += f"{row[col]}, "
-                op_copy = op_copy[:-2]
-                op_copy += "), ("
-            op_copy = op_copy[:-3]
-            cursor.execute(op_copy)
-        connection.close()
+        try:
+            if self.staging_path is not None:
+                self._copy_into(cursor, table_name, dataframe, types, chunksize)
+            else:
+                self._insert_rows(engine, table_name, dataframe, chunksize)
+        finally:
+            connection.close()
+
+        logging.info(f'Table \"{table_name}\" created in Databricks with {dataframe.shape[0]} rows and {len(dataframe.columns)} columns')
+
+    def _insert_rows(self, engine, table_name, dataframe, chunksize):
+        """ Inserts the DataFrame in concurrent chunks with parameterized multi-row INSERT statements.
+
+        :param sqlalchemy.engine.Engine engine: The engine to open connections with.
+        :param str table_name: The table to insert into.
+        :param pandas.DataFrame dataframe: The DataFrame to insert.
+        :param int chunksize: The number of rows to insert at a time.
+        """
+        columns = ', '.join(f'`{col}`' for col in dataframe.columns)
+        row_markers = '(' + ', '.join('?' for _ in dataframe.columns) + ')'
+        rows_per_statement = max(1, min(chunksize, self._MAX_INSERT_PARAMETERS // max(1, len(dataframe.columns))))
+
+        def write_chunk(chunk, index):
+            cursor = connections.get().cursor()
+            try:
+                try:
+                    rows = dataframe_to_rows(chunk)
+                    for i in range(0, len(rows), rows_per_statement):
+                        statement_rows = rows[i:i + rows_per_statement]
+                        operation = f'INSERT INTO `{self.schema}`.`{table_name}` ({columns}) VALUES ' + \
+                                    ', '.join(row_markers for _ in statement_rows)
+                        cursor.execute(operation, [value for row in statement_rows for value in row])
+                finally:
+                    cursor.close()
+            except Exception:
+                # the connection may be broken, a retry gets a new one
+                connections.discard()
+                raise
+
+        # a chunk split over several statements is not atomic, so it can only be retried when it is one statement
+        retries = None if rows_per_statement >= chunksize else 0
+        connections = ThreadLocalConnections(engine.raw_connection)
+        try:
+            self._upload(dataframe, chunksize, write_chunk, retries=retries)
+        finally:
+            connections.close()
+
+    def _copy_into(self, cursor, table_name, dataframe, types, chunksize):
+        """ Stages the DataFrame as one Parquet file per chunk, written concurrently, and loads them with a single
+        COPY INTO.
+
+        :param cursor: The cursor to load with.
+        :param str table_name: The table to load into.
+        :param pandas.DataFrame dataframe: The DataFrame to load.
+        :param dict types: The Databricks type of each column of the table.
+        :param int chunksize: The number of rows to write to each file.
+        """
+        try:
+            import pyarrow
+        except ImportError as e:
+            from atscale.errors import AtScaleExtrasDependencyImportError
+            raise AtScaleExtrasDependencyImportError('databricks', str(e))
+
+        directory = f'{table_name}_{uuid.uuid4().hex}'
+        local_directory = os.path.join(self.staging_path, directory)
+        os.makedirs(local_directory)
+
+        # COPY INTO does not cast Parquet columns, so INT and FLOAT columns are written as 32 bit values, which raises
+        # if an integer does not fit as inserting it would
+        schema = pyarrow.Schema.from_pandas(dataframe, preserve_index=False)
+        for name, arrow_type in (('Integer', pyarrow.int32()), ('Float', pyarrow.float32())):
+            for column in (column for column, value in types.items() if value == name):
+                position = schema.get_field_index(column)
+                schema = schema.set(position, schema.field(position).with_type(arrow_type))
 
-        logging.info(f'Table \"{table_name}\" created in Databricks with {df.size} rows and {len(df.columns)} columns')
+        def write_chunk(chunk, index):
+            chunk.to_parquet(os.path.join(local_directory, f'part-{index:05d}.parquet'), index=False, schema=schema,
+                             compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
 
-    def submit_query(self, db_query):
+        try:
+            self._upload(dataframe, chunksize, write_chunk)
+            began = time.perf_counter()
+            cursor.execute(f"COPY INTO `{self.schema}`.`{table_name}` "
+                           f"FROM '{self.staging_uri.rstrip('/')}/{directory}' FILEFORMAT = PARQUET")
+            self.upload_stats['copy_seconds'] = time.perf_counter() - began
+        finally:
+            shutil.rmtree(local_directory, ignore_errors=True)
+
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to Snowflake and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        from sqlalchemy import create_engine
-        engine = create_engine(self.connection_string, connect_args={'http_path': self.http_path,
-                                                                     'driver_path': self.driver})
-        connection = engine.connect()
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self.get_engine().connect() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
     def get_atscale_connection_id(self):
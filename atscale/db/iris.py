@@ -4,7 +4,7 @@ import logging
 import pandas
 import pandas as pd
 
-from database import Database
+from database import Database, executemany_chunk_writer, is_arrow_output
 
 
 class Iris(Database):
@@ -45,22 +45,21 @@ class Iris(Database):
 
         logging.info('Iris db connection created')
 
-    def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=250, if_exists: str='fail'):
+    def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=250, if_exists: str='fail',
+                  fast_executemany: bool=True):
         """ Creates a table in Iris using a pandas DataFrame.
 
                         :param str table_name: The table to insert into.
                         :param pandas.DataFrame dataframe: The DataFrame to upload to the table.
                         :param int chunksize: the number of rows to insert at a time. Defaults to None to use default value for database.
                         :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'. Defaults to 'fail'.
+                        :param bool fast_executemany: Whether pyodbc should send each chunk's parameters to the driver as arrays. Defaults to True.
                         """
-        import pyodbc as po
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
                             f'Valid values are \'append\', \'replace\', and \'fail\'')
 
-        df = dataframe.copy()
-
         if chunksize is None:
             chunksize=250
         if int(chunksize) < 1:
@@ -78,71 +77,75 @@ class Iris(Database):
             '<class \'decimal.Decimal\'>': 'DECIMAL'
         }
 
-        connection = po.connect(self.connection_string, autommit=True)
-        cursor = connection.cursor()
-
-        if cursor.tables(table=table_name, schema=self.schema).fetchone():
-            exists = True
-        else:
-            exists = False
+        with self._get_connection_pool().connection() as connection:
+            cursor = connection.cursor()
 
-        if exists and if_exists == 'fail':
-            raise Exception(f'A table named: {table_name} already exists in schema: {self.schema}')
-
-        if exists and if_exists == 'replace':
-            operation = f"DROP TABLE \"{self.schema}\".\"{table_name}\""
-            cursor.execute(operation)
-            logging.debug(f'{table_name} already exists in the Iris db, so it was replaced')
-
-        types = {}
-        for i in dataframe.columns:
-            if str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0])) in conversion_dict_iris:
-                types[i] = conversion_dict_iris[str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0]))]
+            if cursor.tables(table=table_name, schema=self.schema).fetchone():
+                exists = True
             else:
-                types[i] = conversion_dict_iris['<class \'str\'>']
-
-        if not cursor.tables(table=table_name, tableType='TABLE').fetchone():
-            operation = "CREATE TABLE \"{}\".\"{}\" (".format(self.schema, table_name)
-            for key, value in types.items():
-                operation += "\"{}\" {}, ".format(key, value)
-            operation = operation[:-2]
-            operation += ")"
-            cursor.execute(operation)
-
-        operation = "INSERT INTO \"{}\".\"{}\" (".format(self.schema, table_name)
-        for col in dataframe.columns:
-            operation += "\"{}\", ".format(col)
-        operation = operation[:-2]
-        operation += ") "
-
-        list_df = [dataframe[i:i + chunksize] for i in range(0, dataframe.shape[0], chunksize)]
-        for df in list_df:
-            op_copy = operation
-            for index, row in df.iterrows():
-                op_copy += 'SELECT '
-                for cl in df.columns:
-                    op_copy += "'{}', ".format(row[cl])
-                op_copy = op_copy[:-2]
-                op_copy += " UNION ALL "
-            op_copy = op_copy[:-11]
-            cursor.execute(op_copy)
-        connection.close()
+                exists = False
+
+            if exists and if_exists == 'fail':
+                raise Exception(f'A table named: {table_name} already exists in schema: {self.schema}')
+
+            if exists and if_exists == 'replace':
+                operation = f"DROP TABLE \"{self.schema}\".\"{table_name}\""
+                cursor.execute(operation)
+                logging.debug(f'{table_name} already exists in the Iris db, so it was replaced')
+
+            types = {}
+            for i in dataframe.columns:
+                if str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0])) in conversion_dict_iris:
+                    types[i] = conversion_dict_iris[str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0]))]
+                else:
+                    types[i] = conversion_dict_iris['<class \'str\'>']
+
+            if not cursor.tables(table=table_name, tableType='TABLE').fetchone():
+                operation = "CREATE TABLE \"{}\".\"{}\" (".format(self.schema, table_name)
+                for key, value in types.items():
+                    operation += "\"{}\" {}, ".format(key, value)
+                operation = operation[:-2]
+                operation += ")"
+                cursor.execute(operation)
+
+            columns = ', '.join(f"\"{col}\"" for col in dataframe.columns)
+            markers = ', '.join('?' for _ in dataframe.columns)
+            operation = f"INSERT INTO \"{self.schema}\".\"{table_name}\" ({columns}) VALUES ({markers})"
+
+        # chunks are inserted concurrently, each bound as arrays of parameters and committed on its own
+        connections = self._writer_connections()
+        try:
+            self._upload(dataframe, chunksize, executemany_chunk_writer(connections, operation, fast_executemany))
+        finally:
+            connections.close()
 
-        logging.info(f'Table \"{table_name}\" created in Databricks with {df.size} rows and {len(df.columns)} columns')
+        logging.info(f'Table \"{table_name}\" created in Iris with {dataframe.shape[0]} rows and {len(dataframe.columns)} columns')
 
-    def submit_query(self, db_query):
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to Snowflake and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        import pyodbc as po
-        engine = po.connect(self.connection_string, autocommit=True)
-        connection = engine.connect()
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self._get_connection_pool().connection() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
+    def _connect(self):
+        import pyodbc as po
+        return po.connect(self.connection_string, autocommit=True)
+
+    def _dbapi_connection(self):
+        return self._get_connection_pool().connection()
+
+    def _stream_connection(self):
+        # pyodbc fetches rows from the open cursor as pandas reads each chunk
+        return self._get_connection_pool().connection()
+
     def get_atscale_connection_id(self):
         return self.atscale_connection_id
 
@@ -1,18 +1,26 @@
 import getpass
+import json
 import logging
+import os
+import shutil
+import tempfile
+import uuid
 
 import pandas
 import pandas as pd
 
 
-from database import Database
+from database import Database, is_arrow_output
 
 class Redshift(Database):
     """
     An object used for all interaction between AtScale and Redshift as well as storage of all necessary information
     for the connected Redshift
     """
-    def __init__(self, atscale_connection_id, username, host, database, schema, port='5439'):
+    supports_key_hints = True
+
+    def __init__(self, atscale_connection_id, username, host, database, schema, port='5439', staging_path=None,
+                 staging_uri=None, iam_role=None):
         """ Creates a database connection to allow for writeback to a Redshift warehouse.
 
         :param str atscale_connection_id: The connection name for the warehouse in AtScale.
@@ -21,6 +29,12 @@ class Redshift(Database):
         :param str database: The database name.
         :param str schema: The database schema.
         :param str port: The database port (defaults to 5439).
+        :param str staging_path: Where add_table stages tables as Parquet files to load them with COPY, either an
+        's3://bucket/prefix' location or a local directory that Redshift can read through staging_uri. Defaults to
+        None to insert rows instead.
+        :param str staging_uri: The location of a local staging_path as seen by Redshift. Defaults to None to use
+        staging_path.
+        :param str iam_role: The ARN of the IAM role Redshift uses to read the staged files. Defaults to None.
         :raises Exception if any of the inputs are of type None
         """
         try:
@@ -45,19 +59,33 @@ class Redshift(Database):
         self.schema = schema
         self.atscale_connection_id = atscale_connection_id
         self.connection_string = str(engine.url)
+        self.staging_path = staging_path
+        self.staging_uri = staging_uri if staging_uri is not None else staging_path
+        self.iam_role = iam_role
 
         logging.info('Redshift connection created')
 
-    def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=1000, if_exists: str='fail'):
+    def _create_engine(self):
+        from sqlalchemy import create_engine
+        return create_engine(self.connection_string, pool_size=self.pool_size, pool_recycle=self.pool_recycle,
+                             pool_pre_ping=True, executemany_mode='batch', executemany_values_page_size=10000,
+                             executemany_batch_page_size=500)
+
+    def add_table(self, table_name: str, dataframe: pandas.DataFrame, chunksize: int=1000, if_exists: str='fail',
+                  sort_keys: list=None, dist_key: str=None):
         """ Creates a table in redshift using a pandas DataFrame.
 
+        If a staging_path was given the chunks are written there as Parquet files with a manifest and loaded with a
+        single COPY, otherwise they are inserted.
+
         :param str table_name: The table to insert into.
         :param pandas.DataFrame dataframe: The DataFrame to upload to the table.
         :param int chunksize: the number of rows to insert at a time. Defaults to None to use default value for database
         :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'.
         Defaults to 'fail'.
+        :param list of str sort_keys: The columns to sort a newly created table by. Defaults to None.
+        :param str dist_key: The column to distribute the rows of a newly created table by. Defaults to None.
         """
-        from sqlalchemy import create_engine
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
@@ -75,23 +103,123 @@ class Redshift(Database):
         df.columns = df.columns.str.lower()
         table_name = table_name.lower()
 
-        engine = create_engine(self.connection_string, executemany_mode='batch',
-                               executemany_values_page_size=chunksize, executemany_batch_page_size=500)
-        df.to_sql(name=table_name, con=engine, schema=self.schema, method='multi', index=False,
-                  chunksize=chunksize, if_exists=if_exists)
-        logging.info(f'Table \"{table_name}\" created in Redshift with {df.size} rows and {len(df.columns)} columns')
+        engine = self.get_engine()
 
-    def submit_query(self, db_query):
+        # create, replace or check the table before loading so keys can be set while it is empty
+        created = if_exists == 'replace' or not engine.has_table(table_name, schema=self.schema)
+        df.head(0).to_sql(name=table_name, con=engine, schema=self.schema, index=False, if_exists=if_exists)
+        if created:
+            self._set_keys(engine, table_name, sort_keys, dist_key)
+
+        if self.staging_path is not None:
+            self._copy(engine, table_name, df, chunksize)
+        else:
+            def write_chunk(chunk, index):
+                chunk.to_sql(name=table_name, con=engine, schema=self.schema, method='multi', index=False,
+                             chunksize=chunksize, if_exists='append')
+
+            self._upload(df, chunksize, write_chunk)
+        logging.info(f'Table \"{table_name}\" created in Redshift with {df.shape[0]} rows and {len(df.columns)} columns')
+
+    def _set_keys(self, engine, table_name, sort_keys, dist_key):
+        """ Sets the sort and distribution keys of an empty table.
+
+        :param sqlalchemy.engine.Engine engine: The engine to connect with.
+        :param str table_name: The table to alter.
+        :param list of str sort_keys: The columns to sort the table by, or None.
+        :param str dist_key: The column to distribute the rows by, or None.
+        """
+        from sqlalchemy import text
+        with engine.begin() as connection:
+            if dist_key:
+                connection.execute(text(f'ALTER TABLE "{self.schema}"."{table_name}" '
+                                        f'ALTER DISTKEY "{dist_key.lower()}"'))
+            if sort_keys:
+                columns = ', '.join(f'"{key.lower()}"' for key in sort_keys)
+                connection.execute(text(f'ALTER TABLE "{self.schema}"."{table_name}" ALTER SORTKEY ({columns})'))
+
+    def _copy(self, engine, table_name, df, chunksize):
+        """ Writes the DataFrame to the staging location as Parquet files with a manifest and loads it with COPY.
+
+        :param sqlalchemy.engine.Engine engine: The engine to connect with.
+        :param str table_name: The table to load into.
+        :param pandas.DataFrame df: The DataFrame to load, with column names matching the table.
+        :param int chunksize: The number of rows in each file.
+        """
+        try:
+            import pyarrow
+        except ImportError as e:
+            from atscale.errors import AtScaleExtrasDependencyImportError
+            raise AtScaleExtrasDependencyImportError('redshift', str(e))
+        from sqlalchemy import text
+
+        prefix = f'{table_name}_{uuid.uuid4().hex}'
+        to_s3 = self.staging_path.startswith('s3://')
+        local_directory = tempfile.mkdtemp(prefix='atscale_') if to_s3 else os.path.join(self.staging_path, prefix)
+        os.makedirs(local_directory, exist_ok=True)
+        remote_directory = f'{self.staging_uri.rstrip("/")}/{prefix}'
+        if to_s3:
+            try:
+                import boto3
+            except ImportError as e:
+                from atscale.errors import AtScaleExtrasDependencyImportError
+                raise AtScaleExtrasDependencyImportError('redshift', str(e))
+            s3 = boto3.client('s3')
+        entries = {}
+        # the key of every object put on S3, deleted once the table is loaded or the load failed
+        uploaded = []
+
+        def write_file(chunk, index):
+            filename = f'part-{index:05d}.parquet'
+            path = os.path.join(local_directory, filename)
+            chunk.to_parquet(path, index=False, compression='snappy', coerce_timestamps='us',
+                             allow_truncated_timestamps=True)
+            if to_s3:
+                bucket, key = f'{remote_directory}/{filename}'[len('s3://'):].split('/', 1)
+                s3.upload_file(path, bucket, key)
+                uploaded.append(key)
+            # Redshift requires the size of every Parquet file listed in a manifest
+            entries[index] = {'url': f'{remote_directory}/{filename}', 'mandatory': True,
+                              'meta': {'content_length': os.path.getsize(path)}}
+            if to_s3:
+                os.remove(path)
+
+        try:
+            self._upload(df, chunksize, write_file)
+            manifest = json.dumps({'entries': [entries[index] for index in sorted(entries)]})
+            if to_s3:
+                bucket, key = f'{remote_directory}/manifest'[len('s3://'):].split('/', 1)
+                s3.put_object(Bucket=bucket, Key=key, Body=manifest.encode())
+                uploaded.append(key)
+            else:
+                with open(os.path.join(local_directory, 'manifest'), 'w') as f:
+                    f.write(manifest)
+
+            credentials = f" IAM_ROLE '{self.iam_role}'" if self.iam_role else ''
+            with engine.begin() as connection:
+                connection.execute(text(f'COPY "{self.schema}"."{table_name}" FROM \'{remote_directory}/manifest\''
+                                        f'{credentials} FORMAT AS PARQUET MANIFEST'))
+        finally:
+            shutil.rmtree(local_directory, ignore_errors=True)
+            if uploaded:
+                bucket = remote_directory[len('s3://'):].split('/', 1)[0]
+                # delete_objects takes at most 1000 keys a request
+                for i in range(0, len(uploaded), 1000):
+                    objects = [{'Key': key} for key in uploaded[i:i + 1000]]
+                    s3.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to Redshift and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        from sqlalchemy import create_engine
-        engine = create_engine(self.connection_string)
-        connection = engine.connect()
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self.get_engine().connect() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
     def get_atscale_connection_id(self):
@@ -1,9 +1,87 @@
 import getpass
+import glob
 import logging
+import os
+import shutil
+import tempfile
+import uuid
 
 import pandas as pd
 
-from database import Database
+from database import Database, is_arrow_output
+
+
+def put_statement(directory, pattern, location, parallel):
+    """ Builds the PUT statement that uploads local files to a stage.
+
+    :param str directory: The local directory of the files.
+    :param str pattern: The file name pattern of the files, such as 'prefix_*.parquet'.
+    :param str location: The stage and path to put the files on.
+    :param int parallel: The number of files uploaded at once.
+    :rtype: str
+    """
+    path = directory.replace(os.sep, '/')
+    return f"PUT 'file://{path}/{pattern}' {location} PARALLEL={max(1, parallel)} AUTO_COMPRESS=FALSE"
+
+
+def copy_statement(schema, table_name, location):
+    """ Builds the COPY INTO statement that loads the Parquet files staged at a location into a table.
+
+    :param str schema: The schema of the table.
+    :param str table_name: The table to load into.
+    :param str location: The stage and path the files were put on.
+    :rtype: str
+    """
+    return (f'COPY INTO "{schema}"."{table_name}" FROM {location} FILE_FORMAT = (TYPE = PARQUET) '
+            f'MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE PURGE = TRUE')
+
+
+class StageExecutor:
+    """Runs the PUT and COPY INTO statements of a Snowflake bulk load on an engine."""
+
+    def __init__(self, engine):
+        """ Creates the executor.
+
+        :param sqlalchemy.engine.Engine engine: The engine to run the statements with.
+        """
+        self.engine = engine
+
+    def stage(self, directory, pattern, location, parallel):
+        """ Puts the local files matching a pattern on a stage, see put_statement.
+        """
+        self._execute(put_statement(directory, pattern, location, parallel))
+
+    def copy_into(self, schema, table_name, location):
+        """ Loads the files staged at a location into a table, see copy_statement.
+        """
+        self._execute(copy_statement(schema, table_name, location))
+
+    def _execute(self, statement):
+        from sqlalchemy import text
+        with self.engine.begin() as connection:
+            connection.execute(text(statement))
+
+
+class RecordingStageExecutor:
+    """Stands in for StageExecutor without connecting, recording the files that would be staged and the COPY INTO
+    statements that would run.
+
+    :var list of dict staged_files: The location, name, rows and bytes of each file staged, in order.
+    :var list of str copy_statements: The COPY INTO statements, in order.
+    """
+
+    def __init__(self):
+        self.staged_files = []
+        self.copy_statements = []
+
+    def stage(self, directory, pattern, location, parallel):
+        import pyarrow.parquet as pq
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            self.staged_files.append({'location': location, 'name': os.path.basename(path),
+                                      'rows': pq.read_metadata(path).num_rows, 'bytes': os.path.getsize(path)})
+
+    def copy_into(self, schema, table_name, location):
+        self.copy_statements.append(copy_statement(schema, table_name, location))
 
 
 class Snowflake(Database):
@@ -11,7 +89,8 @@ class Snowflake(Database):
     An object used for all interaction between AtScale and Snowflake as well as storage of all necessary information
     for the connected Snowflake
     """
-    def __init__(self, atscale_connection_id, username, account, warehouse, database, schema):
+    def __init__(self, atscale_connection_id, username, account, warehouse, database, schema, bulk_load=False,
+                 stage=None, target_file_size=64 * 1024 * 1024, stage_executor=None):
         """ Creates a database connection to allow for writeback to a Snowflake warehouse.
 
         :param str username: The database username.
@@ -19,6 +98,14 @@ class Snowflake(Database):
         :param str warehouse: The database warehouse.
         :param str database: The database name.
         :param str schema: The database schema.
+        :param bool bulk_load: Whether add_table should write the DataFrame to Parquet files, PUT them on a stage and
+        load them with COPY INTO instead of inserting rows. Defaults to False.
+        :param str stage: The stage to PUT files on when bulk loading, for example '@MY_STAGE'. Defaults to None to use
+        the stage of the table being loaded.
+        :param int target_file_size: The approximate uncompressed size in bytes of each file written when bulk loading.
+        Defaults to 64 MB.
+        :param stage_executor: Runs the PUT and COPY INTO statements when bulk loading, such as a
+        RecordingStageExecutor to capture them. Defaults to None to run them with a StageExecutor on the engine.
         """
         try:
             from sqlalchemy import create_engine
@@ -41,6 +128,10 @@ class Snowflake(Database):
         self.schema = schema
         self.atscale_connection_id = atscale_connection_id
         self.connection_string = str(engine.url)
+        self.bulk_load = bulk_load
+        self.stage = stage
+        self.target_file_size = target_file_size
+        self.stage_executor = stage_executor
 
         logging.info('Snowflake db connection created')
 
@@ -51,8 +142,9 @@ class Snowflake(Database):
         :param pandas.DataFrame dataframe: The DataFrame to upload to the table.
         :param int chunksize: the number of rows to insert at a time. Defaults to None to use default value for database.
         :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'. Defaults to 'fail'.
+
+        When bulk_load is set the chunksize is not used, files are sized by target_file_size instead.
         """
-        from sqlalchemy import create_engine
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
@@ -69,23 +161,71 @@ class Snowflake(Database):
         df.columns = df.columns.str.upper()
         table_name = table_name.upper()
 
-        engine = create_engine(self.connection_string)
-        df.to_sql(name=table_name, con=engine, schema=self.schema, method='multi', index=False,
-                  chunksize=chunksize, if_exists=if_exists)
+        engine = self.get_engine()
+
+        if self.bulk_load:
+            self._copy_into(engine, table_name, df, if_exists)
+            logging.info(f'Table \"{table_name}\" loaded into Snowflake with {df.shape[0]} rows and '
+                         f'{len(df.columns)} columns from {len(self.upload_stats["chunks"])} staged files')
+            return
+
+        def write_chunk(chunk, index):
+            # the first chunk creates or replaces the table, the rest are appended concurrently
+            chunk.to_sql(name=table_name, con=engine, schema=self.schema, method='multi', index=False,
+                         chunksize=chunksize, if_exists=if_exists if index == 0 else 'append')
+
+        self._upload(df, chunksize, write_chunk, first_chunk_serial=True)
         logging.info(f'Table \"{table_name}\" created in Snowflake '
                      f'with {df.size} rows and {len(df.columns)} columns \n using chunksize {chunksize}')
 
-    def submit_query(self, db_query):
+    def _copy_into(self, engine, table_name, df, if_exists):
+        """ Loads a DataFrame by writing it to Parquet files in parallel, putting them on a stage and running COPY INTO.
+
+        :param sqlalchemy.engine.Engine engine: The engine to connect with.
+        :param str table_name: The table to load into.
+        :param pandas.DataFrame df: The DataFrame to load, with column names matching the table.
+        :param string if_exists: What to do if the table exists.
+        """
+        try:
+            import pyarrow
+        except ImportError as e:
+            from atscale.errors import AtScaleExtrasDependencyImportError
+            raise AtScaleExtrasDependencyImportError('snowflake', str(e))
+
+        # creates, replaces or checks the table from the column types without inserting rows
+        df.head(0).to_sql(name=table_name, con=engine, schema=self.schema, index=False, if_exists=if_exists)
+
+        bytes_per_row = df.memory_usage(index=False, deep=True).sum() / max(1, df.shape[0])
+        rows_per_file = max(1, int(self.target_file_size / max(1, bytes_per_row)))
+
+        directory = tempfile.mkdtemp(prefix='atscale_')
+        prefix = f'atscale_{uuid.uuid4().hex}'
+        stage = self.stage if self.stage is not None else f'@"{self.schema}".%"{table_name}"'
+
+        def write_file(chunk, index):
+            chunk.to_parquet(os.path.join(directory, f'{prefix}_{index:05d}.parquet'), index=False,
+                             compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
+
+        executor = self.stage_executor if self.stage_executor is not None else StageExecutor(engine)
+        try:
+            self._upload(df, rows_per_file, write_file)
+            executor.stage(directory, f'{prefix}_*.parquet', f'{stage}/{prefix}/', self.upload_workers)
+            executor.copy_into(self.schema, table_name, f'{stage}/{prefix}/')
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to Snowflake and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        from sqlalchemy import create_engine
-        engine = create_engine(self.connection_string)
-        connection = engine.connect()
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self.get_engine().connect() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
     def get_atscale_connection_id(self):
@@ -1,7 +1,7 @@
 import getpass
 import logging
 import pandas as pd
-from database import Database
+from database import Database, executemany_chunk_writer, is_arrow_output
 
 
 class Synapse(Database):
@@ -44,22 +44,21 @@ class Synapse(Database):
 
         logging.info('Synapse db connection created')
 
-    def add_table(self, table_name: str, dataframe: pd.DataFrame, chunksize: int=10000, if_exists: str='fail'):
+    def add_table(self, table_name: str, dataframe: pd.DataFrame, chunksize: int=10000, if_exists: str='fail',
+                  fast_executemany: bool=True):
         """ Creates a table in synapse using a pandas DataFrame.
 
         :param str table_name: The table to insert into.
         :param pandas.DataFrame dataframe: The DataFrame to upload to the table.
         :param int chunksize: the number of rows to insert at a time. Defaults to None to use default value for database.
         :param string if_exists: what to do if the table exists. Valid inputs are 'append', 'replace', and 'fail'. Defaults to 'fail'.
+        :param bool fast_executemany: Whether pyodbc should send each chunk's parameters to the driver as arrays. Defaults to True.
         """
-        import pyodbc as po
         if_exists = if_exists.lower()
         if if_exists not in ['append', 'replace', 'fail']:
             raise Exception(f'Invalid value for parameter \'if_exists\': {if_exists}. '
                             f'Valid values are \'append\', \'replace\', and \'fail\'')
 
-        df = dataframe.copy()
-
         if chunksize is None:
             chunksize=10000
         if int(chunksize) < 1:
@@ -77,72 +76,74 @@ class Synapse(Database):
             '<class \'datetime.date\'>': 'date',
         }
 
-        connection = po.connect(self.connection_string, autocommit=True)
-        cursor = connection.cursor()
-
-        if cursor.tables(table=table_name, schema=self.schema).fetchone():
-            exists = True
-        else:
-            exists = False
+        with self._get_connection_pool().connection() as connection:
+            cursor = connection.cursor()
 
-        if exists and if_exists == 'fail':
-            raise Exception(f'A table named: {table_name} in schema: {self.schema} already exists')
-
-        if exists and if_exists == 'replace':
-            operation = f"DROP TABLE \"{self.schema}\".\"{table_name}\""
-            cursor.execute(operation)
-
-        types = {}
-        for i in dataframe.columns:
-            if str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0])) in conversion_dict_synapse:
-                types[i] = conversion_dict_synapse[str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0]))]
+            if cursor.tables(table=table_name, schema=self.schema).fetchone():
+                exists = True
             else:
-                types[i] = conversion_dict_synapse['<class \'str\'>']
-
-        if not cursor.tables(table=table_name, tableType='TABLE').fetchone():
-            operation = f"CREATE TABLE \"{self.schema}\".\"{table_name}\" ("
-            for key, value in types.items():
-                operation += f"{key} {value}, "
-            operation = operation[:-2]
-            operation += ")"
-            cursor.execute(operation)
-
-        operation = f"INSERT INTO \"{self.schema}\".\"{table_name}\" ("
-        for col in dataframe.columns:
-            operation += f"{col}, "
-        operation = operation[:-2]
-        operation += ") "
-
-        list_df = [dataframe[i:i + chunksize] for i in range(0, dataframe.shape[0], chunksize)]
-        for df in list_df:
-            op_copy = operation
-            for index, row in df.iterrows():
-                op_copy += 'SELECT '
-                for cl in df.columns:
-                    if 'nvarchar' in types[cl] or 'date' in types[cl]:
-                        op_copy += "'{}', ".format(row[cl])
-                    else:
-                        op_copy += "{}, ".format(row[cl])
-                op_copy = op_copy[:-2]
-                op_copy += " UNION ALL "
-            op_copy = op_copy[:-11]
-            cursor.execute(op_copy)
-        connection.close()
+                exists = False
+
+            if exists and if_exists == 'fail':
+                raise Exception(f'A table named: {table_name} in schema: {self.schema} already exists')
+
+            if exists and if_exists == 'replace':
+                operation = f"DROP TABLE \"{self.schema}\".\"{table_name}\""
+                cursor.execute(operation)
+
+            types = {}
+            for i in dataframe.columns:
+                if str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0])) in conversion_dict_synapse:
+                    types[i] = conversion_dict_synapse[str(type(dataframe[i].loc[~dataframe[i].isnull()].iloc[0]))]
+                else:
+                    types[i] = conversion_dict_synapse['<class \'str\'>']
+
+            if not cursor.tables(table=table_name, tableType='TABLE').fetchone():
+                operation = f"CREATE TABLE \"{self.schema}\".\"{table_name}\" ("
+                for key, value in types.items():
+                    operation += f"{key} {value}, "
+                operation = operation[:-2]
+                operation += ")"
+                cursor.execute(operation)
+
+            columns = ', '.join(f"{col}" for col in dataframe.columns)
+            markers = ', '.join('?' for _ in dataframe.columns)
+            operation = f"INSERT INTO \"{self.schema}\".\"{table_name}\" ({columns}) VALUES ({markers})"
+
+        # chunks are inserted concurrently, each bound as arrays of parameters and committed on its own
+        connections = self._writer_connections()
+        try:
+            self._upload(dataframe, chunksize, executemany_chunk_writer(connections, operation, fast_executemany))
+        finally:
+            connections.close()
 
-        logging.info(f'Table \"{table_name}\" created in Synapse with {df.size} rows and {len(df.columns)} columns')
+        logging.info(f'Table \"{table_name}\" created in Synapse with {dataframe.shape[0]} rows and {len(dataframe.columns)} columns')
 
-    def submit_query(self, db_query):
+    def submit_query(self, db_query, output='pandas'):
         """ Submits a query to Synapse and returns the result.
 
         :param str db_query: The query to submit to the database.
+        :param str output: The format of the result, 'pandas' or 'arrow'. Defaults to 'pandas'.
         :return: The queried data.
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or pyarrow.Table
         """
-        import pyodbc as po
-        connection = po.connect(self.connection_string, autocommit=True)
-        df = pd.read_sql_query(db_query, connection)
+        if is_arrow_output(output):
+            return self._submit_query_arrow(db_query)
+        with self._get_connection_pool().connection() as connection:
+            df = pd.read_sql_query(db_query, connection)
         return df
 
+    def _connect(self):
+        import pyodbc as po
+        return po.connect(self.connection_string, autocommit=True)
+
+    def _dbapi_connection(self):
+        return self._get_connection_pool().connection()
+
+    def _stream_connection(self):
+        # pyodbc fetches rows from the open cursor as pandas reads each chunk
+        return self._get_connection_pool().connection()
+
     def get_atscale_connection_id(self):
         return self.atscale_connection_id
 
@@ -0,0 +1,270 @@
+import re
+from html import unescape as _unescape
+
+import numpy as np
+import pandas as pd
+
+
+class QueryResultParser:
+    """Incrementally parses the XML body of a query response into columns.
+
+    The body can be fed in chunks as it is read from the connection. Whenever the body read so far holds complete
+    rows, their cells are matched and appended to their columns and the text is let go of, so only the column values
+    and at most one partial row are held in memory rather than copies of the body. Cells are matched with regular
+    expressions, which is several times faster than an XML parser calling back into Python for every element, and
+    their text is decoded from UTF-8 and unescaped like an XML parser would.
+    """
+
+    _ROWS_END = b'</row>'
+    # a row start, or a cell with whether it is null and its text
+    _TOKEN = re.compile(r'(<row>)|<column( null="true")?\s*(?:/>|>(.*?)</column>)', re.DOTALL)
+    _NAME = re.compile(r'<name>(.*?)</name>', re.DOTALL)
+    _SUCCEEDED = re.compile(r'<succeeded>(.*?)</succeeded>', re.DOTALL)
+    _ERROR = re.compile(r'<error-message>(.*?)</error-message>', re.DOTALL)
+
+    def __init__(self):
+        self._buffer = b''
+        self._outside = []  # the text before the first row and after the last, with the column names and the status
+        self.row_count = 0
+        self.column_names = []
+        self.columns = []
+        self.succeeded = None
+        self.error_message = None
+
+    def feed(self, data):
+        """ Parses the next chunk of the response body.
+
+        :param bytes data: The chunk to parse.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer += data
+        end = self._buffer.rfind(self._ROWS_END)
+        if end < 0:
+            return
+        end += len(self._ROWS_END)
+        # the end of a row is ASCII, so the rows before it decode on their own
+        self._read_rows(self._buffer[:end].decode('utf-8'))
+        self._buffer = self._buffer[end:]
+
+    def close(self):
+        """ Finishes parsing the response body.
+
+        :raises Exception if the response reports that the query failed.
+        """
+        self._outside.append(self._buffer.decode('utf-8'))
+        self._buffer = b''
+        outside = ''.join(self._outside)
+        self._outside = []
+        self.column_names = [_unescape(name) for name in self._NAME.findall(outside)]
+        succeeded = self._SUCCEEDED.search(outside)
+        self.succeeded = succeeded.group(1).strip() if succeeded else None
+        error = self._ERROR.search(outside)
+        self.error_message = _unescape(error.group(1)) if error else None
+        if self.succeeded == 'false':
+            raise Exception(self.error_message)
+
+    def _read_rows(self, text):
+        first = text.find('<row>')
+        if first < 0:
+            self._outside.append(text)
+            return
+        self._outside.append(text[:first])
+        tokens = self._TOKEN.findall(text, first)
+        values = [None if null else (_unescape(value) if '&' in value else value) for _, null, value in tokens]
+        stride = len(self.columns) + 1
+        rows = len(tokens) // stride
+        if self.columns and rows * stride == len(tokens) and text.count('<row>', first) == rows and \
+                all(start for start, _, _ in tokens[::stride]):
+            # every row has a cell for every column, so the cells of a column are every stride-th value
+            for i, column in enumerate(self.columns, 1):
+                column.extend(values[i::stride])
+            self.row_count += rows
+            return
+
+        row = None
+        for (start, _, _), value in zip(tokens, values):
+            if start:
+                if row is not None:
+                    self._add_row(row)
+                row = []
+            else:
+                row.append(value)
+        self._add_row(row)
+
+    def _add_row(self, values):
+        for _ in range(len(self.columns), len(values)):
+            self.columns.append([None] * self.row_count)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        # rows with fewer cells than earlier rows are padded with nulls
+        for column in self.columns[len(values):]:
+            column.append(None)
+        self.row_count += 1
+
+    def to_dataframe(self, column_types=None):
+        """ Builds a DataFrame from the parsed columns, decoding each column once into its target dtype.
+
+        :param dict of str/str column_types: How to decode each column by name, see decode_column. Columns that are
+        not included are converted to numbers if every value is numeric. Defaults to None.
+        :return: A pandas DataFrame.
+        :rtype: pandas.DataFrame
+        """
+        if column_types is None:
+            column_types = {}
+        if not self.columns:
+            return pd.DataFrame(columns=self.column_names)
+        df = pd.DataFrame({i: decode_column(values, column_types.get(name))
+                           for i, (name, values) in enumerate(zip(self.column_names, self.columns))})
+        df.columns = self.column_names
+        return df
+
+    def to_arrow(self, column_types=None):
+        """ Builds a pyarrow Table from the parsed columns without going through pandas.
+
+        :param dict of str/str column_types: How to decode each column by name, see decode_arrow_column. Defaults to
+        None.
+        :return: A pyarrow Table.
+        :rtype: pyarrow.Table
+        """
+        pa = import_pyarrow()
+        if column_types is None:
+            column_types = {}
+        if not self.columns:
+            return pa.table({name: pa.array([], type=pa.string()) for name in self.column_names})
+        return pa.Table.from_arrays([decode_arrow_column(values, column_types.get(name))
+                                     for name, values in zip(self.column_names, self.columns)],
+                                    names=self.column_names)
+
+
+def decode_column(values, column_type=None):
+    """ Converts the text values of a result column into an array of the given type.
+
+    :param list of str values: The values of the column, None for nulls.
+    :param str column_type: One of 'int', 'float', 'datetime', 'bool', 'category' or 'string'. Integer columns
+    containing nulls are decoded as float. Category columns whose values are all numeric, such as years or months,
+    are decoded as numbers like they were before categories were introduced. Defaults to None to convert to numbers
+    only if every value is numeric.
+    :return: The decoded column.
+    :rtype: numpy.ndarray or pandas.Categorical
+    """
+    if column_type == 'category':
+        try:
+            return pd.to_numeric(np.array(values, dtype=object))
+        except (ValueError, TypeError):
+            return pd.Categorical(values)
+    if column_type == 'string':
+        return np.array(values, dtype=object)
+    if column_type == 'datetime':
+        return pd.to_datetime(values, errors='coerce').values
+    if column_type == 'bool':
+        if None in values:
+            return np.array([None if v is None else v.lower() == 'true' for v in values], dtype=object)
+        return np.array([v.lower() == 'true' for v in values], dtype=bool)
+    if column_type in ('int', 'float'):
+        numbers = pd.to_numeric(np.array(values, dtype=object), errors='coerce')
+        if column_type == 'float':
+            return numbers.astype(np.float64, copy=False)
+        return numbers
+    try:
+        return pd.to_numeric(np.array(values, dtype=object))
+    except (ValueError, TypeError):
+        return np.array(values, dtype=object)
+
+
+def import_pyarrow():
+    """ Imports pyarrow, which is only needed for results in the Arrow format.
+
+    :return: The pyarrow module.
+    :raises AtScaleExtrasDependencyImportError if pyarrow is not installed
+    """
+    try:
+        import pyarrow
+    except ImportError as e:
+        from errors import AtScaleExtrasDependencyImportError
+        raise AtScaleExtrasDependencyImportError('arrow', str(e))
+    return pyarrow
+
+
+def decode_arrow_column(values, column_type=None):
+    """ Converts the text values of a result column into an Arrow array of the given type.
+
+    Values are cast by Arrow's own parsers, columns that they reject are decoded with decode_column instead so the
+    results match to_dataframe.
+
+    :param list of str values: The values of the column, None for nulls.
+    :param str column_type: One of 'int', 'float', 'datetime', 'bool', 'category' or 'string', see decode_column.
+    Categories that are not all numeric are dictionary encoded. Defaults to None to convert to numbers only if every
+    value is numeric.
+    :return: The decoded column.
+    :rtype: pyarrow.Array
+    """
+    pa = import_pyarrow()
+    text = pa.array(values, type=pa.string())
+    if column_type == 'string':
+        return text
+    if column_type == 'category':
+        decoded = decode_column(values, column_type)
+        if isinstance(decoded, pd.Categorical):
+            return text.dictionary_encode()
+        return pa.array(decoded, from_pandas=True)
+    if column_type == 'bool':
+        import pyarrow.compute as pc
+        return pc.equal(pc.utf8_lower(text), 'true')
+
+    if column_type == 'datetime':
+        targets = [pa.timestamp('ns')]
+    elif column_type == 'float':
+        targets = [pa.float64()]
+    else:
+        # unlike decode_column, integer columns with nulls stay integers since arrow arrays can hold nulls
+        targets = [pa.int64(), pa.float64()]
+    for target in targets:
+        try:
+            return text.cast(target)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            pass
+    decoded = decode_column(values, column_type)
+    if decoded.dtype == object:
+        return text
+    return pa.array(decoded, from_pandas=True)
+
+
+def sort_arrow_table(table, columns):
+    """ Sorts a pyarrow Table by the given columns in ascending order with nulls last, like DataFrame.sort_values.
+
+    :param pyarrow.Table table: The table to sort.
+    :param list of str columns: The columns to sort by, in order of precedence.
+    :return: The sorted table.
+    :rtype: pyarrow.Table
+    """
+    if not columns:
+        return table
+    pa = import_pyarrow()
+    import pyarrow.compute as pc
+    keys = {}
+    for name in columns:
+        column = table.column(name)
+        # categories are sorted by their values like the categories of a DataFrame
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        keys[name] = column
+    indices = pc.sort_indices(pa.table(keys), sort_keys=[(name, 'ascending') for name in keys])
+    return table.take(indices)
+
+
+def parse_query_response(content):
+    """ Parses the body of a query response.
+
+    :param bytes or iterable of bytes content: The body of the response, or an iterator over chunks of it.
+    :return: The parser holding the decoded columns.
+    :rtype: QueryResultParser
+    """
+    parser = QueryResultParser()
+    if isinstance(content, (bytes, str)):
+        parser.feed(content)
+    else:
+        for chunk in content:
+            parser.feed(chunk)
+    parser.close()
+    return parser
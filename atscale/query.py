@@ -0,0 +1,649 @@
+from abc import ABC, abstractmethod
+import logging
+import re
+import uuid
+
+
+class Param:
+    """A placeholder for a filter value that is bound each time a prepared query is run.
+
+    :var str `~Param.name`: The name the value is bound by.
+    """
+
+    def __init__(self, name):
+        """ Creates a placeholder.
+
+        :param str name: The name the value is bound by.
+        """
+        self.name = name
+
+    def __repr__(self):
+        return f'Param({self.name!r})'
+
+
+def render_literal(value):
+    """ Renders a filter value as it is written in a query, numbers and booleans as is and anything else as a quoted
+    string with its quotes escaped.
+
+    :param value: The value to render.
+    :return: The value as it is written in a query.
+    :rtype: str
+    """
+    if isinstance(value, (int, float, bool)):
+        return f'{value}'
+    text = str(value).replace("'", "''")
+    return f'\'{text}\''
+
+
+def render_column(model_name, feature):
+    """ Renders a reference to a feature of a model.
+
+    :param str model_name: The name of the model.
+    :param str feature: The name of the feature.
+    :return: The quoted column.
+    :rtype: str
+    """
+    model_name = model_name.replace('`', '``')
+    feature = feature.replace('`', '``')
+    return f'`{model_name}`.`{feature}`'
+
+
+def _render_in(values):
+    if not values:
+        from errors import UserError
+        raise UserError('IN filters need at least one value')
+    return '(' + ', '.join(render_literal(x) for x in values) + ')'
+
+
+def _render_between(values):
+    return f'{render_literal(values[0])} and {render_literal(values[1])}'
+
+
+def _render_regex(value):
+    return render_literal(str(value))
+
+
+class _Slot:
+    """A part of a compiled query that is rendered from a bound parameter."""
+
+    def __init__(self, name, render):
+        self.name = name
+        self.render = render
+
+
+class Filter(ABC):
+    """A filter expression that compiles to the WHERE clause of a query.
+
+    Combine filters with And, Or and Not, or with the &, | and ~ operators. Values can be a Param to be bound when a
+    prepared query is run. Two filters are equal when they are the same expression, with the operands of And and Or in
+    any order, so filters can be used in cache keys.
+    """
+
+    @abstractmethod
+    def features(self):
+        """ Lists the features the filter uses.
+
+        :rtype: list of str
+        """
+
+    @abstractmethod
+    def key(self):
+        """ Returns a normalized form of the filter that is the same for equivalent expressions.
+
+        :rtype: tuple
+        """
+
+    @abstractmethod
+    def compile(self, model_name, parts):
+        """ Appends the compiled filter to parts, see render_parts.
+
+        :param str model_name: The name of the model the features are in.
+        :param list parts: The compiled query to append to.
+        """
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+def _value_key(value):
+    if isinstance(value, Param):
+        return ('param', value.name)
+    if isinstance(value, (list, tuple)):
+        return tuple(_value_key(x) for x in value)
+    return (type(value).__name__, value)
+
+
+class _Comparison(Filter):
+    _operator = None
+    _render = staticmethod(render_literal)
+
+    def __init__(self, feature, value):
+        """ Creates the filter.
+
+        :param str feature: The feature to compare.
+        :param value: The value to compare it to, or a Param.
+        """
+        self.feature = feature
+        self.value = value
+
+    def features(self):
+        return [self.feature]
+
+    def key(self):
+        return (self._operator, self.feature, _value_key(self.value))
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.feature!r}, {self.value!r})'
+
+    def compile(self, model_name, parts):
+        prefix = f'({render_column(model_name, self.feature)} {self._operator} '
+        if isinstance(self.value, Param):
+            parts.extend([prefix, _Slot(self.value.name, self._render), ')'])
+        else:
+            parts.append(f'{prefix}{self._render(self.value)})')
+
+
+class Equals(_Comparison):
+    """Keeps rows where the feature equals the value."""
+    _operator = '='
+
+
+class NotEquals(_Comparison):
+    """Keeps rows where the feature does not equal the value."""
+    _operator = '<>'
+
+
+class Greater(_Comparison):
+    """Keeps rows where the feature is greater than the value."""
+    _operator = '>'
+
+
+class GreaterOrEqual(_Comparison):
+    """Keeps rows where the feature is greater than or equal to the value."""
+    _operator = '>='
+
+
+class Less(_Comparison):
+    """Keeps rows where the feature is less than the value."""
+    _operator = '<'
+
+
+class LessOrEqual(_Comparison):
+    """Keeps rows where the feature is less than or equal to the value."""
+    _operator = '<='
+
+
+class Like(_Comparison):
+    """Keeps rows where the feature matches the LIKE pattern."""
+    _operator = 'LIKE'
+
+
+class RLike(_Comparison):
+    """Keeps rows where the feature is matched by the regular expression."""
+    _operator = 'RLIKE'
+    _render = staticmethod(_render_regex)
+
+
+class In(_Comparison):
+    """Keeps rows where the feature is one of the values, given as a list or a Param bound to a list."""
+    _operator = 'IN'
+    _render = staticmethod(_render_in)
+
+    def key(self):
+        if isinstance(self.value, Param):
+            return super().key()
+        return (self._operator, self.feature, tuple(sorted(set(_value_key(x) for x in self.value), key=repr)))
+
+
+class Between(_Comparison):
+    """Keeps rows where the feature is between the values of a (low, high) pair, or a Param bound to one."""
+    _operator = 'BETWEEN'
+    _render = staticmethod(_render_between)
+
+
+class IsNull(Filter):
+    """Keeps rows where the feature is null."""
+    _operator = 'IS NULL'
+
+    def __init__(self, feature):
+        """ Creates the filter.
+
+        :param str feature: The feature to check.
+        """
+        self.feature = feature
+
+    def features(self):
+        return [self.feature]
+
+    def key(self):
+        return (self._operator, self.feature)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.feature!r})'
+
+    def compile(self, model_name, parts):
+        parts.append(f'({render_column(model_name, self.feature)} {self._operator})')
+
+
+class IsNotNull(IsNull):
+    """Keeps rows where the feature is not null."""
+    _operator = 'IS NOT NULL'
+
+
+class _Group(Filter):
+    _operator = None
+
+    def __init__(self, *filters):
+        """ Combines filters.
+
+        :param Filter filters: The filters to combine, at least one.
+        """
+        if not filters:
+            from errors import UserError
+            raise UserError(f'{type(self).__name__} needs at least one filter')
+        # nested groups of the same kind are flattened so they compile without extra parentheses
+        self.filters = []
+        for f in filters:
+            if type(f) == type(self):
+                self.filters.extend(f.filters)
+            else:
+                self.filters.append(f)
+
+    def features(self):
+        return [feature for f in self.filters for feature in f.features()]
+
+    def key(self):
+        return (self._operator, frozenset(f.key() for f in self.filters))
+
+    def __repr__(self):
+        return f'{type(self).__name__}{tuple(self.filters)!r}'
+
+    def compile(self, model_name, parts):
+        parts.append('(')
+        for i, f in enumerate(self.filters):
+            if i:
+                parts.append(f' {self._operator} ')
+            f.compile(model_name, parts)
+        parts.append(')')
+
+
+class And(_Group):
+    """Keeps rows that pass every filter."""
+    _operator = 'and'
+
+
+class Or(_Group):
+    """Keeps rows that pass any of the filters."""
+    _operator = 'or'
+
+
+class Not(Filter):
+    """Keeps rows that do not pass the filter."""
+
+    def __init__(self, filter):
+        """ Negates a filter.
+
+        :param Filter filter: The filter to negate.
+        """
+        self.filter = filter
+
+    def features(self):
+        return self.filter.features()
+
+    def key(self):
+        return ('NOT', self.filter.key())
+
+    def __repr__(self):
+        return f'Not({self.filter!r})'
+
+    def compile(self, model_name, parts):
+        parts.append('(NOT ')
+        self.filter.compile(model_name, parts)
+        parts.append(')')
+
+
+def filters_from_arguments(filter_equals=None, filter_greater=None, filter_less=None, filter_greater_or_equal=None,
+                           filter_less_or_equal=None, filter_not_equal=None, filter_in=None, filter_between=None,
+                           filter_like=None, filter_rlike=None, filter_null=None, filter_not_null=None,
+                           filters=None):
+    """ Builds the filter expression for the filter arguments of get_data, see AtScale.get_data.
+
+    :param Filter filters: An expression that is ANDed with the filter_* arguments. Defaults to None.
+    :return: The filters combined with And, or None if there are no filters.
+    :rtype: Filter
+    """
+    conditions = []
+    for kind, arguments in [(Equals, filter_equals), (Greater, filter_greater), (Less, filter_less),
+                            (GreaterOrEqual, filter_greater_or_equal), (LessOrEqual, filter_less_or_equal),
+                            (NotEquals, filter_not_equal), (Like, filter_like), (RLike, filter_rlike),
+                            (In, filter_in), (Between, filter_between)]:
+        if arguments:
+            conditions.extend(kind(feature, value) for feature, value in arguments.items())
+    for kind, arguments in [(IsNull, filter_null), (IsNotNull, filter_not_null)]:
+        if arguments:
+            if type(arguments) != list:
+                arguments = [arguments]
+            conditions.extend(kind(feature) for feature in arguments)
+    if filters is not None:
+        if not isinstance(filters, Filter):
+            from errors import UserError
+            raise UserError(f'Make sure that Argument: \'{filters}\' is a Filter')
+        conditions.append(filters)
+    if not conditions:
+        return None
+    return And(*conditions)
+
+
+def compile_where(model_name, expression):
+    """ Compiles a filter expression into the parts of a WHERE clause.
+
+    Values that are a Param are left as slots to be filled in by render_parts, every other value is rendered once.
+
+    :param str model_name: The name of the model the features are in.
+    :param Filter expression: The filters, or None for no filters.
+    :return: The parts of the clause, an empty list if there are no filters.
+    :rtype: list
+    """
+    if expression is None:
+        return []
+    parts = [' WHERE ']
+    if not isinstance(expression, And):
+        # the clause is always wrapped like a group so a single filter compiles like the legacy arguments
+        expression = And(expression)
+    expression.compile(model_name, parts)
+    parts.append(' GROUP BY 1')
+    return _merge_strings(parts)
+
+
+def _merge_strings(parts):
+    # joins runs of plain strings so rendering only has to visit the slots
+    merged = []
+    for part in parts:
+        if isinstance(part, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += part
+        else:
+            merged.append(part)
+    return merged
+
+
+def param_names(parts):
+    """ Lists the names of the parameters a compiled query needs.
+
+    :param list parts: The compiled query.
+    :return: The names in the order they first appear.
+    :rtype: list of str
+    """
+    names = []
+    for part in parts:
+        if isinstance(part, _Slot) and part.name not in names:
+            names.append(part.name)
+    return names
+
+
+def render_parts(parts, values=None):
+    """ Renders a compiled query with the given parameter values.
+
+    :param list parts: The compiled query.
+    :param dict values: The value of each parameter by name. Defaults to None for a query without parameters.
+    :return: The query.
+    :rtype: str
+    :raises UserError if a parameter is missing a value or a value is given for an unknown parameter
+    """
+    if values is None:
+        values = {}
+    rendered = []
+    used = set()
+    for part in parts:
+        if isinstance(part, str):
+            rendered.append(part)
+            continue
+        if part.name not in values:
+            from errors import UserError
+            raise UserError(f'No value was given for parameter: \'{part.name}\'')
+        used.add(part.name)
+        rendered.append(part.render(values[part.name]))
+    unknown = set(values) - used
+    if unknown:
+        from errors import UserError
+        raise UserError(f'Unknown parameters: {sorted(unknown)}')
+    return ''.join(rendered)
+
+
+def _portable_literal(value):
+    # a value renders the same in every database's SQL unless it is a string with quotes or backslashes to escape
+    if not isinstance(value, (int, float, bool)) and ("'" in str(value) or '\\' in str(value)):
+        return None
+    return render_literal(value)
+
+
+def _literal_kind(value):
+    # numbers render unquoted and anything else but booleans as a quoted string, see render_literal
+    if isinstance(value, bool):
+        return None
+    return 'numeric' if isinstance(value, (int, float)) else 'string'
+
+
+def _value_kind(render, value):
+    """ Finds the kind of literals a bound value renders to in a slot, which the placeholders it is planned with must
+    match.
+
+    :param callable render: The renderer of the slot.
+    :param value: The bound value.
+    :return: 'numeric' or 'string', a pair of them for a between, or None for booleans and lists of mixed kinds, which
+    are not planned with placeholders.
+    :rtype: str or tuple
+    """
+    if render is _render_regex:
+        return 'string'
+    if render is _render_between:
+        kinds = (_literal_kind(value[0]), _literal_kind(value[1]))
+        return None if None in kinds else kinds
+    if render is _render_in:
+        kinds = {_literal_kind(x) for x in value}
+        return kinds.pop() if len(kinds) == 1 else None
+    return _literal_kind(value)
+
+
+def _sentinel(kind):
+    # a value of the kind that renders to a literal found nowhere else in the query, numbers have fifteen digits so a
+    # double still holds them exactly
+    if kind == 'numeric':
+        return 10 ** 14 + uuid.uuid4().int % (9 * 10 ** 14)
+    return f'atscale_param_{uuid.uuid4().hex}'
+
+
+def _literal_pattern(literal):
+    # numbers must not match part of a longer number, or one the planner wrote with a fraction or an exponent
+    if literal.startswith("'"):
+        return re.escape(literal)
+    return rf'(?<![\w.]){re.escape(literal)}(?![\w.])'
+
+
+def _placeholder(render, kind):
+    """ Builds a placeholder value for a slot that translates to unique literals of the kind of the bound value in the
+    database query.
+
+    :param callable render: The renderer of the slot.
+    :param kind: The kind of the bound value, see _value_kind.
+    :return: The value to render the slot with, the literals it renders to with the text each one must appear in,
+    and a function returning the database literal to put in place of each of them for a bound value, or None if a
+    bound value can not be put in without the database's escaping.
+    :rtype: tuple
+    """
+    if render is _render_between:
+        low, high = _sentinel(kind[0]), _sentinel(kind[1])
+        low_literal, high_literal = render_literal(low), render_literal(high)
+
+        def substitute(value):
+            literals = {low_literal: _portable_literal(value[0]), high_literal: _portable_literal(value[1])}
+            return None if None in literals.values() else literals
+        return (low, high), [(low_literal, low_literal), (high_literal, high_literal)], substitute
+    token = _sentinel(kind)
+    token_literal = render_literal(token)
+    if render is _render_in:
+        def substitute(value):
+            literals = [_portable_literal(x) for x in value]
+            return None if None in literals else {token_literal: ', '.join(literals)}
+        # the list must still be in parentheses, the planner may have turned an IN of one value into an equals
+        return [token], [(token_literal, f'({token_literal})')], substitute
+
+    def substitute(value):
+        literal = _portable_literal(str(value) if render is _render_regex else value)
+        return None if literal is None else {token_literal: literal}
+    return token, [(token_literal, token_literal)], substitute
+
+
+class PreparedQuery:
+    """A get_data query whose features and filters were validated and compiled once, to be run many times with new
+    filter values.
+
+    Create one with AtScale.prepare_query and pass the value of each Param to the run functions by name.
+
+    :var list of str `~PreparedQuery.features`: The features queried.
+    :var list of str `~PreparedQuery.params`: The names of the parameters that need a value.
+    """
+
+    def __init__(self, atscale, features, parts, atscale_parts, categorical_features):
+        """ Creates a prepared query, see AtScale.prepare_query.
+
+        :param AtScale atscale: The AtScale object the query runs against.
+        :param list of str features: The features queried.
+        :param list parts: The compiled query submitted by get_data.
+        :param list atscale_parts: The compiled query translated by get_data_direct.
+        :param list of str categorical_features: The categorical features queried, which the results are sorted by.
+        """
+        self.atscale = atscale
+        self.features = features
+        self.params = param_names(parts)
+        self._parts = parts
+        self._atscale_parts = atscale_parts
+        self._categorical_features = categorical_features
+        # the renderer of each parameter's slots, None if a parameter fills slots that render differently
+        self._renders = {}
+        for part in atscale_parts:
+            if isinstance(part, _Slot) and self._renders.setdefault(part.name, part.render) is not part.render:
+                self._renders = None
+                break
+        self._db_templates = {}
+        self._db_template_version = None
+
+    def render(self, values=None):
+        """ Renders the query get_data submits.
+
+        :param dict values: The value of each parameter by name. Defaults to None.
+        :return: The query.
+        :rtype: str
+        """
+        return render_parts(self._parts, values)
+
+    def generate_atscale_query(self, values=None):
+        """ Renders the query get_data_direct translates, see AtScale.generate_atscale_query.
+
+        :param dict values: The value of each parameter by name. Defaults to None.
+        :return: An AtScale query string.
+        :rtype: str
+        """
+        return render_parts(self._atscale_parts, values)
+
+    def get_data(self, values=None, useAggs=True, genAggs=False, fakeResults=False, dryRun=False, useLocalCache=True,
+                 useAggregateCache=True, timeout=2, output='pandas'):
+        """ Runs the query with the given values, see AtScale.get_data for a description of the other parameters.
+
+        :param dict values: The value of each parameter by name. Defaults to None.
+        :return: A pandas DataFrame containing the query results.
+        :rtype: pandas.DataFrame or pyarrow.Table
+        """
+        return self.atscale._run_get_data_query(self.render(values), self._categorical_features, useAggs, genAggs,
+                                                fakeResults, dryRun, useLocalCache, useAggregateCache, timeout,
+                                                output)
+
+    def get_data_direct(self, values=None, chunksize=None, output='pandas'):
+        """ Runs the query directly against the database with the given values, see AtScale.get_data_direct.
+
+        The query is translated to a database query once per published version of the project and kinds of values, with
+        a unique number or string literal in place of each parameter, and the values are put in place of those literals
+        each time it is run, so new values do not go back to the query planner. Values that would need the database's
+        own escaping, strings with quotes or backslashes, booleans and lists of both numbers and strings are translated
+        with the query by AtScale.generate_db_query instead, as are all values when the planner did not keep the
+        literals as they were written.
+
+        :param dict values: The value of each parameter by name. Defaults to None.
+        :param int chunksize: The most rows in each chunk when streaming the results. Defaults to None.
+        :param str output: 'pandas' or 'arrow'. Defaults to 'pandas'.
+        :return: the queried data
+        :rtype: pandas.DataFrame, pyarrow.Table or an iterator of either
+        """
+        return self.atscale._submit_db_query(self.generate_db_query(values), chunksize, output)
+
+    def generate_db_query(self, values=None):
+        """ Renders the database query get_data_direct submits, see get_data_direct.
+
+        :param dict values: The value of each parameter by name. Defaults to None.
+        :return: A database query string.
+        :rtype: str
+        """
+        # rendering checks every parameter has a value and no unknown ones are given
+        atscale_query = self.generate_atscale_query(values)
+        if not self.params:
+            return self.atscale.generate_db_query(atscale_query)
+        if self._db_template_version != self.atscale._published_version:
+            self._db_templates = {}
+            self._db_template_version = self.atscale._published_version
+        kinds = None
+        if self._renders is not None:
+            kinds = tuple(_value_kind(render, values[name]) for name, render in self._renders.items())
+        if kinds is not None and None not in kinds:
+            if kinds not in self._db_templates:
+                self._db_templates[kinds] = self._translate_template(kinds)
+            template = self._db_templates[kinds]
+            if template is not None:
+                db_query, substitutes = template
+                literals = {}
+                for name, substitute in substitutes.items():
+                    replacement = substitute(values[name])
+                    if replacement is None:
+                        break
+                    literals.update(replacement)
+                else:
+                    return re.sub('|'.join(_literal_pattern(literal) for literal in literals),
+                                  lambda m: literals[m.group(0)], db_query)
+        return self.atscale.generate_db_query(atscale_query)
+
+    def _translate_template(self, kinds):
+        """ Translates the query with a placeholder literal for each parameter, see _placeholder.
+
+        :param tuple kinds: The kind of the value of each parameter, in the order of the renderers, see _value_kind.
+        :return: The database query and the substitute function of each parameter by name, or None if the planner did
+        not keep every placeholder as it was written.
+        :rtype: tuple
+        """
+        placeholders = {}
+        substitutes = {}
+        expected = []
+        for (name, render), kind in zip(self._renders.items(), kinds):
+            placeholders[name], contexts, substitutes[name] = _placeholder(render, kind)
+            expected.extend(contexts)
+        try:
+            db_query = self.atscale.generate_db_query(render_parts(self._atscale_parts, placeholders))
+        except Exception as e:
+            logging.debug(f'Unable to translate the prepared query with placeholders: {e}')
+            return None
+        for literal, context in expected:
+            found = len(re.findall(_literal_pattern(literal), db_query))
+            if context not in db_query or not found == db_query.count(literal) == db_query.count(context):
+                logging.debug(f'The planner rewrote the placeholder {literal}, values will be translated with the '
+                              f'query each time')
+                return None
+        return db_query, substitutes
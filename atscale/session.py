@@ -0,0 +1,103 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class AtScaleSession:
+    """A connection-pooled, keep-alive HTTP session shared by every REST and XMLA call made to an AtScale server.
+
+    Connections to the design center and engine are kept open and reused between calls instead of paying a new
+    TCP and TLS handshake per request. Authentication is added to each request and a 401 or 403 response triggers
+    a single token refresh and retry.
+    """
+
+    def __init__(self, token_provider=None, on_unauthorized=None, pool_connections=10, pool_maxsize=10,
+                 max_retries=0, timeout=None, keep_alive=True):
+        """ Creates the pooled session.
+
+        :param callable token_provider: Called with no arguments to get the current API token. Defaults to None to
+        send requests without a bearer token.
+        :param callable on_unauthorized: Called with no arguments to refresh the token when a request is rejected
+        with a 401 or 403. Defaults to None to not retry rejected requests.
+        :param int pool_connections: The number of hosts to keep connection pools for. Defaults to 10.
+        :param int pool_maxsize: The maximum number of connections kept open to a single host. Defaults to 10.
+        :param int max_retries: The number of times to retry failed connection attempts. Defaults to 0.
+        :param float timeout: The number of seconds to wait for the server before giving up, or a (connect, read)
+        tuple. Defaults to None to wait indefinitely.
+        :param bool keep_alive: Whether connections should be kept open between requests. Defaults to True.
+        """
+        if int(pool_connections) < 1 or int(pool_maxsize) < 1:
+            from errors import UserError
+            raise UserError('pool_connections and pool_maxsize must be greater than 0')
+
+        self.token_provider = token_provider
+        self.on_unauthorized = on_unauthorized
+        self.timeout = timeout
+        self._refresh_lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
+    def build_headers(self, headers, authenticate):
+        """ Adds the default content type and the bearer token to the given headers.
+
+        :param dict headers: The headers passed in by the caller, these take precedence over the defaults.
+        :param bool authenticate: Whether the bearer token should be added.
+        :return: The headers to send.
+        :rtype: dict
+        """
+        request_headers = {'Content-type': 'application/json'}
+        if authenticate and self.token_provider is not None:
+            request_headers['Authorization'] = f'Bearer {self.token_provider()}'
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    def request(self, method, url, headers=None, authenticate=True, **kwargs):
+        """ Sends a request over the pooled connections, refreshing the token and retrying once if it is rejected.
+
+        :param str method: The HTTP method to use.
+        :param str url: The url to send the request to.
+        :param dict headers: Headers to add to or override the defaults. Defaults to None.
+        :param bool authenticate: Whether to add the bearer token and retry on a 401 or 403. Defaults to True.
+        :param kwargs: Any other keyword arguments accepted by requests.Session.request.
+        :return: The server's response.
+        :rtype: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        request_headers = self.build_headers(headers, authenticate)
+        response = self._session.request(method, url, headers=request_headers, **kwargs)
+        if authenticate and self.on_unauthorized is not None and response.status_code in (401, 403):
+            response.close()
+            with self._refresh_lock:
+                # requests on other threads may have been rejected at the same time, only refresh once
+                if self.build_headers(headers, authenticate) == request_headers:
+                    logging.info('Invalid authentication, if you created this instance with a token, you need a new '
+                                 'one')
+                    self.on_unauthorized()
+            response = self._session.request(method, url, headers=self.build_headers(headers, authenticate),
+                                             **kwargs)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        """ Closes all pooled connections.
+        """
+        self._session.close()
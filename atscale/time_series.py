@@ -0,0 +1,1258 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+ROLLING_STATS = ('sum', 'avg', 'stddev', 'min', 'max')
+
+
+def group_positions(dataframe, group_features=None):
+    """ Finds where each row sits within its group of a frame sorted by the group features.
+
+    :param pandas.DataFrame dataframe: The frame, sorted so the rows of each group are contiguous.
+    :param list of str group_features: The features the rows are grouped by. Defaults to None for a single group.
+    :return: The position of each row within its group, and whether each row has a value for every group feature,
+    or None if there are no group features.
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+    """
+    n = dataframe.shape[0]
+    rows = np.arange(n)
+    if not group_features:
+        return rows, None
+    valid = dataframe[group_features].notna().all(axis=1).to_numpy()
+    starts = np.zeros(n, dtype=bool)
+    starts[:1] = True
+    for feature in group_features:
+        codes, _ = pd.factorize(dataframe[feature])
+        starts[1:] |= codes[1:] != codes[:-1]
+    return rows - np.maximum.accumulate(np.where(starts, rows, 0)), valid
+
+
+def group_codes(dataframe, keys):
+    """ Numbers the groups of a frame, the rows of a group do not need to be contiguous.
+
+    :param pandas.DataFrame dataframe: The frame.
+    :param list of str keys: The features the rows are grouped by.
+    :return: The number of each row's group, -1 for rows missing a key.
+    :rtype: numpy.ndarray
+    """
+    return dataframe.groupby(keys, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+
+def shift(values, periods):
+    """ Shifts values like pandas.Series.shift, filling with NaN.
+
+    :param numpy.ndarray values: The values to shift.
+    :param int periods: The number of rows to shift forward by, negative to shift backward.
+    :return: The shifted values.
+    :rtype: numpy.ndarray
+    """
+    n = len(values)
+    result = np.full(n, np.nan)
+    if periods == 0:
+        result[:] = values
+    elif 0 < periods < n:
+        result[periods:] = values[:n - periods]
+    elif 0 < -periods < n:
+        result[:n + periods] = values[-periods:]
+    return result
+
+
+def shift_packed(values, valid, periods):
+    """ Shifts values the way generate_time_series_features always has for rolling stats of grouped rows.
+
+    The stats of rows that have a group are packed to the front in group order, then shifted across group boundaries.
+    This matches assigning the reset result of a pandas groupby rolling to the frame.
+
+    :param numpy.ndarray values: The stats of each row.
+    :param numpy.ndarray valid: Whether each row has a group, None if every row does.
+    :param int periods: The number of rows to shift forward by.
+    :return: The values as they are added to the frame.
+    :rtype: numpy.ndarray
+    """
+    if valid is None or valid.all():
+        return shift(values, periods)
+    packed = values[valid]
+    result = np.full(len(values), np.nan)
+    result[:len(packed)] = shift(packed, periods)
+    return result
+
+
+def _window_blocks(values, interval):
+    """ Reduces every window of interval consecutive values to its sum, sum of squared deviations, min and max.
+
+    Blocks of 1, 2, 4, ... values are built by merging pairs of the blocks below them, and each window is merged from
+    the blocks of the binary representation of interval, largest first. This takes O(log interval) array operations,
+    and because every window is merged from the same blocks in the same order its result only depends on its values.
+    Squared deviations are merged with Chan's parallel update so they stay accurate for large values.
+    """
+    total = values
+    squares = np.zeros(len(values))
+    low = values
+    high = values
+    window = None
+    size = 1
+    offset = 0
+    blocks = {}
+    for bit in range(interval.bit_length()):
+        if bit:
+            half = size
+            size *= 2
+            length = len(total) - half
+            mean_delta = total[half:half + length] / half - total[:length] / half
+            squares = squares[:length] + squares[half:half + length] + mean_delta * mean_delta * (half / 2)
+            total = total[:length] + total[half:half + length]
+            low = np.minimum(low[:length], low[half:half + length])
+            high = np.maximum(high[:length], high[half:half + length])
+        if interval >> bit & 1:
+            blocks[bit] = (size, total, squares, low, high)
+
+    m = len(values) - interval + 1
+    for bit in sorted(blocks, reverse=True):
+        size, total, squares, low, high = blocks[bit]
+        part = (total[offset:offset + m], squares[offset:offset + m], low[offset:offset + m], high[offset:offset + m])
+        if window is None:
+            window = part
+            merged = size
+        else:
+            mean_delta = part[0] / size - window[0] / merged
+            window = (window[0] + part[0],
+                      window[1] + part[1] + mean_delta * mean_delta * (merged * size / (merged + size)),
+                      np.minimum(window[2], part[2]), np.maximum(window[3], part[3]))
+            merged += size
+        offset += size
+    return window
+
+
+_BLOCK_ROWS = 1 << 18  # windows reduced at a time, bounds the memory used by the blocks of each window
+
+
+def rolling_stats(values, positions, interval):
+    """ Computes the sum, mean, sample standard deviation, min and max over the trailing window of each row.
+
+    A row only has stats if its window holds interval rows of its own group and no nulls, like
+    pandas.Series.rolling(interval). The stats of a row depend only on the values in its window, see _window_blocks.
+
+    :param numpy.ndarray values: The float values, sorted by group.
+    :param numpy.ndarray positions: The position of each row within its group, see group_positions.
+    :param int interval: The number of rows in each window, at least 2.
+    :return: The stats by name, see ROLLING_STATS.
+    :rtype: dict of str/numpy.ndarray
+    """
+    n = len(values)
+    stats = {stat: np.full(n, np.nan) for stat in ROLLING_STATS}
+    # the window of row i starts at row i - interval + 1
+    for start in range(0, n - interval + 1, _BLOCK_ROWS):
+        stop = min(start + _BLOCK_ROWS, n - interval + 1)
+        total, squares, low, high = _window_blocks(values[start:stop + interval - 1], interval)
+        std = np.sqrt(squares / (interval - 1))
+        # constant windows have no spread
+        std[low == high] = 0.0
+        rows = slice(start + interval - 1, stop + interval - 1)
+        for stat, result in zip(ROLLING_STATS, (total, total / interval, std, low, high)):
+            stats[stat][rows] = result
+
+    incomplete = positions < interval - 1
+    for result in stats.values():
+        result[incomplete] = np.nan
+    return stats
+
+
+def lag(values, positions, valid, interval):
+    """ Gets the value interval rows back within each row's group.
+
+    :param numpy.ndarray values: The float values, sorted by group.
+    :param numpy.ndarray positions: The position of each row within its group, see group_positions.
+    :param numpy.ndarray valid: Whether each row has a group, None if every row does.
+    :param int interval: The number of rows back.
+    :return: The lagged values.
+    :rtype: numpy.ndarray
+    """
+    result = shift(values, interval)
+    result[positions < interval] = np.nan
+    if valid is not None:
+        result[~valid] = np.nan
+    return result
+
+
+def cumsum_by(values, codes, initial=None):
+    """ Sums values cumulatively within each group in row order, skipping nulls like pandas GroupBy.cumsum.
+
+    :param numpy.ndarray values: The float values.
+    :param numpy.ndarray codes: The group of each row, see group_codes.
+    :param numpy.ndarray initial: The total each group starts from, by group, NaN for groups that start from nothing.
+    Defaults to None for every group to start from nothing.
+    :return: The running totals, NaN for null values and rows without a group, and the final total of each group.
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+    """
+    result = np.full(len(values), np.nan)
+    finals = np.full(int(codes.max()) + 1 if len(codes) else 0, np.nan)
+    if len(values) == 0:
+        return result, finals
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    for rows in np.split(order, bounds):
+        code = codes[rows[0]]
+        if code < 0:
+            continue
+        group_values = values[rows]
+        nulls = np.isnan(group_values)
+        addends = np.where(nulls, 0.0, group_values)
+        if initial is not None and not np.isnan(initial[code]):
+            # the total is carried in as the first addend, so it is summed in the same order as the full history
+            totals = np.cumsum(np.concatenate([initial[code:code + 1], addends]))[1:]
+        else:
+            totals = np.cumsum(addends)
+        finals[code] = totals[-1]
+        totals[nulls] = np.nan
+        result[rows] = totals
+    return result, finals
+
+
+def to_date_levels(levels, level):
+    """ Lists the levels above the given level that to date features are added for, from lowest to highest.
+
+    :param list of str levels: The levels of the time hierarchy in the frame, from highest to lowest.
+    :param str level: The level of the rows.
+    :rtype: list of str
+    """
+    found = False
+    result = []
+    for heir_level in reversed(levels):
+        if found:
+            result.append(heir_level)
+        if heir_level == level:
+            found = True
+    return result
+
+
+def _as_dtype_of(values, series):
+    # shifting keeps narrower float columns in their dtype, every other column becomes float64
+    if series.dtype.kind == 'f' and series.dtype != np.float64:
+        return values.astype(series.dtype)
+    return values
+
+
+def raw_features(values, positions, valid, codes, intervals):
+    """ Computes the features of one numeric feature that only depend on the rows of each group, before any shift.
+
+    :param numpy.ndarray values: The float values, sorted by group.
+    :param numpy.ndarray positions: The position of each row within its group, see group_positions.
+    :param numpy.ndarray valid: Whether each row has a group, None if every row does.
+    :param list of numpy.ndarray codes: The groups of each to date level, see group_codes.
+    :param list of int intervals: The intervals to create features over.
+    :return: The rolling stats and lag of each interval, then the running total of each to date level.
+    :rtype: list of numpy.ndarray
+    """
+    columns = []
+    for interval in intervals:
+        if interval > 1:
+            stats = rolling_stats(values, positions, interval)
+            columns.extend(stats[stat] for stat in ROLLING_STATS)
+        columns.append(lag(values, positions, valid, interval))
+    for level_codes in codes:
+        columns.append(cumsum_by(values, level_codes)[0])
+    return columns
+
+
+def _raw_feature_count(intervals, heir_levels):
+    return sum(len(ROLLING_STATS) + 1 if interval > 1 else 1 for interval in intervals) + len(heir_levels)
+
+
+def _feature_columns(feature, intervals, time_name, heir_levels):
+    # names the raw features of raw_features in order, along with whether each is a rolling stat, lag or to date total
+    for interval in intervals:
+        name = feature + f'_{interval}_{time_name}_'
+        if interval > 1:
+            for stat in ROLLING_STATS:
+                yield f'{name}{stat}', 'stat'
+        yield f'{name}lag', 'lag'
+    for heir_level in heir_levels:
+        yield f'{feature}_{heir_level}_to_date', 'to_date'
+
+
+def _column_shift(kind, valid, grouped, shift_amount):
+    # the rows a kind of raw feature is packed to and the periods it is shifted by across the whole frame
+    if kind == 'stat':
+        return valid, shift_amount
+    if kind == 'lag':
+        return None, 0 if grouped else shift_amount
+    return None, 1
+
+
+def _add_features(columns, feature, series, raw, intervals, time_name, heir_levels, valid, grouped, shift_amount,
+                  edges=None):
+    # shifts the raw features across the whole frame, the way the features have always been shifted, and names them.
+    # The raw values the shifts move out of the frame are kept in edges, see TimeSeriesState
+    for (name, kind), values in zip(_feature_columns(feature, intervals, time_name, heir_levels), raw):
+        packed_rows, periods = _column_shift(kind, valid, grouped, shift_amount)
+        if edges is not None:
+            edges[name] = _edges(values, packed_rows, periods)
+        shifted = shift_packed(values, packed_rows, periods)
+        columns[name] = _as_dtype_of(shifted, series) if kind == 'lag' else shifted
+
+
+def _edges(values, valid, periods):
+    # the packed values a shift by periods moves out of the frame, at its start and at its end
+    packed = values if valid is None or valid.all() else values[valid]
+    return packed[:max(-periods, 0)].copy(), packed[max(len(packed) - max(periods, 0), 0):].copy()
+
+
+def partition_bounds(positions, partitions):
+    """ Splits the rows of a frame sorted by group into contiguous ranges of about the same size, without
+    splitting any group.
+
+    :param numpy.ndarray positions: The position of each row within its group, see group_positions.
+    :param int partitions: The most ranges to split the rows into.
+    :return: The first row of each range, followed by the number of rows.
+    :rtype: list of int
+    """
+    n = len(positions)
+    starts = np.flatnonzero(positions == 0)
+    targets = np.arange(1, partitions) * n / partitions
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)] if len(starts) else []
+    return sorted({0, n} | {int(cut) for cut in cuts if 0 < cut < n})
+
+
+def _share(array, blocks):
+    # copies an array into a new shared memory block, returning what a worker needs to attach to it
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str, os.getpid()
+
+
+@contextmanager
+def _attach(specs):
+    # the blocks belong to the process that created them, so workers only attach and close. Before Python 3.13
+    # attaching also registers a block with the resource tracker, and a worker process with a tracker of its own would
+    # report the block as leaked and try to unlink it again when it exits, so registering is skipped in workers
+    if sys.version_info >= (3, 13):
+        blocks = [shared_memory.SharedMemory(name=name, track=False) for name, _, _, _ in specs]
+    elif all(owner == os.getpid() for _, _, _, owner in specs):
+        blocks = [shared_memory.SharedMemory(name=name) for name, _, _, _ in specs]
+    else:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            blocks = [shared_memory.SharedMemory(name=name) for name, _, _, _ in specs]
+        finally:
+            resource_tracker.register = register
+    try:
+        yield [np.ndarray(shape, dtype=dtype, buffer=block.buf) for block, (_, shape, dtype, _) in zip(blocks, specs)]
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _compute_partition(specs, start, stop, intervals):
+    # runs in a worker, writing the raw features of rows start to stop of every numeric feature into the output block
+    with _attach(specs) as (values, positions, valid, codes, output):
+        count = output.shape[0] // values.shape[0]
+        level_codes = [row[start:stop] for row in codes]
+        for i in range(values.shape[0]):
+            raw = raw_features(values[i, start:stop], positions[start:stop], valid[start:stop], level_codes, intervals)
+            for j, column in enumerate(raw):
+                output[i * count + j, start:stop] = column
+            del raw
+        del level_codes
+
+
+@contextmanager
+def _partitioned_raw_features(matrix, positions, valid, codes, intervals, count, executor, partitions):
+    # computes the raw features of each range of groups in the executor, sharing the arrays through shared memory
+    # instead of pickling them, and yields views of the raw features of each numeric feature that are only valid
+    # until the context exits
+    blocks = []
+    try:
+        specs = [_share(matrix, blocks), _share(positions, blocks), _share(valid, blocks), _share(codes, blocks),
+                 _share(np.empty((matrix.shape[0] * count, matrix.shape[1])), blocks)]
+        bounds = partition_bounds(positions, partitions)
+        futures = [executor.submit(_compute_partition, specs, start, stop, intervals)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+        _, shape, dtype, _ = specs[-1]
+        output = np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf)
+        yield [output[i * count:(i + 1) * count] for i in range(matrix.shape[0])]
+    finally:
+        output = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # a view is still held by a traceback, the memory is freed once it is collected
+                pass
+            block.unlink()
+
+
+def time_series_features(dataframe, numeric_features, levels, level, time_name, intervals, group_features=None,
+                         shift_amount=0, n_jobs=None, executor=None, edges=None, partitions=None):
+    """ Computes the features of AtScale.generate_time_series_features in one pass over each numeric feature.
+
+    The groups are found once and every window stat for every interval is computed from contiguous NumPy arrays. The
+    results match the pandas groupby rolling the features were computed with before, including how the stats are
+    shifted across group boundaries, up to floating point rounding.
+
+    With group features, the rows can be split into ranges of whole groups that are computed in parallel. The ranges
+    share their input and output arrays with the workers through shared memory, and the results are the same as
+    computing every row at once.
+
+    :param pandas.DataFrame dataframe: The frame, sorted by the group features and then the levels.
+    :param list of str numeric_features: The numeric features to use for the calculation.
+    :param list of str levels: The levels of the time hierarchy in the frame, from highest to lowest.
+    :param str level: The level of the rows.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :param list of int intervals: The intervals to create features over.
+    :param list of str group_features: The features to be grouped by. Defaults to None.
+    :param int shift_amount: The lag used to generate the calculated measures. Defaults to 0.
+    :param int n_jobs: The number of processes to compute the groups in, -1 for one per CPU. Defaults to None to
+    compute every row in this process.
+    :param concurrent.futures.Executor executor: An executor to compute the groups in instead of starting processes
+    for n_jobs. Defaults to None.
+    :param dict edges: Filled with the values the shifts move out of the frame by column name, see TimeSeriesState.
+    Defaults to None.
+    :param int partitions: The number of ranges of groups the rows are split into when computing in parallel.
+    Defaults to None for four per job, taking the number of jobs from n_jobs or, when only an executor is given, the
+    number of CPUs.
+    :return: The new columns by name, in the order they are added to the frame.
+    :rtype: dict of str/numpy.ndarray
+    """
+    intervals = [int(interval) for interval in intervals]
+    positions, valid = group_positions(dataframe, group_features)
+    heir_levels = to_date_levels(levels, level)
+    codes = [group_codes(dataframe, (group_features or []) + [heir_level]) for heir_level in heir_levels]
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    parallel = bool(group_features) and len(numeric_features) > 0 and (executor is not None or (n_jobs or 1) > 1)
+
+    columns = {}
+    with np.errstate(invalid='ignore'):
+        if not parallel:
+            for feature in numeric_features:
+                series = dataframe[feature]
+                values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+                raw = raw_features(values, positions, valid, codes, intervals)
+                _add_features(columns, feature, series, raw, intervals, time_name, heir_levels, valid,
+                              bool(group_features), shift_amount, edges)
+            return columns
+
+        matrix = np.stack([dataframe[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+                           for feature in numeric_features])
+        codes = np.array(codes, dtype=np.int64).reshape(len(codes), len(positions))
+        count = _raw_feature_count(intervals, heir_levels)
+        pool = None
+        if executor is None:
+            executor = pool = ProcessPoolExecutor(max_workers=n_jobs)
+        if partitions is None:
+            # a few ranges per worker so a worker that gets larger groups does not hold up the rest
+            partitions = 4 * (n_jobs or os.cpu_count() or 1)
+        try:
+            with _partitioned_raw_features(matrix, positions, valid, codes, intervals, count, executor,
+                                           partitions) as raws:
+                for feature, raw in zip(numeric_features, raws):
+                    _add_features(columns, feature, dataframe[feature], raw, intervals, time_name, heir_levels,
+                                  valid, True, shift_amount, edges)
+                del raws, raw
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    return columns
+
+
+def add_columns(dataframe, columns):
+    """ Adds columns to a frame in one step, columns that already exist are replaced in place.
+
+    :param pandas.DataFrame dataframe: The frame, which is changed if any of the columns already exist.
+    :param dict of str/numpy.ndarray columns: The columns by name.
+    :return: The frame with the columns.
+    :rtype: pandas.DataFrame
+    """
+    new_columns = {}
+    for name, values in columns.items():
+        if name in dataframe.columns:
+            dataframe[name] = values
+        else:
+            new_columns[name] = values
+    if not new_columns:
+        return dataframe
+    return pd.concat([dataframe, pd.DataFrame(new_columns, index=dataframe.index)], axis=1)
+
+
+class TimeSeriesState:
+    """ What update_time_series_features needs to add rows to a frame of time series features without recomputing it.
+
+    This is the settings the features were computed with, the last rows of each group, which hold every window and lag
+    of the next rows, the running to date totals of each group, the raw values that shifting the features across the
+    frame moved out of it and the number of rows of each group in frame order, which places the new rows without
+    sorting the frame. Its size depends on the number of groups, not the number of rows, and it can be pickled.
+    """
+
+    def __init__(self, numeric_features, levels, level, time_name, intervals, group_features, shift_amount, tails,
+                 totals, edges, runs=None):
+        self.numeric_features = numeric_features
+        self.levels = levels
+        self.level = level
+        self.time_name = time_name
+        self.intervals = intervals
+        self.group_features = group_features
+        self.shift_amount = shift_amount
+        self.tails = tails
+        self.totals = totals
+        self.edges = edges
+        self.runs = runs
+
+    @property
+    def heir_levels(self):
+        return to_date_levels(self.levels, self.level)
+
+    @property
+    def feature_names(self):
+        """ The names of the features in the order they are added to the frame.
+
+        :rtype: list of str
+        """
+        return [name for feature in self.numeric_features
+                for name, _ in _feature_columns(feature, self.intervals, self.time_name, self.heir_levels)]
+
+
+def _tails(dataframe, state):
+    # the rows of each group the windows and lags of the next rows of the group reach back to
+    frame = dataframe[(state.group_features or []) + state.levels + state.numeric_features]
+    rows = max(state.intervals)
+    if not state.group_features:
+        return frame.tail(rows).reset_index(drop=True)
+    return frame.groupby(state.group_features, sort=False).tail(rows).reset_index(drop=True)
+
+
+def _totals(dataframe, state, initial=None, running=None):
+    # the final running total of each group of each to date level, carrying on from the initial totals. The running
+    # totals of each row are kept in running by feature and level
+    totals = {}
+    for heir_level in state.heir_levels:
+        keys = (state.group_features or []) + [heir_level]
+        codes = group_codes(dataframe, keys)
+        present = codes >= 0
+        firsts = dataframe.loc[present, keys].assign(_code=codes[present]).drop_duplicates('_code')
+        carried = None
+        if initial is not None:
+            carried = firsts.merge(initial[heir_level], on=keys, how='left')
+        finals = firsts[keys].reset_index(drop=True)
+        for feature in state.numeric_features:
+            values = dataframe[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+            start = None
+            if carried is not None:
+                start = np.full(len(firsts), np.nan)
+                start[carried['_code'].to_numpy()] = carried[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+            result, feature_finals = cumsum_by(values, codes, start)
+            finals[feature] = feature_finals[firsts['_code'].to_numpy()]
+            if running is not None:
+                running[feature, heir_level] = result
+        if initial is not None:
+            finals = pd.concat([initial[heir_level], finals], ignore_index=True)
+            finals = finals.drop_duplicates(subset=keys, keep='last').reset_index(drop=True)
+        totals[heir_level] = finals
+    return totals
+
+
+def window_state(dataframe, numeric_features, levels, level, time_name, intervals, group_features=None,
+                 shift_amount=0, edges=None):
+    """ Saves what update_time_series_features needs to add rows to a frame of time series features.
+
+    :param pandas.DataFrame dataframe: The frame the features were computed for, sorted by the group features and
+    then the levels.
+    :param list of str numeric_features: The numeric features used for the calculation.
+    :param list of str levels: The levels of the time hierarchy in the frame, from highest to lowest.
+    :param str level: The level of the rows.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :param list of int intervals: The intervals the features were created over.
+    :param list of str group_features: The features the rows were grouped by. Defaults to None.
+    :param int shift_amount: The lag used to generate the calculated measures. Defaults to 0.
+    :param dict edges: The edges filled in by time_series_features.
+    :rtype: TimeSeriesState
+    """
+    state = TimeSeriesState(list(numeric_features), list(levels), level, time_name,
+                            [int(interval) for interval in intervals], list(group_features or []) or None,
+                            shift_amount, None, None, dict(edges))
+    state.tails = _tails(dataframe, state)
+    state.runs = _runs(dataframe, state.group_features or [])
+    with np.errstate(invalid='ignore'):
+        state.totals = _totals(dataframe, state)
+    return state
+
+
+def _sorted_order(dataframe, by):
+    # the order generate_time_series_features sorts the rows in
+    return dataframe.sort_values(by=by).index.to_numpy()
+
+
+def _runs(dataframe, group_features):
+    # the groups of a frame sorted by the group features in frame order, with their number of rows
+    positions, _ = group_positions(dataframe, group_features)
+    starts = np.flatnonzero(positions == 0)
+    runs = dataframe[group_features].iloc[starts].reset_index(drop=True)
+    runs['_rows'] = np.diff(np.append(starts, len(dataframe)))
+    return runs
+
+
+def _place_groups(runs, keys, group_features):
+    # the run each group of new rows adds to, -1 for a new group, the number of runs before each group and the runs
+    # in their new order, with the new groups numbered -1 - the group. Only the groups are sorted, not the rows
+    from errors import UserError
+
+    if not group_features:
+        run = np.full(len(keys), 0 if len(runs) else -1)
+    else:
+        found = keys[group_features].merge(runs[group_features].assign(_run=np.arange(len(runs))),
+                                           on=group_features, how='left')['_run']
+        run = found.fillna(-1).to_numpy(dtype=np.int64)
+    before = run + 1
+    new_groups = np.flatnonzero(run < 0)
+    if len(new_groups) == 0:
+        return run, before, np.arange(len(runs))
+    if not group_features:
+        return run, np.zeros(len(keys), dtype=np.int64), np.array([-1])
+
+    table = pd.concat([runs[group_features].assign(_run=np.arange(len(runs))),
+                       keys[group_features].iloc[new_groups].assign(_run=-1 - new_groups)], ignore_index=True)
+    placed = table['_run'].to_numpy()[_sorted_order(table, group_features)]
+    old = placed >= 0
+    if np.any(np.diff(placed[old]) < 0):
+        raise UserError('The frame must be sorted the way generate_time_series_features returned it')
+    before[-1 - placed[~old]] = np.maximum.accumulate(np.where(old, placed + 1, 0))[~old]
+    return run, before, placed
+
+
+def _changed_rows(slot_rows, slots, unpacked_rows, count, new_count, periods, size):
+    # the rows of the merged frame whose shifted values can differ from the values of the rows before the new rows
+    # were inserted between them: from each new row to the row its packed value is shifted to, every row after a new
+    # row that is left out of the packed values, and the rows around the end of the packed values
+    starts = np.concatenate([np.minimum(slot_rows, slots + periods), unpacked_rows, [count + min(periods, 0)]])
+    stops = np.concatenate([np.maximum(slot_rows, slots + periods) + 1, np.full(len(unpacked_rows), size),
+                            [new_count + max(periods, 0)]])
+    starts, stops = np.clip(starts, 0, size), np.clip(stops, 0, size)
+    keep = stops > starts
+    order = np.argsort(starts[keep], kind='stable')
+    starts, stops = starts[keep][order], np.maximum.accumulate(stops[keep][order])
+    if len(starts) == 0:
+        return starts
+    # the ranges that overlap are joined and the rows of each joined range listed
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > stops[:-1]
+    starts, stops = starts[first], stops[np.append(np.flatnonzero(first)[1:] - 1, len(first) - 1)]
+    lengths = stops - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def _packed_values(index, shifted, count, periods, edges, slots, new_values):
+    # the packed raw values at index once the new values are inserted at slots, taken from the values of the shifted
+    # column and the values the shift moved out of the frame, see _edges. count is the packed values before inserting
+    result = np.full(len(index), np.nan)
+    inserted = np.searchsorted(slots, index)
+    is_slot = inserted < len(slots)
+    is_slot[is_slot] = slots[inserted[is_slot]] == index[is_slot]
+    result[is_slot] = new_values[inserted[is_slot]]
+    packed = index - inserted
+    rows = packed + periods
+    head, tail = edges
+    inside = ~is_slot & (rows >= 0) & (rows < count)
+    result[inside] = shifted[rows[inside]]
+    before = ~is_slot & (rows < 0)
+    result[before] = head[packed[before]]
+    after = ~is_slot & (rows >= count)
+    result[after] = tail[packed[after] - max(count - periods, 0)]
+    return result
+
+
+def update_time_series_features(dataframe, new_rows, state):
+    """ Adds rows to a frame of time series features, computing the features of only the new rows.
+
+    The windows, lags and to date totals of the new rows come from the last rows and totals of their groups in the
+    state, and the new rows are placed at the end of their groups from the number of rows of each group, so only the
+    new rows and the groups are sorted. The features of the existing rows are copied to their new places, and only the
+    rows the frame wide shifts move a value into or out of are filled in again, from the values the shifts moved out of
+    the frame. The result is identical to computing the features of every row again.
+
+    Apart from copying the rows into the returned frame, the work depends on the number of new rows and groups and not
+    the length of the history. The exception is a new row with a null group feature ahead of other groups, which only
+    happens with more than one group feature: the rolling stats of the rows with a group are packed together before
+    they are shifted, so every later rolling stat moves and is filled in again.
+
+    :param pandas.DataFrame dataframe: The frame of features returned with the state.
+    :param pandas.DataFrame new_rows: The rows to add, with the columns of the frame before any features were added.
+    Each row must come after every row of its group already in the frame.
+    :param TimeSeriesState state: The state returned with the frame.
+    :return: The frame with the new rows and their features, and the state to add the next rows with.
+    :rtype: tuple of (pandas.DataFrame, TimeSeriesState)
+    """
+    from errors import UserError
+
+    group_features = state.group_features or []
+    by = group_features + state.levels
+    names = state.feature_names
+    missing = [column for column in by + state.numeric_features if column not in new_rows.columns]
+    if missing:
+        raise UserError(f'new_rows is missing the columns: {missing}')
+    missing = [name for name in names if name not in dataframe.columns]
+    if missing:
+        raise UserError(f'The frame is missing the features: {missing}. Make sure it was returned with the state')
+    runs = state.runs if state.runs is not None else _runs(dataframe, group_features)
+    if int(runs['_rows'].sum()) != len(dataframe):
+        raise UserError('The frame must have the rows it was returned with along with the state')
+
+    # the new rows are sorted and each group of them is inserted after the rows of its group already in the frame
+    new_frame = new_rows.sort_values(by=by).reset_index(drop=True)
+    new_positions, new_valid = group_positions(new_frame, group_features)
+    firsts = np.flatnonzero(new_positions == 0)
+    counts = np.diff(np.append(firsts, len(new_frame)))
+    run, before, placed = _place_groups(runs, new_frame.iloc[firsts], group_features)
+    sizes = runs['_rows'].to_numpy()
+    ends = np.concatenate([[0], np.cumsum(sizes)])
+    valid_ends = np.concatenate([[0], np.cumsum(np.where(runs[group_features].notna().all(axis=1), sizes, 0))])
+    if np.any(np.diff(ends[before]) < 0):
+        raise UserError('The frame must be sorted the way generate_time_series_features returned it')
+    grown = np.flatnonzero(run >= 0)
+    if len(grown):
+        pairs = pd.concat([dataframe[state.levels].iloc[ends[run[grown] + 1] - 1].assign(_pair=grown, _new=0),
+                           new_frame[state.levels].iloc[firsts[grown]].assign(_pair=grown, _new=1)],
+                          ignore_index=True)
+        order = pairs.sort_values(by=['_pair'] + state.levels, kind='stable').index.to_numpy()
+        if np.any(pairs['_new'].to_numpy()[order][::2] != 0):
+            raise UserError('Each new row must come after every row of its group already in the frame')
+    rows = np.repeat(ends[before], counts)  # the row of the frame each new row is inserted before
+    valid_rows = np.repeat(valid_ends[before], counts)  # and the rows with a group before it
+    merged_rows = rows + np.arange(len(new_frame))
+    size = len(dataframe) + len(new_frame)
+
+    # the window of each new row is found in the last rows of its group
+    window_frame = pd.concat([state.tails, new_frame[by + state.numeric_features]], ignore_index=True)
+    window_order = _sorted_order(window_frame, by)
+    window_frame = window_frame.take(window_order).reset_index(drop=True)
+    window_positions, window_valid = group_positions(window_frame, group_features)
+    window_rows = np.empty(len(new_frame), dtype=np.int64)
+    window_new = np.flatnonzero(window_order >= len(state.tails))
+    window_rows[window_order[window_new] - len(state.tails)] = window_new
+
+    # where the packed values of each kind of feature are inserted and the rows whose shifted values change
+    layouts = {}
+    for kind in ('stat', 'lag', 'to_date'):
+        packed_rows, periods = _column_shift(kind, new_valid, bool(group_features), state.shift_amount)
+        if packed_rows is None:
+            slot_rows, slots, unpacked, count = np.arange(len(new_frame)), merged_rows, rows[:0], len(dataframe)
+        else:
+            slot_rows = np.flatnonzero(packed_rows)
+            slots = valid_rows[slot_rows] + np.arange(len(slot_rows))
+            unpacked, count = merged_rows[~packed_rows], int(valid_ends[-1])
+        new_count = count + len(slot_rows)
+        changed = _changed_rows(merged_rows[slot_rows], slots, unpacked, count, new_count, periods, size)
+        # and the packed values the shift moves out of the frame, see _edges
+        moved = (np.arange(min(max(-periods, 0), new_count)), np.arange(max(new_count - max(periods, 0), 0), new_count))
+        layouts[kind] = periods, slot_rows, slots, count, new_count, changed, moved
+
+    heir_levels = state.heir_levels
+    edges = {}
+    columns = {}
+    with np.errstate(invalid='ignore'):
+        running = {}
+        totals = _totals(new_frame, state, state.totals, running)
+        for feature in state.numeric_features:
+            values = window_frame[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+            raw_new = raw_features(values, window_positions, window_valid, [], state.intervals)
+            raw_new = [column[window_rows] for column in raw_new]
+            raw_new.extend(running[feature, heir_level] for heir_level in heir_levels)
+
+            feature_columns = _feature_columns(feature, state.intervals, state.time_name, heir_levels)
+            for (name, kind), new_column in zip(feature_columns, raw_new):
+                periods, slot_rows, slots, count, new_count, changed, moved = layouts[kind]
+                shifted = dataframe[name].to_numpy()
+                lookup = (shifted, count, periods, state.edges[name], slots, new_column[slot_rows])
+                column = np.insert(shifted, rows, np.nan)
+                index = changed - periods
+                shown = (changed < new_count) & (index >= 0) & (index < new_count)
+                changed_values = np.full(len(changed), np.nan)
+                changed_values[shown] = _packed_values(index[shown], *lookup)
+                column[changed] = changed_values
+                columns[name] = column
+                edges[name] = tuple(_packed_values(index, *lookup) for index in moved)
+
+    base_columns = [column for column in dataframe.columns if column not in names]
+    combined = pd.concat([dataframe[base_columns], new_frame[[column for column in new_frame.columns
+                                                             if column in base_columns]]], ignore_index=True)
+    merged = combined.take(np.insert(np.arange(len(dataframe)), rows, np.arange(len(dataframe), size)))
+
+    sizes = sizes.copy()
+    sizes[run[grown]] += counts[grown]
+    if len(placed) == len(runs):
+        new_runs = runs.assign(_rows=sizes)
+    else:
+        keys = pd.concat([runs[group_features], new_frame[group_features].iloc[firsts]], ignore_index=True)
+        ids = np.where(placed >= 0, placed, len(runs) - 1 - placed)
+        new_runs = keys.take(ids).reset_index(drop=True)
+        new_runs['_rows'] = np.concatenate([sizes, counts])[ids]
+    new_state = TimeSeriesState(state.numeric_features, state.levels, state.level, state.time_name, state.intervals,
+                                state.group_features, state.shift_amount, _tails(window_frame, state), totals, edges,
+                                new_runs)
+    return add_columns(merged.reset_index(drop=True), columns), new_state
+
+
+class _ShiftBuffer:
+    """ The packed raw values of one feature that the rows still to be written are shifted from, see shift_packed. """
+
+    def __init__(self, periods):
+        self.periods = periods
+        self.start = 0  # the packed index of the first value held
+        self.values = np.empty(0)
+
+    @property
+    def end(self):
+        return self.start + len(self.values)
+
+    def append(self, values):
+        self.values = np.concatenate([self.values, values])
+
+    def ready(self):
+        """ The number of rows whose values are known before the rest of the stream is read.
+
+        :rtype: int
+        """
+        return self.end + min(self.periods, 0)
+
+    def take(self, first, stop):
+        """ Gets the shifted values of rows first to stop, and lets go of the values no later row needs.
+
+        :param int first: The index of the first row.
+        :param int stop: The index after the last row.
+        :rtype: numpy.ndarray
+        """
+        rows = np.arange(first, stop)
+        index = rows - self.periods
+        result = np.full(len(rows), np.nan)
+        # rows past the packed values and values shifted from outside them stay empty, like shift_packed
+        inside = (index >= self.start) & (index < self.end) & (rows < self.end)
+        result[inside] = self.values[index[inside] - self.start]
+        drop = min(max(stop - self.periods - self.start, 0), len(self.values))
+        self.values = self.values[drop:]
+        self.start += drop
+        return result
+
+
+def _is_sorted(dataframe, by):
+    return bool(np.all(dataframe.sort_values(by=by, kind='stable').index.to_numpy() == np.arange(len(dataframe))))
+
+
+def _last_group(dataframe, positions, rows):
+    # the last rows of the group of the last row, the only group later rows of a sorted stream can belong to
+    if len(dataframe) == 0:
+        return dataframe
+    start = len(dataframe) - 1 - int(positions[-1])
+    return dataframe.iloc[max(start, len(dataframe) - rows):].reset_index(drop=True)
+
+
+def _matching_group(totals, group_features, last_row):
+    # the totals of the group of the last row, the only group later rows of a sorted stream can add to
+    keep = np.ones(len(totals), dtype=bool)
+    for feature in group_features:
+        value = last_row[feature]
+        column = totals[feature]
+        keep &= column.isna().to_numpy() if pd.isna(value) else (column == value).to_numpy()
+    return totals[keep].reset_index(drop=True)
+
+
+def stream_time_series_features(chunks, numeric_features, levels, level, time_name, intervals, group_features=None,
+                                shift_amount=0):
+    """ Computes the features of AtScale.generate_time_series_features over a stream of chunks of a frame that may not
+    fit in memory.
+
+    The chunks must together be sorted by the group features and then the levels. The windows, lags and to date totals
+    are carried across chunks in the state update_time_series_features uses, holding the last rows of only the group
+    in progress, so memory depends on the chunk size rather than the length of the frame. The features are identical
+    to computing the whole frame at once. Rows are yielded as soon as the values they are shifted from are known, which
+    holds back a few rows for a negative shift_amount, and the rows with a null group feature for rolling stats, which
+    are shifted from rows after them.
+
+    :param iterable of pandas.DataFrame chunks: The chunks of the frame, in order.
+    :param list of str numeric_features: The numeric features to use for the calculation.
+    :param list of str levels: The levels of the time hierarchy in the frame, from highest to lowest.
+    :param str level: The level of the rows.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :param list of int intervals: The intervals to create features over.
+    :param list of str group_features: The features to be grouped by. Defaults to None.
+    :param int shift_amount: The lag used to generate the calculated measures. Defaults to 0.
+    :return: The rows of the frame with their features, in chunks.
+    :rtype: iterator of pandas.DataFrame
+    """
+    from errors import UserError
+
+    group_features = list(group_features or [])
+    state = TimeSeriesState(list(numeric_features), list(levels), level, time_name,
+                            [int(interval) for interval in intervals], group_features or None, shift_amount,
+                            None, None, {})
+    by = group_features + state.levels
+    heir_levels = state.heir_levels
+    kinds = [(feature, name, kind) for feature in state.numeric_features
+             for name, kind in _feature_columns(feature, state.intervals, time_name, heir_levels)]
+    buffers = {}
+    for feature, name, kind in kinds:
+        valid_kind = kind == 'stat' and bool(group_features)
+        buffers[name] = (valid_kind, _ShiftBuffer(_column_shift(kind, None, bool(group_features), shift_amount)[1]))
+
+    pending = None  # the rows read but not yet yielded
+    written = 0
+    last_row = None
+    dtypes = {}
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.reset_index(drop=True)
+        check = chunk[by] if last_row is None else pd.concat([last_row[by], chunk[by]], ignore_index=True)
+        if not _is_sorted(check, by):
+            raise UserError(f'The chunks must be sorted by {by}')
+        last_row = chunk.iloc[-1:]
+
+        window_frame = chunk[by + state.numeric_features]
+        if state.tails is not None:
+            window_frame = pd.concat([state.tails, window_frame], ignore_index=True)
+        positions, valid = group_positions(window_frame, group_features)
+        carried = len(window_frame) - len(chunk)
+        chunk_valid = None if valid is None else valid[carried:]
+
+        with np.errstate(invalid='ignore'):
+            running = {}
+            totals = _totals(chunk, state, state.totals, running)
+            for feature in state.numeric_features:
+                dtypes.setdefault(feature, chunk[feature].iloc[:0])
+                values = window_frame[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+                raw = [column[carried:] for column in raw_features(values, positions, valid, [], state.intervals)]
+                raw.extend(running[feature, heir_level] for heir_level in heir_levels)
+                for (name, _), column in zip(_feature_columns(feature, state.intervals, time_name, heir_levels), raw):
+                    packed, buffer = buffers[name]
+                    buffer.append(column[chunk_valid] if packed and chunk_valid is not None else column)
+
+        state.tails = _last_group(window_frame, positions, max(state.intervals))
+        if group_features:
+            totals = {heir_level: _matching_group(frame, group_features, last_row.iloc[0])
+                      for heir_level, frame in totals.items()}
+        state.totals = totals
+
+        pending = chunk if pending is None else pd.concat([pending, chunk], ignore_index=True)
+        stop = min([written + len(pending)] + [buffer.ready() for _, buffer in buffers.values()])
+        if stop > written:
+            yield _stream_rows(pending, written, stop, kinds, buffers, dtypes)
+            pending = pending.iloc[stop - written:].reset_index(drop=True)
+            written = stop
+
+    if pending is not None and len(pending):
+        yield _stream_rows(pending, written, written + len(pending), kinds, buffers, dtypes)
+
+
+def _stream_rows(pending, first, stop, kinds, buffers, dtypes):
+    # the pending rows first to stop along with their features
+    columns = {}
+    for feature, name, kind in kinds:
+        values = buffers[name][1].take(first, stop)
+        columns[name] = _as_dtype_of(values, dtypes[feature]) if kind == 'lag' else values
+    return add_columns(pending.iloc[:stop - first].reset_index(drop=True), columns)
+
+
+def _import_parquet():
+    # pyarrow, with its parquet module loaded
+    from parsers import import_pyarrow
+    pyarrow = import_pyarrow()
+    import pyarrow.parquet
+    return pyarrow
+
+
+def parquet_chunks(path, columns=None):
+    """ Reads a Parquet file one row group at a time, memory mapping the file.
+
+    :param str path: The path of the file.
+    :param list of str columns: The columns to read. Defaults to None for every column.
+    :return: The row groups of the file.
+    :rtype: iterator of pandas.DataFrame
+    """
+    parquet_file = _import_parquet().parquet.ParquetFile(path, memory_map=True)
+    for index in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(index, columns=columns).to_pandas()
+
+
+def write_parquet(frames, path):
+    """ Writes frames to one Parquet file, a row group or more for each frame.
+
+    :param iterable of pandas.DataFrame frames: The frames, with the same columns.
+    :param str path: The path of the file to write.
+    :return: The number of rows written.
+    :rtype: int
+    """
+    pyarrow = _import_parquet()
+    writer = None
+    rows = 0
+    try:
+        for frame in frames:
+            if writer is None:
+                table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            else:
+                table = pyarrow.Table.from_pandas(frame, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+            rows += len(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+# rough costs of the parts of each route, in seconds, see plan_time_series_features. The costs of a value are in line
+# with what benchmarks/bench_time_series_routes.py measures on the client, which leaves out the engine
+PUBLISH_SECONDS = 10.0  # publishing the model once to add calculated features
+TRANSFER_SECONDS = 1e-6  # querying one value of one row from the cube
+COMPUTE_SECONDS = 5e-8  # computing one value of one row with time_series_features
+
+
+def pushdown_features(numeric_features, intervals, time_name):
+    """ Lists the rolling stats and lags of generate_time_series_features, which the cube can compute as the calculated
+    features of AtScale.create_rolling_stats with the same names.
+
+    :param list of str numeric_features: The numeric features to use for the calculation.
+    :param list of int intervals: The intervals to create features over.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :return: The name, numeric feature, interval and stat of each feature, the stat being one of ROLLING_STATS or lag.
+    :rtype: list of tuple
+    """
+    features = []
+    for feature in numeric_features:
+        for interval in intervals:
+            name = feature + f'_{interval}_{time_name}_'
+            if interval > 1:
+                features.extend((f'{name}{stat}', feature, interval, stat) for stat in ROLLING_STATS)
+            features.append((f'{name}lag', feature, interval, 'lag'))
+    return features
+
+
+class TimeSeriesPlan:
+    """ Where the rolling stats and lags of generate_time_series_features are computed, see plan_time_series_features.
+
+    :var str route: 'cube' to query them as calculated features, or 'local' to compute them from the queried rows.
+    :var str reason: Why the route was chosen.
+    :var list of tuple features: The features computed either way, see pushdown_features.
+    :var list of str missing: The names of the features the cube route has to create in the model first.
+    :var dict costs: The estimated seconds of each route, None for a route that cannot give the same values.
+    """
+
+    def __init__(self, route, reason, features, missing, costs):
+        self.route = route
+        self.reason = reason
+        self.features = features
+        self.missing = missing
+        self.costs = costs
+
+    def __repr__(self):
+        return f'TimeSeriesPlan(route={self.route!r}, reason={self.reason!r})'
+
+
+def plan_time_series_features(numeric_features, intervals, time_name, model_features, query_columns, shift_amount=0,
+                              estimated_rows=None, returned_rows=None, route=None, publish_seconds=PUBLISH_SECONDS,
+                              transfer_seconds=TRANSFER_SECONDS, compute_seconds=COMPUTE_SECONDS):
+    """ Decides whether the cube or this process computes the rolling stats and lags of generate_time_series_features.
+
+    Both routes query the same rows, which hold the windows of the rows returned, and compute the to date features
+    locally. The local route computes the rolling stats and lags of every queried row. The cube route instead queries
+    them as calculated features for only the rows returned, which the engine evaluates over the rest of the history,
+    creating the ones the model does not have yet. So the cube route pays for publishing the model once if features
+    are missing and transferring the features of the returned rows, and the local route for computing the features of
+    every row. Computing a value is much cheaper than transferring it, so the cube route only wins when few of the rows
+    are returned, such as the last day of a long daily history. The cube cannot shift the features across the frame,
+    so any shift_amount other than 0 is computed locally.
+
+    :param list of str numeric_features: The numeric features to use for the calculation.
+    :param list of int intervals: The intervals to create features over.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :param collection of str model_features: The numeric features of the model.
+    :param int query_columns: The number of columns both routes query.
+    :param int shift_amount: The lag used to generate the calculated measures. Defaults to 0.
+    :param int estimated_rows: The number of rows the query is expected to return. Defaults to None when unknown, in
+    which case publishing is treated as free next to the rows and every row as returned.
+    :param int returned_rows: The number of the estimated rows that are returned with their features. Defaults to None
+    for every row.
+    :param str route: 'cube' or 'local' to choose the route instead. Defaults to None.
+    :param float publish_seconds: The estimated seconds to publish the model. Defaults to PUBLISH_SECONDS.
+    :param float transfer_seconds: The estimated seconds to query one value of one row. Defaults to TRANSFER_SECONDS.
+    :param float compute_seconds: The estimated seconds to compute one value of one row. Defaults to COMPUTE_SECONDS.
+    :rtype: TimeSeriesPlan
+    """
+    from errors import UserError
+
+    features = pushdown_features(numeric_features, intervals, time_name)
+    missing = [name for name, _, _, _ in features if name not in model_features]
+    rows = 1 if estimated_rows is None else estimated_rows
+    returned = rows if estimated_rows is None or returned_rows is None else min(returned_rows, rows)
+    local = rows * (query_columns * transfer_seconds + len(features) * compute_seconds)
+    cube = (rows * query_columns + returned * len(features)) * transfer_seconds
+    if missing and estimated_rows is not None:
+        cube += publish_seconds
+    if shift_amount:
+        cube = None
+    costs = {'cube': cube, 'local': local}
+
+    if route is not None:
+        if route not in costs:
+            raise UserError(f'route must be \'cube\' or \'local\', not \'{route}\'')
+        if costs[route] is None:
+            raise UserError('The cube can not shift the calculated measures by shift_amount, use the local route')
+        return TimeSeriesPlan(route, 'chosen by the caller', features, missing, costs)
+    if not features:
+        return TimeSeriesPlan('local', 'there are no rolling stats or lags to compute', features, missing, costs)
+    if cube is None:
+        return TimeSeriesPlan('local', 'the cube can not shift the features by shift_amount', features, missing, costs)
+    if cube < local:
+        return TimeSeriesPlan('cube', 'querying the features of the returned rows is estimated to be faster than '
+                                      'computing them for every row', features, missing, costs)
+    return TimeSeriesPlan('local', 'computing the features for every row is estimated to be faster than querying them '
+                                   'for the returned rows', features, missing, costs)
+
+
+def finish_pushed_features(dataframe, numeric_features, levels, level, time_name, intervals, group_features=None,
+                           returned=None):
+    """ Turns the rolling stats and lags the cube computed into the features of generate_time_series_features.
+
+    The calculated features of the cube are evaluated over whatever members the window has, so the rows whose window
+    is incomplete or holds a null are emptied the way a rolling window of rows empties them. The to date features are
+    computed from the queried rows, and every feature goes through the same packing as time_series_features, so the
+    names, order and nulls of the columns match it and the values match up to floating point rounding.
+
+    The rows that are not returned are only queried for the windows and to date totals of the returned rows, and their
+    features of pushdown_features can be null. Unless packed_stats_move, only the returned rows are finished.
+
+    :param pandas.DataFrame dataframe: The queried rows, sorted by the group features and then the levels, with the
+    numeric features and the features of pushdown_features.
+    :param list of str numeric_features: The numeric features to use for the calculation.
+    :param list of str levels: The levels of the time hierarchy in the frame, from highest to lowest.
+    :param str level: The level of the rows.
+    :param str time_name: The name of the time step of the level used in the feature names.
+    :param list of int intervals: The intervals the features were created over.
+    :param list of str group_features: The features to be grouped by. Defaults to None.
+    :param numpy.ndarray returned: Whether each row is returned. Defaults to None to return every row.
+    :return: The returned rows without the queried features and with the features of generate_time_series_features.
+    :rtype: pandas.DataFrame
+    """
+    positions, valid = group_positions(dataframe, group_features)
+    heir_levels = to_date_levels(levels, level)
+    codes = [group_codes(dataframe, (group_features or []) + [heir_level]) for heir_level in heir_levels]
+    pushed = pushdown_features(numeric_features, intervals, time_name)
+    if returned is not None and not packed_stats_move(dataframe, group_features):
+        return _finish_returned_rows(dataframe, numeric_features, intervals, time_name, heir_levels, positions, valid,
+                                     codes, pushed, np.flatnonzero(returned))
+
+    columns = {}
+    with np.errstate(invalid='ignore'):
+        for feature in numeric_features:
+            series = dataframe[feature]
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            nulls = np.isnan(values)
+            null_windows = {}
+            raw = []
+            for name, _, interval, stat in (column for column in pushed if column[1] == feature):
+                column = dataframe[name].to_numpy(dtype=np.float64, na_value=np.nan).copy()
+                if stat == 'lag':
+                    column[positions < interval] = np.nan
+                    if valid is not None:
+                        column[~valid] = np.nan
+                else:
+                    column[positions < interval - 1] = np.nan
+                    if nulls.any():
+                        if interval not in null_windows:
+                            counts = rolling_stats(nulls.astype(np.float64), positions, interval)['sum']
+                            null_windows[interval] = ~(counts == 0)
+                        column[null_windows[interval]] = np.nan
+                raw.append(column)
+            raw.extend(cumsum_by(values, level_codes)[0] for level_codes in codes)
+            _add_features(columns, feature, series, raw, intervals, time_name, heir_levels, valid,
+                          bool(group_features), 0)
+    finished = add_columns(dataframe.drop(columns=[name for name, _, _, _ in pushed]), columns)
+    return finished if returned is None else finished[returned].reset_index(drop=True)
+
+
+def _finish_returned_rows(dataframe, numeric_features, intervals, time_name, heir_levels, positions, valid, codes,
+                          pushed, rows):
+    # finish_pushed_features for only the rows given. Without a shift and with the rows without a group after the
+    # rest, the packing leaves the rolling stats and lags of each row in place, emptying them for the rows without a
+    # group, and the to date totals move down one row across the whole frame
+    previous = rows - 1
+    columns = {}
+    with np.errstate(invalid='ignore'):
+        for feature in numeric_features:
+            series = dataframe[feature]
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            nulls = np.concatenate([[0], np.cumsum(np.isnan(values))])
+            feature_pushed = {name: (interval, stat) for name, pushed_feature, interval, stat in pushed
+                              if pushed_feature == feature}
+            totals = [cumsum_by(values, level_codes)[0] for level_codes in codes]
+            for name, kind in _feature_columns(feature, intervals, time_name, heir_levels):
+                if kind == 'to_date':
+                    column = np.full(len(rows), np.nan)
+                    column[previous >= 0] = totals.pop(0)[previous[previous >= 0]]
+                    columns[name] = column
+                    continue
+                interval, stat = feature_pushed[name]
+                column = dataframe[name].to_numpy(dtype=np.float64, na_value=np.nan)[rows]
+                if stat == 'lag':
+                    column[positions[rows] < interval] = np.nan
+                else:
+                    complete = positions[rows] >= interval - 1
+                    column[~complete] = np.nan
+                    # the nulls in each complete window, which lies within the group
+                    window_nulls = nulls[rows + 1] - nulls[np.maximum(rows + 1 - interval, 0)]
+                    column[complete & (window_nulls > 0)] = np.nan
+                if valid is not None:
+                    column[~valid[rows]] = np.nan
+                columns[name] = _as_dtype_of(column, series) if kind == 'lag' else column
+    kept = dataframe.iloc[rows].drop(columns=[name for name, _, _, _ in pushed]).reset_index(drop=True)
+    return add_columns(kept, columns)
+
+
+def packed_stats_move(dataframe, group_features=None):
+    """ Checks whether time_series_features moves rolling stats to other rows, which it does when a row with a null
+    group feature comes before a row without one, see shift_packed.
+
+    :param pandas.DataFrame dataframe: The frame, sorted by the group features and then the levels.
+    :param list of str group_features: The features the rows are grouped by. Defaults to None.
+    :rtype: bool
+    """
+    if not group_features:
+        return False
+    valid = dataframe[group_features].notna().all(axis=1).to_numpy()
+    return not valid.all() and bool(valid[np.argmin(valid):].any())
+
+
+def compare_time_series_features(left, right, rtol=1e-9, atol=1e-12):
+    """ Checks that two frames of time series features, such as the results of the cube and local routes, match.
+
+    :param pandas.DataFrame left: One frame.
+    :param pandas.DataFrame right: The other frame.
+    :param float rtol: The relative tolerance of numeric values. Defaults to 1e-9.
+    :param float atol: The absolute tolerance of numeric values. Defaults to 1e-12.
+    :return: The number of rows that differ by column, empty when the frames match. A column in only one of the
+    frames, or in a different place, differs in every row.
+    :rtype: dict of str/int
+    """
+    differences = {}
+    rows = max(len(left), len(right))
+    for column in dict.fromkeys(list(left.columns) + list(right.columns)):
+        if column not in left.columns or column not in right.columns or len(left) != len(right) or \
+                list(left.columns).index(column) != list(right.columns).index(column):
+            differences[column] = rows
+            continue
+        a = left[column].to_numpy()
+        b = right[column].to_numpy()
+        if a.dtype.kind in 'fiu' and b.dtype.kind in 'fiu':
+            a = a.astype(np.float64)
+            b = b.astype(np.float64)
+            same = np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            same = (left[column] == right[column]).to_numpy() | (left[column].isna() & right[column].isna()).to_numpy()
+        if not same.all():
+            differences[column] = int((~same).sum())
+    return differences
@@ -0,0 +1,122 @@
+"""Compares the throughput of Iris.add_table and Synapse.add_table with the INSERT ... SELECT ... UNION ALL statements
+they used to build, writing a synthetic DataFrame to a local SQLite stand-in for the ODBC driver, see odbc_standin.
+
+The stand-in waits --latency seconds per round trip to stand for the network. SQLite allows at most 500 SELECTs in a
+compound statement, so the UNION ALL path is run with chunks of at most that many rows.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from common import report, timed
+from odbc_standin import StandInDatabase
+from iris import Iris
+from synapse import Synapse
+
+
+class BenchIris(Iris):
+    """Iris writing to the stand-in, without prompting for a password."""
+
+    def __init__(self, schema):
+        self.namespace = 'bench'
+        self.schema = schema
+        self.atscale_connection_id = 'bench'
+        self.connection_string = 'stand-in'
+
+    def fix_table_name(self, table_name):
+        return table_name
+
+
+class BenchSynapse(Synapse):
+    """Synapse writing to the stand-in, without prompting for a password."""
+
+    def __init__(self, schema):
+        self.database_name = 'bench'
+        self.schema = schema
+        self.atscale_connection_id = 'bench'
+        self.connection_string = 'stand-in'
+
+    def fix_table_name(self, table_name):
+        return table_name
+
+
+def make_dataframe(rows):
+    """ Builds a DataFrame of integer, float and text columns, without nulls as the UNION ALL path wrote them as text.
+    """
+    keys = np.arange(rows)
+    return pd.DataFrame({'id': keys, 'amount': keys * 0.25, 'quantity': keys % 13,
+                         'name': [f'customer {key % 5000}' for key in keys], 'region': [f'r{key % 7}' for key in keys]})
+
+
+def union_all_add_table(standin, database, table_name, dataframe, chunksize, types, quote_all):
+    """ The inserts of Iris.add_table (quote_all) and Synapse.add_table before they used executemany. """
+    import pyodbc as po
+    connection = po.connect(database.connection_string, autocommit=True)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS \"{database.schema}\".\"{table_name}\"")
+    columns = ', '.join(f"\"{col}\" {types[col]}" for col in dataframe.columns)
+    cursor.execute(f"CREATE TABLE \"{database.schema}\".\"{table_name}\" ({columns})")
+
+    operation = f"INSERT INTO \"{database.schema}\".\"{table_name}\" ("
+    for col in dataframe.columns:
+        operation += f"\"{col}\", "
+    operation = operation[:-2]
+    operation += ") "
+    list_df = [dataframe[i:i + chunksize] for i in range(0, dataframe.shape[0], chunksize)]
+    for df in list_df:
+        op_copy = operation
+        for index, row in df.iterrows():
+            op_copy += 'SELECT '
+            for cl in df.columns:
+                if quote_all or 'nvarchar' in types[cl]:
+                    op_copy += "'{}', ".format(row[cl])
+                else:
+                    op_copy += "{}, ".format(row[cl])
+            op_copy = op_copy[:-2]
+            op_copy += " UNION ALL "
+        op_copy = op_copy[:-11]
+        cursor.execute(op_copy)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--chunksize', type=int, default=250)
+    parser.add_argument('--latency', type=float, default=0.0005, help='seconds per round trip')
+    args = parser.parse_args()
+
+    standin = StandInDatabase('bench', latency=args.latency)
+    standin.install()
+    dataframe = make_dataframe(args.rows)
+    types = {'id': 'int', 'amount': 'real', 'quantity': 'int', 'name': 'nvarchar(4000)', 'region': 'nvarchar(4000)'}
+    print(f'{args.rows:,} rows in chunks of {args.chunksize}, {args.latency * 1000:g} ms per round trip')
+    results = [('writer', 'path', 'seconds', 'rows/s', 'round trips')]
+    try:
+        for name, database in (('Iris', BenchIris(standin.schema)), ('Synapse', BenchSynapse(standin.schema))):
+            runs = (
+                ('UNION ALL', lambda: union_all_add_table(standin, database, 'union_all', dataframe, args.chunksize,
+                                                           types, quote_all=name == 'Iris')),
+                ('executemany', lambda: database.add_table('executemany', dataframe, args.chunksize, 'replace')),
+                ('executemany, not fast', lambda: database.add_table('executemany', dataframe, args.chunksize,
+                                                                      'replace', fast_executemany=False)),
+            )
+            for path, run in runs:
+                before = standin.round_trips
+                seconds, _ = timed(run, repeat=1)
+                round_trips = standin.round_trips - before
+                table_name = 'union_all' if path == 'UNION ALL' else 'executemany'
+                cursor = standin.connect().cursor()
+                written = cursor.execute(f'SELECT COUNT(*) FROM "{standin.schema}"."{table_name}"').fetchone()[0]
+                assert written == args.rows, f'{name} {path} wrote {written} rows'
+                results.append((name, path, f'{seconds:.2f}', f'{args.rows / seconds:,.0f}',
+                                f'{round_trips:,}'))
+            database.close()
+    finally:
+        standin.close()
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
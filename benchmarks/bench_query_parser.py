@@ -0,0 +1,79 @@
+"""Compares the peak memory and throughput of QueryResultParser with the regex parsing it replaced, on a synthetic
+query response of a few million cells fed in the 1 MB chunks custom_query streams.
+"""
+import argparse
+import re
+
+import pandas as pd
+
+from common import peak_memory, report, timed
+from parsers import parse_query_response
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_body(rows, columns):
+    """ Builds the XML body of a successful query response with a mix of text, numeric and null cells. """
+    names = ''.join(f'<column><name>column_{i}</name></column>' for i in range(columns))
+    parts = [f'<?xml version="1.0" encoding="UTF-8"?><response><succeeded>true</succeeded><data><columns>{names}'
+             f'</columns><rows>']
+    for row in range(rows):
+        cells = []
+        for column in range(columns):
+            if column == 0:
+                cells.append(f'<column>member {row % 1000}</column>')
+            elif (row + column) % 97 == 0:
+                cells.append('<column null="true"/>')
+            else:
+                cells.append(f'<column>{(row * column) % 100003 / 7:.4f}</column>')
+        parts.append(f'<row>{"".join(cells)}</row>')
+    parts.append('</rows></data></response>')
+    return ''.join(parts).encode('utf-8')
+
+
+def regex_parse(content):
+    """ The parsing of AtScale._parse_query_response before QueryResultParser. """
+    content = str(content)
+    if re.search('<succeeded>(.*?)</succeeded>', content).group(1) == 'false':
+        raise Exception(re.search('<error-message>(.*?)</error-message>', ' '.join(content.split('\n'))).group(1))
+    column_names = re.findall('<name>(.*?)</name>', content)
+    row_text = re.findall('<row>(.*?)</row>', content)
+    rows = []
+    for row in row_text:
+        row = row.replace('<column null="true"/>', '<column></column>')
+        cells = re.findall('<column>(.*?)</column>', row)
+        rows.append(cells)
+    df = pd.DataFrame(data=rows, columns=column_names)
+    for column in df.columns:
+        # errors='ignore', which newer pandas no longer accepts
+        try:
+            df[column] = pd.to_numeric(df[column].values)
+        except (ValueError, TypeError):
+            pass
+    return df
+
+
+def stream_parse(content):
+    chunks = (content[i:i + CHUNK_SIZE] for i in range(0, len(content), CHUNK_SIZE))
+    return parse_query_response(chunks).to_dataframe()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--columns', type=int, default=10)
+    args = parser.parse_args()
+
+    body = make_body(args.rows, args.columns)
+    cells = args.rows * args.columns
+    print(f'{cells:,} cells, {len(body) / 2 ** 20:.1f} MB body')
+    results = [('parser', 'seconds', 'cells/s', 'peak MB')]
+    for name, function in (('regex', regex_parse), ('QueryResultParser', stream_parse)):
+        seconds, _ = timed(function, body)
+        peak = peak_memory(function, body)
+        results.append((name, f'{seconds:.2f}', f'{cells / seconds:,.0f}', f'{peak / 2 ** 20:.0f}'))
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
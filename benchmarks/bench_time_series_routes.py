@@ -0,0 +1,136 @@
+"""Measures the client side of both routes of AtScale.get_time_series_features on synthetic daily panels with few and
+many rolling stats, for a range of returned rows, and checks that plan_time_series_features picks the faster route.
+
+The local route parses a query response of every row and computes the rolling stats and lags of every row. The cube
+route parses a response of the earlier rows, a response of the returned rows with their calculated features and
+finishes them with finish_pushed_features. The time the engine takes to evaluate the calculated features is not
+measured here. The seconds per value of each route are fitted from the runs, and the plan is made with them and no
+publishing, as the calculated features are taken to be in the model already.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from common import report, timed
+from parsers import parse_query_response
+from time_series import (add_columns, finish_pushed_features, plan_time_series_features, pushdown_features,
+                         time_series_features)
+
+CHUNK_SIZE = 1024 * 1024
+LEVELS = ['year', 'day']
+# the number of numeric features and the intervals of each panel
+SCENARIOS = (('narrow', 2, [1, 7, 28]), ('wide', 8, [1, 7, 14, 28, 56, 91, 182, 364]))
+
+
+def make_panel(groups, days, features, seed=0):
+    """ Builds a daily panel of numeric features, with a few nulls. """
+    rng = np.random.default_rng(seed)
+    panel = pd.DataFrame({'store': np.repeat([f'store {i}' for i in range(groups)], days),
+                          'year': np.tile(2000 + np.arange(days) // 365, groups),
+                          'day': np.tile(np.arange(days), groups)})
+    for feature in (f'measure_{i}' for i in range(features)):
+        values = rng.normal(100, 30, len(panel)).round(2)
+        values[rng.random(len(panel)) < 0.01] = np.nan
+        panel[feature] = values
+    return panel
+
+
+def make_body(dataframe):
+    """ Builds the XML body of the query response that returns the rows of a frame. """
+    names = ''.join(f'<column><name>{name}</name></column>' for name in dataframe.columns)
+    cells = [np.where(dataframe[name].isna(), '<column null="true"/>',
+                      '<column>' + dataframe[name].astype(str) + '</column>') for name in dataframe.columns]
+    rows = ''.join('<row>' + ''.join(row) + '</row>' for row in zip(*cells))
+    return (f'<?xml version="1.0" encoding="UTF-8"?><response><succeeded>true</succeeded><data><columns>{names}'
+            f'</columns><rows>{rows}</rows></data></response>').encode('utf-8')
+
+
+def parse(body):
+    chunks = (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+    return parse_query_response(chunks).to_dataframe()
+
+
+def local_route(body, numeric_features, intervals, since):
+    dataframe = parse(body).sort_values(by=['store'] + LEVELS).reset_index(drop=True)
+    columns = time_series_features(dataframe, numeric_features, LEVELS, 'day', 'day', intervals, ['store'])
+    dataframe = add_columns(dataframe, columns)
+    return dataframe[dataframe['day'] >= since].reset_index(drop=True)
+
+
+def cube_route(history_body, returned_body, numeric_features, intervals):
+    history = parse(history_body)
+    dataframe = pd.concat([history, parse(returned_body)], ignore_index=True).sort_values(by=['store'] + LEVELS)
+    returned = dataframe.index >= len(history)
+    return finish_pushed_features(dataframe.reset_index(drop=True), numeric_features, LEVELS, 'day', 'day', intervals,
+                                  ['store'], returned)
+
+
+def run_scenario(groups, days, features, intervals):
+    """ Times both routes on a panel for a tenth, a hundredth and one day of it returned.
+
+    :return: The rows, query columns and rolling stats and lags of the panel, and the returned rows and seconds of
+    each route of each run.
+    :rtype: tuple
+    """
+    panel = make_panel(groups, days, features)
+    numeric_features = list(panel.columns[len(LEVELS) + 1:])
+    pushed = [name for name, _, _, _ in pushdown_features(numeric_features, intervals, 'day')]
+    # the engine's calculated features, which match the rolling stats and lags computed locally without a shift
+    engine = add_columns(panel.copy(), time_series_features(panel, numeric_features, LEVELS, 'day', 'day', intervals,
+                                                            ['store']))
+    full_body = make_body(panel)
+    runs = []
+    for returned_days in sorted({days // 10, days // 100, 1} - {0}, reverse=True):
+        since = days - returned_days
+        earlier = panel['day'] < since
+        history_body = make_body(panel[earlier])
+        returned_body = make_body(engine.loc[~earlier, list(panel.columns) + pushed])
+        local_seconds, local = timed(local_route, full_body, numeric_features, intervals, since)
+        cube_seconds, cube = timed(cube_route, history_body, returned_body, numeric_features, intervals)
+        pd.testing.assert_frame_equal(local, cube, check_dtype=False)
+        runs.append((returned_days * groups, local_seconds, cube_seconds))
+    return len(panel), len(panel.columns), len(pushed), runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--days', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, features, intervals in SCENARIOS:
+        results[name] = run_scenario(args.groups, args.days, features, intervals)
+        rows, query_columns, pushed, _ = results[name]
+        print(f'{name}: {rows:,} rows of {query_columns} columns, {pushed} rolling stats and lags')
+
+    # the seconds to transfer and to compute a value, fitted to every run of both routes
+    parts, seconds = [], []
+    for rows, query_columns, pushed, runs in results.values():
+        for returned, local_seconds, cube_seconds in runs:
+            parts.extend([(rows * query_columns + returned * pushed, 0), (rows * query_columns, rows * pushed)])
+            seconds.extend([cube_seconds, local_seconds])
+    (transfer_seconds, compute_seconds), *_ = np.linalg.lstsq(np.array(parts, dtype=np.float64), np.array(seconds),
+                                                               rcond=None)
+    print(f'fitted {transfer_seconds:.2e} s to transfer a value and {compute_seconds:.2e} s to compute one')
+
+    table = [('panel', 'returned rows', 'local s', 'cube s', 'faster', 'planned')]
+    agree = total = 0
+    for (name, features, intervals), (rows, query_columns, _, runs) in zip(SCENARIOS, results.values()):
+        numeric_features = [f'measure_{i}' for i in range(features)]
+        model_features = {name for name, _, _, _ in pushdown_features(numeric_features, intervals, 'day')}
+        for returned, local_seconds, cube_seconds in runs:
+            plan = plan_time_series_features(numeric_features, intervals, 'day', model_features, query_columns,
+                                             estimated_rows=rows, returned_rows=returned,
+                                             transfer_seconds=transfer_seconds, compute_seconds=compute_seconds)
+            faster = 'cube' if cube_seconds < local_seconds else 'local'
+            agree += plan.route == faster
+            total += 1
+            table.append((name, f'{returned:,}', f'{local_seconds:.2f}', f'{cube_seconds:.2f}', faster, plan.route))
+    report(table)
+    print(f'the plan picked the faster route {agree} of {total} times')
+
+
+if __name__ == '__main__':
+    main()
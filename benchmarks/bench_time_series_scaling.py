@@ -0,0 +1,60 @@
+"""Measures how time_series_features scales from one process to one per CPU on a synthetic panel of grouped daily
+rows, checking that every process count gives the same columns as computing in this process.
+
+Each process count runs in a pool that is started and warmed up before it is timed, so the times cover the
+computation and the shared memory transfers but not process start up.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from common import report, timed
+from time_series import time_series_features
+
+
+def make_panel(groups, days, seed=1):
+    """ Builds a frame of groups x days rows sorted by group and day, with a few nulls in the measures. """
+    rng = np.random.default_rng(seed)
+    rows = groups * days
+    dataframe = pd.DataFrame({'store': np.repeat(np.arange(groups), days), 'year': np.tile(np.arange(days) // 365, groups),
+                              'day': np.tile(np.arange(days), groups), 'sales': rng.normal(100, 20, rows),
+                              'units': rng.integers(0, 50, rows).astype(float)})
+    dataframe.loc[::97, 'sales'] = np.nan
+    return dataframe
+
+
+def _warm_up(_):
+    return os.getpid()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--groups', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--max-jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', RuntimeWarning)
+
+    dataframe = make_panel(args.groups, args.days)
+    arguments = (dataframe, ['sales', 'units'], ['year', 'day'], 'day', 'Day', [7, 28, 91], ['store'], 1)
+    print(f'{dataframe.shape[0]:,} rows in {args.groups:,} groups, {os.cpu_count()} CPUs')
+
+    serial, expected = timed(time_series_features, *arguments)
+    results = [('processes', 'seconds', 'speedup'), ('in process', f'{serial:.2f}', '1.00')]
+    counts = sorted({2 ** i for i in range(args.max_jobs.bit_length()) if 2 ** i <= args.max_jobs} | {args.max_jobs})
+    for jobs in counts:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(_warm_up, range(jobs)))
+            seconds, columns = timed(time_series_features, *arguments, n_jobs=jobs, executor=executor)
+        for name, values in expected.items():
+            assert np.array_equal(columns[name], values, equal_nan=True), f'{name} differs with {jobs} processes'
+        results.append((jobs, f'{seconds:.2f}', f'{serial / seconds:.2f}'))
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
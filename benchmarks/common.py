@@ -0,0 +1,55 @@
+"""Helpers shared by the benchmarks, which are run as scripts from the repository root, e.g.
+
+    python benchmarks/bench_query_parser.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+# the package modules import each other by their flat names
+PACKAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'atscale')
+sys.path[:0] = [PACKAGE, os.path.join(PACKAGE, 'db')]
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    """ Runs a function a few times and keeps the fastest run.
+
+    :param function function: The function to run.
+    :param int repeat: The number of runs. Defaults to 3.
+    :return: The seconds of the fastest run and the result of the last run.
+    :rtype: tuple of (float, object)
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def peak_memory(function, *args, **kwargs):
+    """ Measures the most memory a function allocates at once with tracemalloc.
+
+    :param function function: The function to run.
+    :return: The peak bytes allocated while it ran.
+    :rtype: int
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(rows):
+    """ Prints a table of results.
+
+    :param list of tuple rows: The header, then one tuple per result.
+    """
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
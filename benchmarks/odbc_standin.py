@@ -0,0 +1,130 @@
+"""A local stand-in for pyodbc backed by SQLite, for benchmarking the ODBC writers without a warehouse.
+
+Every statement sent to the stand-in waits for one simulated network round trip before SQLite runs it. executemany is
+one round trip when fast_executemany is on, as pyodbc then binds the parameters as arrays, and one per row otherwise.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+
+class StandInCursor:
+    """A pyodbc-like cursor over a SQLite cursor."""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = connection._sqlite.cursor()
+        self.fast_executemany = False
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, operation, *parameters):
+        self._connection._round_trip(len(operation))
+        self._cursor.execute(operation, parameters)
+        return self
+
+    def executemany(self, operation, rows):
+        rows = list(rows)
+        if self.fast_executemany:
+            self._connection._round_trip(len(operation))
+        else:
+            for _ in rows:
+                self._connection._round_trip(len(operation))
+        self._cursor.executemany(operation, rows)
+
+    def tables(self, table=None, schema=None, tableType=None):
+        self._connection._round_trip(0)
+        schemas = [schema] if schema else [name for _, name, _ in self._cursor.execute('PRAGMA database_list').fetchall()]
+        query = ' UNION ALL '.join(f'SELECT \'{name}\', name FROM "{name}".sqlite_master WHERE type = \'table\' AND '
+                                   f'name = ?' for name in schemas)
+        self._cursor.execute(query, [table] * len(schemas))
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+
+class StandInConnection:
+    """A pyodbc-like connection to the stand-in database, with the schema attached under its own name."""
+
+    def __init__(self, database, latency, autocommit=False):
+        self._database = database
+        self._latency = latency
+        self._sqlite = sqlite3.connect(database.path, timeout=600, check_same_thread=False)
+        self._sqlite.execute(f'ATTACH DATABASE ? AS "{database.schema}"', (database.schema_path,))
+        self.autocommit = autocommit
+
+    @property
+    def autocommit(self):
+        return self._sqlite.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._sqlite.isolation_level = None if value else 'DEFERRED'
+
+    def _round_trip(self, size):
+        self._database.round_trips += 1
+        self._database.bytes_sent += size
+        if self._latency:
+            time.sleep(self._latency)
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        self._round_trip(0)
+        self._sqlite.commit()
+
+    def rollback(self):
+        self._sqlite.rollback()
+
+    def close(self):
+        self._sqlite.close()
+
+
+class StandInDatabase:
+    """A temporary SQLite database with a schema that stand-in connections connect to.
+
+    :var int round_trips: The simulated round trips so far.
+    :var int bytes_sent: The characters of SQL sent so far.
+    """
+
+    def __init__(self, schema, latency=0.0):
+        """ Creates the database in a temporary directory.
+
+        :param str schema: The name the schema database is attached under.
+        :param float latency: The seconds each round trip waits. Defaults to 0.
+        """
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'main.db')
+        self.schema = schema
+        self.schema_path = os.path.join(self._directory.name, f'{schema}.db')
+        self.latency = latency
+        self.round_trips = 0
+        self.bytes_sent = 0
+        sqlite3.connect(self.schema_path).execute('PRAGMA journal_mode=WAL').close()
+
+    def connect(self, connection_string=None, autocommit=False):
+        return StandInConnection(self, self.latency, autocommit)
+
+    def install(self):
+        """ Installs the stand-in as the pyodbc module.
+        """
+        sys.modules['pyodbc'] = types.SimpleNamespace(connect=self.connect)
+
+    def close(self):
+        self._directory.cleanup()
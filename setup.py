@@ -15,14 +15,18 @@ REQUIRED = [
         ]
 
 GBQ_REQUIRED = ['sqlalchemy>=1.4.29', 'pybigquery>=0.10.2', 'pandas_gbq>=0.16.0']
-DATABRICKS_REQUIRED = ['sqlalchemy>=1.4.29']
+DATABRICKS_REQUIRED = ['sqlalchemy>=1.4.29', 'pyarrow>=6.0.1']
 IRIS_REQUIRED = ['pyodbc>=4.0.32']
-REDSHIFT_REQUIRED = ['sqlalchemy>=1.4.29', 'sqlalchemy-redshift>=0.8.9']
-SNOWFLAKE_REQUIRED = ['sqlalchemy>=1.4.29', 'snowflake-sqlalchemy>=1.3.3']
+REDSHIFT_REQUIRED = ['sqlalchemy>=1.4.29', 'sqlalchemy-redshift>=0.8.9', 'pyarrow>=6.0.1', 'boto3>=1.20.0']
+SNOWFLAKE_REQUIRED = ['sqlalchemy>=1.4.29', 'snowflake-sqlalchemy>=1.3.3', 'pyarrow>=6.0.1']
 SYNAPSE_REQUIRED = ['pyodbc>=4.0.32']
 ATSPARK_REQUIRED = ['pyspark>=3.1.2']
+ASYNC_REQUIRED = ['aiohttp>=3.8.1']
+CACHE_REQUIRED = ['pyarrow>=6.0.1']
+ARROW_REQUIRED = ['pyarrow>=6.0.1']
 DEV_REQUIRED = GBQ_REQUIRED + DATABRICKS_REQUIRED + IRIS_REQUIRED + REDSHIFT_REQUIRED \
-               + SNOWFLAKE_REQUIRED + SYNAPSE_REQUIRED + ATSPARK_REQUIRED + ['IPython']
+               + SNOWFLAKE_REQUIRED + SYNAPSE_REQUIRED + ATSPARK_REQUIRED + ASYNC_REQUIRED + CACHE_REQUIRED + ARROW_REQUIRED \
+               + ['IPython']
 EXTRAS_REQUIRE = {
             'dev': DEV_REQUIRED,
             'gbq': GBQ_REQUIRED,
@@ -31,6 +35,9 @@ EXTRAS_REQUIRE = {
             'redshift': REDSHIFT_REQUIRED,
             'snowflake': SNOWFLAKE_REQUIRED,
             'synapse': SYNAPSE_REQUIRED,
+            'async': ASYNC_REQUIRED,
+            'cache': CACHE_REQUIRED,
+            'arrow': ARROW_REQUIRED,
       }
 
 setup(name='atscale',